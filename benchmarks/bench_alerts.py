@@ -0,0 +1,132 @@
+"""
+Cost of the alert rules per report, and delivery of the notifications to a
+local stand-in of the webhook: a fleet reports every 10s, a few GPUs heat
+past the threshold, some machines go silent, then everything recovers. Each
+notification should be delivered once.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_alerts --machines 1000 --reports 30
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+
+class WebhookStandIn(BaseHTTPRequestHandler):
+    received: List[dict] = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        WebhookStandIn.received.extend(json.loads(body)["alerts"])
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--machines", type=int, default=1000)
+    parser.add_argument("--reports", type=int, default=30, help="per machine")
+    parser.add_argument("--hot", type=float, default=0.05, help="share of GPUs")
+    args = parser.parse_args(argv)
+
+    from benchmarks.common import make_status, random_machine_id
+    from server import ingest
+    from server.alerts import AlertEngine, WebhookSink, load_rules
+    from server.metric_history import samples
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), WebhookStandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/alerts"
+
+    machines = []
+    for _ in range(args.machines):
+        report = ingest.parse_report(make_status(random_machine_id(), ""))
+        values = samples(report)
+        for name in values:
+            if name.endswith(".temperature"):
+                values[name] = 60.0
+            elif name.endswith(".usage") or name == "ram_usage":
+                values[name] = 0.5
+        machines.append((report["machine_id"], values))
+    hot = set(random.sample(range(args.machines), int(args.machines * args.hot)))
+
+    async def run() -> None:
+        sink = WebhookSink(url)
+        engine = AlertEngine(load_rules(), sink.submit)
+
+        async def deliver() -> None:
+            while True:
+                batch = await sink.next_batch()
+                await asyncio.to_thread(sink.post, batch)
+
+        task = asyncio.create_task(deliver())
+        start_ts = time.time()
+        # baseline: every metric within bounds
+        elapsed = 0.0
+        for i in range(args.reports):
+            ts = start_ts + i * 10
+            start = time.perf_counter()
+            for machine_id, values in machines:
+                engine.evaluate(machine_id, ts, values)
+            elapsed += time.perf_counter() - start
+        n = args.machines * args.reports
+        print(
+            f"{len(machines[0][1])} metrics: {elapsed / n * 1e6:.2f} us per report "
+            f"within bounds"
+        )
+
+        # hot GPUs for 2 minutes, then back to normal
+        elapsed = 0.0
+        for i in range(args.reports, args.reports + 24):
+            ts = start_ts + i * 10
+            start = time.perf_counter()
+            for index, (machine_id, values) in enumerate(machines):
+                if index in hot:
+                    temperature = 95.0 if i < args.reports + 12 else 80.0
+                    values = {**values, "gpu.0.temperature": temperature}
+                engine.evaluate(machine_id, ts, values)
+            elapsed += time.perf_counter() - start
+        n = args.machines * 24
+        print(f"{elapsed / n * 1e6:.2f} us per report with {len(hot)} hot GPUs")
+
+        # the hot machines go silent
+        ts = start_ts + (args.reports + 24) * 10
+        now = ts + 3600
+        last_seen = {machine_id: now - 10 for machine_id, _ in machines}
+        for index in hot:
+            last_seen[machines[index][0]] = ts
+        engine.sweep(now, last_seen)
+        engine.sweep(now + 10, last_seen)  # nothing new
+        for index in hot:
+            engine.evaluate(machines[index][0], now + 10, machines[index][1])
+
+        while sink.queue.qsize():
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(0.2)
+        task.cancel()
+        print(f"notified {engine.notified}, webhook {sink.stats()}")
+
+    asyncio.run(run())
+    server.shutdown()
+
+    received = WebhookStandIn.received
+    by_status = {}
+    for notification in received:
+        key = (notification["rule"], notification["status"])
+        by_status[key] = by_status.get(key, 0) + 1
+    print(f"received {len(received)}: {by_status}")
+    duplicates = len(received) - len({(n["id"], n["status"]) for n in received})
+    print(f"duplicates: {duplicates}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Compare the in-process throughput of /report (one report per request)
+with /report_batch (many reports per request).
+
+Usage (from the repository root):
+    python -m benchmarks.bench_batch --reports 2000 --batch-size 1 10 50 200
+"""
+
+import argparse
+import json
+import logging
+import time
+from typing import List
+
+from fastapi.testclient import TestClient
+
+from benchmarks.common import make_status, random_machine_id
+
+HEADERS = {"Content-type": "application/json"}
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--reports", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, nargs="+", default=[10, 50, 200])
+    args = parser.parse_args(argv)
+
+    from server.main import app
+
+    # the test client logs every request
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    client = TestClient(app)
+    report_key = client.post("/create_report_key?user_id=1000").json()["report_key"]
+    reports = [
+        make_status(random_machine_id(), report_key) for _ in range(args.reports)
+    ]
+
+    start = time.perf_counter()
+    for report in reports:
+        r = client.post("/report", content=json.dumps(report), headers=HEADERS)
+        assert r.status_code == 201, r.text
+    single = args.reports / (time.perf_counter() - start)
+    print(f"{'mode':>16} {'reports/s':>10} {'speedup':>8}")
+    print(f"{'/report':>16} {single:>10.1f} {1:>8.2f}")
+
+    for batch_size in args.batch_size:
+        bodies = [
+            json.dumps(reports[i : i + batch_size])
+            for i in range(0, args.reports, batch_size)
+        ]
+        start = time.perf_counter()
+        for body in bodies:
+            r = client.post("/report_batch", content=body, headers=HEADERS)
+            assert r.status_code == 200, r.text
+        rate = args.reports / (time.perf_counter() - start)
+        label = f"/report_batch {batch_size}"
+        print(f"{label:>16} {rate:>10.1f} {rate / single:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Throughput and peak memory of /export for growing views: the export is
+encoded chunk by chunk, so its peak memory should not grow with the number
+of machines, unlike materializing the whole view.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_export --machines 1000 10000 --table gpu
+"""
+
+import argparse
+import time
+import tracemalloc
+from typing import List
+
+from benchmarks.common import make_status, random_machine_id
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--machines", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--table", default="gpu")
+    parser.add_argument("--formats", nargs="+", default=["ndjson", "csv", "arrow"])
+    args = parser.parse_args(argv)
+
+    import server.database as db
+    from server import export, ingest
+    from server.data_model import ViewGroup
+
+    report_key = db.create_new_report_key("1000")["report_key"]
+    print(f"{'machines':>8} {'format':>7} {'rows/s':>10} {'MiB':>8} {'peak KiB':>9}")
+    for machines in args.machines:
+        machine_ids = [random_machine_id() for _ in range(machines)]
+        for machine_id in machine_ids:
+            db.store_report(ingest.parse_report(make_status(machine_id, report_key)))
+        view_key = db.create_new_view_group(
+            "1000", ViewGroup(view_machines=machine_ids)
+        ).view_key
+        for fmt in args.formats:
+            try:
+                export.check_format(fmt)
+            except export.UnsupportedFormat as e:
+                print(f"{machines:>8} {fmt:>7} {e}")
+                continue
+            table = export.TABLES[args.table]
+            rows = sum(1 for _ in db.export_view(view_key, args.table))
+            start = time.perf_counter()
+            size = sum(
+                len(chunk)
+                for chunk in export.encode(
+                    fmt, table, db.export_view(view_key, args.table)
+                )
+            )
+            elapsed = time.perf_counter() - start
+            # traced separately, tracing slows the export down
+            tracemalloc.start()
+            for _ in export.encode(fmt, table, db.export_view(view_key, args.table)):
+                pass
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(
+                f"{machines:>8} {fmt:>7} {rows / elapsed:>10.0f} "
+                f"{size / 1024 / 1024:>8.1f} {peak / 1024:>9.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+Memory per sample of the report history (reports as stored: compact
+records sharing the unchanged values with the previous report) against the
+columnar metric history (one float32 array per metric), the time of a
+range query over the metric history, and the time of a week-long query
+over the samples against the rollups.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_history --machines 200 --samples 360
+"""
+
+import argparse
+import random
+import time
+import tracemalloc
+from typing import Callable, List
+
+from benchmarks.common import (
+    make_gpu_compute_processes,
+    make_gpu_status,
+    make_status,
+    random_machine_id,
+)
+
+
+def traced_bytes(build: Callable[[], object]) -> int:
+    """
+    Bytes still allocated by `build` once it returned, the result kept alive
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del result
+    return allocated
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--machines", type=int, default=200)
+    parser.add_argument("--samples", type=int, default=360, help="per machine")
+    parser.add_argument("--gpus", type=int, default=4)
+    parser.add_argument("--days", type=int, default=7, help="of rollup queries")
+    args = parser.parse_args(argv)
+
+    from server import ingest
+    from server.history import ReportHistory
+    from server.metric_history import MetricHistory, memory_report, samples
+    from server.profiles import compact, share_unchanged
+    from server.rollup import RESOLUTIONS, Rollups
+
+    start_ts = time.time() - args.samples * 10
+    machines = [
+        (random_machine_id(), [make_status("", "", n_gpus=args.gpus)])
+        for _ in range(args.machines)
+    ]
+
+    def reports(machine_id: str, template: dict):
+        # a new dict per report, as received: the CPU, RAM and GPUs change
+        # every report, the GPU processes every minute
+        processes = template["gpu_compute_processes"]
+        for i in range(args.samples):
+            if i % 6 == 0:
+                processes = make_gpu_compute_processes(n_gpus=args.gpus)
+            report = ingest.parse_report(
+                {
+                    **template,
+                    "machine_id": machine_id,
+                    "uptime": template["uptime"] + i * 10,
+                    "cpu_usage": random.random(),
+                    "ram_free": float(random.randint(1000, 500000)),
+                    "gpu_status": make_gpu_status(args.gpus),
+                    "gpu_compute_processes": processes,
+                }
+            )
+            yield start_ts + i * 10, report
+
+    def build_report_history():
+        histories = []
+        for machine_id, (template,) in machines:
+            history = ReportHistory(args.samples)
+            previous = None
+            for _, report in reports(machine_id, template):
+                # as stored by database._apply_report
+                previous = share_unchanged(compact(report), previous)
+                history.append(previous)
+            histories.append(history)
+        return histories
+
+    def build_metric_history():
+        histories = []
+        for machine_id, (template,) in machines:
+            history = MetricHistory(args.samples)
+            for ts, report in reports(machine_id, template):
+                history.append(ts, samples(report))
+            histories.append(history)
+        return histories
+
+    n = args.machines * args.samples
+    report_bytes = traced_bytes(build_report_history)
+    metric_bytes = traced_bytes(build_metric_history)
+    histories = build_metric_history()
+    report = memory_report(histories)
+
+    print(f"{args.machines} machines x {args.samples} samples, {args.gpus} GPUs")
+    print(f"{'':>28} {'MiB':>8} {'B/sample':>9}")
+    print(
+        f"{'report history (stored)':>28} {report_bytes / 2**20:>8.1f} {report_bytes / n:>9.0f}"
+    )
+    print(
+        f"{'metric history (float32)':>28} {metric_bytes / 2**20:>8.1f} {metric_bytes / n:>9.0f}"
+    )
+    print(
+        f"memory_report: {report['bytes_per_sample']} B/sample, "
+        f"{report['bytes_per_value']} B/value over {report['values']} values"
+    )
+
+    history = histories[0]
+    since = start_ts + args.samples * 5  # last half
+    for metrics, step in ((None, 0), (["gpu.*.temperature"], 0), (None, 60)):
+        start = time.perf_counter()
+        for _ in range(100):
+            result = history.query(since=since, step=step, metrics=metrics)
+        elapsed = (time.perf_counter() - start) / 100
+        points = len(result["timestamps"]) * len(result["metrics"])
+        print(
+            f"query metrics={metrics} step={step}: {points} values "
+            f"in {elapsed * 1e6:.0f} us"
+        )
+
+    # a week of samples every 10s, kept whole, against the rollups
+    n = args.days * 24 * 360
+    values = samples(ingest.parse_report(machines[0][1][0]))
+    week = MetricHistory(n)
+    rollups = Rollups(RESOLUTIONS)
+    start = time.perf_counter()
+    for i in range(n):
+        rollups.append(start_ts + i * 10, values)
+    append = (time.perf_counter() - start) / n
+    for i in range(n):
+        week.append(start_ts + i * 10, values)
+    print(
+        f"{n} samples, {len(values)} metrics: rollup append {append * 1e6:.1f} us, "
+        f"{rollups.nbytes() / 1024:.0f} KiB of rollups"
+    )
+    for step in (300, 3600):
+        for name, query in (("samples", week.query), ("rollups", rollups.query)):
+            start = time.perf_counter()
+            for _ in range(10):
+                result = query(step=step, metrics=["gpu.*.gpu_usage"])
+            elapsed = (time.perf_counter() - start) / 10
+            points = len(result["timestamps"]) * len(result["metrics"])
+            print(f"{name:>8} step={step}: {points} values in {elapsed * 1e6:.0f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Parse-to-store time per report, from the request body to the stored dict,
+before (MachineStatus model validated then dumped) and after (the compiled
+schema of server/ingest.py validating straight into the dict), and the time
+to serialize a stored status for /view, before (validated again as a model)
+and after (serialized directly).
+
+Usage (from the repository root):
+    python -m benchmarks.bench_ingest --reports 2000 --gpus 8
+"""
+
+import argparse
+import json
+from typing import Callable, List
+
+import msgpack
+from pydantic import TypeAdapter
+
+from benchmarks.bench_msgpack import timed
+from benchmarks.common import make_status, random_machine_id
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--reports", type=int, default=2000)
+    parser.add_argument("--gpus", type=int, default=8)
+    parser.add_argument("--procs", type=int, default=8, help="GPU processes")
+    args = parser.parse_args(argv)
+
+    import server.database as db
+    from server import codec, ingest
+    from server.data_model import MachineStatus
+
+    report_key = db.create_new_report_key("1000")["report_key"]
+    reports = [
+        make_status(
+            random_machine_id(), report_key, n_gpus=args.gpus, n_procs=args.procs
+        )
+        for _ in range(args.reports)
+    ]
+    n = len(reports)
+    json_bodies = [json.dumps(report).encode() for report in reports]
+    msgpack_bodies = [msgpack.packb(report) for report in reports]
+    stored = [ingest.parse_report_json(body) for body in json_bodies]
+    adapter = TypeAdapter(MachineStatus)
+
+    def per_report(func: Callable[[], object]) -> float:
+        return timed(func) / n * 1e6
+
+    rows = [
+        (
+            "JSON parse (us)",
+            per_report(
+                lambda: [
+                    MachineStatus.model_validate_json(b).model_dump()
+                    for b in json_bodies
+                ]
+            ),
+            per_report(lambda: [ingest.parse_report_json(b) for b in json_bodies]),
+        ),
+        (
+            "JSON parse-to-store (us)",
+            per_report(
+                lambda: [
+                    db.store_new_report(MachineStatus.model_validate_json(b))
+                    for b in json_bodies
+                ]
+            ),
+            per_report(
+                lambda: [
+                    db.store_report(ingest.parse_report_json(b)) for b in json_bodies
+                ]
+            ),
+        ),
+        (
+            "MessagePack parse-to-store (us)",
+            per_report(
+                lambda: [
+                    db.store_new_report(
+                        MachineStatus.model_validate(msgpack.unpackb(b))
+                    )
+                    for b in msgpack_bodies
+                ]
+            ),
+            per_report(
+                lambda: [
+                    db.store_report(ingest.parse_report(msgpack.unpackb(b)))
+                    for b in msgpack_bodies
+                ]
+            ),
+        ),
+        (
+            "view serialize JSON (us)",
+            per_report(
+                lambda: [adapter.dump_json(adapter.validate_python(r)) for r in stored]
+            ),
+            per_report(lambda: [ingest.dump_report_json(r) for r in stored]),
+        ),
+        (
+            "view serialize MessagePack (us)",
+            per_report(
+                lambda: [
+                    codec.pack(
+                        adapter.dump_python(adapter.validate_python(r), mode="json")
+                    )
+                    for r in stored
+                ]
+            ),
+            per_report(lambda: [codec.pack(ingest.dump_report(r)) for r in stored]),
+        ),
+    ]
+
+    print(f"{n} reports, {args.gpus} GPUs and {args.procs} processes per machine")
+    print(f"{'':>32} {'before':>8} {'after':>8} {'speedup':>8}")
+    for label, before, after in rows:
+        print(f"{label:>32} {before:>8.1f} {after:>8.1f} {before / after:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Compare JSON with MessagePack for realistic GPU node reports: payload size,
+client encoding, server parsing (decode + validation) and serialization of a
+/view response.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_msgpack --reports 1000 --gpus 8
+"""
+
+import argparse
+import gzip
+import json
+import time
+from typing import Callable, List
+
+import msgpack
+
+from benchmarks.common import make_status, random_machine_id
+
+
+def timed(func: Callable[[], object], repeat: int = 3) -> float:
+    """
+    Best of `repeat` runs, in seconds
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--reports", type=int, default=1000)
+    parser.add_argument("--gpus", type=int, default=8)
+    args = parser.parse_args(argv)
+
+    from server import codec
+    from server.data_model import MachineStatus
+    from server.view_cache import ViewCache
+
+    reports = [
+        make_status(random_machine_id(), "BENCHKEY", n_gpus=args.gpus)
+        for _ in range(args.reports)
+    ]
+    n = len(reports)
+    json_bodies = [json.dumps(report).encode() for report in reports]
+    msgpack_bodies = [msgpack.packb(report) for report in reports]
+    stored = [
+        (report["machine_id"], MachineStatus.model_validate(report).model_dump())
+        for report in reports
+    ]
+
+    def build_view(fmt: str) -> Callable[[], bytes]:
+        # cold cache: every status is serialized again
+        return lambda: ViewCache().build_view_bytes("view", stored, fmt)
+
+    json_view = build_view(codec.JSON)()
+    msgpack_view = build_view(codec.MSGPACK)()
+
+    rows = [
+        (
+            "report size (B)",
+            sum(map(len, json_bodies)) / n,
+            sum(map(len, msgpack_bodies)) / n,
+        ),
+        (
+            "report gzip size (B)",
+            sum(len(gzip.compress(body)) for body in json_bodies) / n,
+            sum(len(gzip.compress(body)) for body in msgpack_bodies) / n,
+        ),
+        (
+            "client encode (us)",
+            timed(lambda: [json.dumps(r).encode() for r in reports]) / n * 1e6,
+            timed(lambda: [msgpack.packb(r) for r in reports]) / n * 1e6,
+        ),
+        (
+            "server decode (us)",
+            timed(lambda: [json.loads(b) for b in json_bodies]) / n * 1e6,
+            timed(lambda: [msgpack.unpackb(b) for b in msgpack_bodies]) / n * 1e6,
+        ),
+        (
+            "server parse (us)",
+            timed(lambda: [MachineStatus.model_validate_json(b) for b in json_bodies])
+            / n
+            * 1e6,
+            timed(
+                lambda: [
+                    MachineStatus.model_validate(msgpack.unpackb(b))
+                    for b in msgpack_bodies
+                ]
+            )
+            / n
+            * 1e6,
+        ),
+        (
+            "view size (B/machine)",
+            len(json_view) / n,
+            len(msgpack_view) / n,
+        ),
+        (
+            "view serialize (us/machine)",
+            timed(build_view(codec.JSON)) / n * 1e6,
+            timed(build_view(codec.MSGPACK)) / n * 1e6,
+        ),
+        (
+            "view decode (us/machine)",
+            timed(lambda: json.loads(json_view)) / n * 1e6,
+            timed(lambda: msgpack.unpackb(msgpack_view)) / n * 1e6,
+        ),
+    ]
+
+    print(f"{args.reports} reports, {args.gpus} GPUs per machine")
+    print(f"{'':>28} {'JSON':>10} {'MessagePack':>12} {'ratio':>6}")
+    for label, json_value, msgpack_value in rows:
+        ratio = msgpack_value / json_value
+        print(f"{label:>28} {json_value:>10.1f} {msgpack_value:>12.1f} {ratio:>6.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Memory of the latest statuses of a fleet stored as report dicts against
+compact Status records sharing interned static profiles, and the time of
+the dumps of all statuses: state snapshot (pickle) and JSON serialization.
+
+Every machine has its own mac_address, interned in its record, and the
+fleet shares a few profiles. Reports are parsed from JSON like on /report,
+so each one holds its own copy of every string.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_profiles --machines 10000
+"""
+
+import argparse
+import json
+import pickle
+import time
+import tracemalloc
+from typing import Callable, List
+
+from benchmarks.common import make_status, random_machine_id
+
+
+def traced_bytes(build: Callable[[], object]) -> int:
+    """
+    Bytes still allocated by `build` once it returned, the result kept alive
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del result
+    return allocated
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--machines", type=int, default=10000)
+    parser.add_argument(
+        "--reports", type=int, default=1, help="per machine, e.g. with history"
+    )
+    args = parser.parse_args(argv)
+
+    from server import ingest
+    from server.profiles import compact, profile_count
+    from server.view_cache import serialize_status
+
+    bodies = []
+    for i in range(args.machines):
+        status = make_status(random_machine_id(), "")
+        status["mac_address"] = ":".join(f"{b:02x}" for b in i.to_bytes(6, "big"))
+        bodies.append(json.dumps(status).encode())
+
+    def build_dicts():
+        return [
+            [ingest.parse_report_json(body) for _ in range(args.reports)]
+            for body in bodies
+        ]
+
+    def build_statuses():
+        return [
+            [compact(ingest.parse_report_json(body)) for _ in range(args.reports)]
+            for body in bodies
+        ]
+
+    dict_bytes = traced_bytes(build_dicts)
+    status_bytes = traced_bytes(build_statuses)
+    n = args.machines * args.reports
+    print(f"{args.machines} machines x {args.reports} reports")
+    print(f"{'':>20} {'MiB':>8} {'B/report':>9}")
+    print(f"{'dicts':>20} {dict_bytes / 2**20:>8.1f} {dict_bytes / n:>9.0f}")
+    print(
+        f"{'Status + profiles':>20} {status_bytes / 2**20:>8.1f} {status_bytes / n:>9.0f}"
+    )
+
+    dicts = {str(i): reports[-1] for i, reports in enumerate(build_dicts())}
+    statuses = {str(i): compact(report) for i, report in dicts.items()}
+    print(f"{profile_count()} profiles")
+    for name, state in (("dicts", dicts), ("Status", statuses)):
+        start = time.perf_counter()
+        data = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+        dumped = time.perf_counter() - start
+        start = time.perf_counter()
+        pickle.loads(data)
+        loaded = time.perf_counter() - start
+        start = time.perf_counter()
+        for report in state.values():
+            serialize_status(report)
+        serialized = time.perf_counter() - start
+        print(
+            f"{name:>8}: pickle {len(data) / 2**20:.1f} MiB, dump {dumped * 1e3:.0f} ms, "
+            f"load {loaded * 1e3:.0f} ms, JSON {serialized * 1e3:.0f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
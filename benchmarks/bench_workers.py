@@ -0,0 +1,147 @@
+"""
+Benchmark /report throughput against a local uvicorn with 1, 2, 4 and 8 workers
+sharing their state through STATE_DB_PATH. Other workers replay only the
+status of a report, scaling still needs more CPUs than workers (plus the
+clients).
+
+Usage (from the repository root):
+    python -m benchmarks.bench_workers --workers 1 2 4 8 --clients 16 --duration 10
+"""
+
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import List, Tuple
+
+from benchmarks.common import make_status, random_machine_id
+
+ROOT = Path(__file__).resolve().parent.parent
+HOST = "127.0.0.1"
+HEADERS = {"Content-type": "application/json", "Accept": "application/json"}
+
+
+def wait_for_server(port: int, timeout: float = 30.0) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection(HOST, port, timeout=1)
+            conn.request("GET", "/")
+            if conn.getresponse().status == 200:
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server on port {port} did not start in {timeout} seconds")
+
+
+def create_report_key(port: int) -> str:
+    conn = http.client.HTTPConnection(HOST, port)
+    conn.request("POST", "/create_report_key?user_id=1000")
+    response = conn.getresponse()
+    if response.status != 201:
+        raise RuntimeError(f"create_report_key failed: {response.read()}")
+    return json.loads(response.read())["report_key"]
+
+
+def run_client(args: Tuple[int, str, float, int]) -> Tuple[int, int]:
+    """
+    Post reports for `n_machines` machines in a loop until the deadline
+
+    Returns:
+        Tuple[int, int]: number of accepted and failed reports
+    """
+    port, report_key, deadline, n_machines = args
+    bodies = [
+        json.dumps(make_status(random_machine_id(), report_key)).encode()
+        for _ in range(n_machines)
+    ]
+    ok, failed = 0, 0
+    i = 0
+    while time.time() < deadline:
+        # one connection per report, like requests.post in client/main.py
+        conn = http.client.HTTPConnection(HOST, port)
+        conn.request("POST", "/report", body=bodies[i % n_machines], headers=HEADERS)
+        response = conn.getresponse()
+        response.read()
+        conn.close()
+        if response.status == 201:
+            ok += 1
+        else:
+            failed += 1
+        i += 1
+    return ok, failed
+
+
+def bench(workers: int, clients: int, duration: float, port: int) -> float:
+    state_dir = tempfile.mkdtemp(prefix="mxstatus_bench_")
+    env = dict(os.environ)
+    env["PYTHONPATH"] = str(ROOT)
+    env["STATE_DB_PATH"] = os.path.join(state_dir, "state.db")
+    # every client machine reports in a tight loop, measure throughput instead
+    env["MACHINE_REPORT_RATE"] = "0"
+    env["MAX_CONCURRENT_REPORTS"] = "0"
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "server.main:app",
+            "--host",
+            HOST,
+            "--port",
+            str(port),
+            "--workers",
+            str(workers),
+            "--log-level",
+            "warning",
+        ],
+        cwd=state_dir,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_server(port)
+        report_key = create_report_key(port)
+        deadline = time.time() + duration
+        with multiprocessing.Pool(clients) as pool:
+            results = pool.map(run_client, [(port, report_key, deadline, 50)] * clients)
+        ok = sum(r[0] for r in results)
+        failed = sum(r[1] for r in results)
+        if failed:
+            print(f"  {failed} reports failed with {workers} worker(s)")
+        return ok / duration
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--port", type=int, default=5099)
+    args = parser.parse_args(argv)
+
+    print(f"CPU count: {os.cpu_count()}, clients: {args.clients}")
+    if max(args.workers) >= (os.cpu_count() or 1):
+        # the clients run on the same machine
+        print(
+            "Fewer CPUs than workers and clients: this measures the cost of "
+            "replaying the reports of the other workers, not scaling"
+        )
+    print(f"{'workers':>8} {'req/s':>10}")
+    for workers in args.workers:
+        rps = bench(workers, args.clients, args.duration, args.port)
+        print(f"{workers:>8} {rps:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+import random
+import uuid
+from typing import Any, Dict, List
+
+###############################################################################
+### Synthetic MachineStatus payloads
+
+GPU_NAMES = ["NVIDIA A100-SXM4-80GB", "NVIDIA GeForce RTX 3090", "Tesla V100-SXM2-32GB"]
+USERS = ["alice", "bob", "carol", "dave", "erin", "frank"]
+MOUNTS = ["/", "/boot", "/home", "/data", "/scratch"]
+
+
+def random_machine_id() -> str:
+    return uuid.uuid4().hex
+
+
+def make_disk_info(n_disks: int = 5) -> List[Dict[str, Any]]:
+    disks = []
+    for i in range(n_disks):
+        size = random.choice([64.0, 512.0, 1863.0, 7452.0])
+        used = round(size * random.random(), 1)
+        usage = round(used / size, 2)
+        disks.append(
+            {
+                "filesystem": f"/dev/nvme0n1p{i + 1}",
+                "type": "ext4",
+                "size_str": f"{size}G",
+                "size": size,
+                "used_str": f"{used}G",
+                "used": used,
+                "avail_str": f"{round(size - used, 1)}G",
+                "avail": round(size - used, 1),
+                "usage_str": f"{int(usage * 100)}%",
+                "usage": usage,
+                "mounted_on": MOUNTS[i % len(MOUNTS)],
+            }
+        )
+    return disks
+
+
+def make_gpu_status(n_gpus: int = 4) -> List[Dict[str, Any]]:
+    gpu_name = random.choice(GPU_NAMES)
+    memory_total = 81920.0 if "80GB" in gpu_name else 24576.0
+    gpus = []
+    for i in range(n_gpus):
+        memory_free = round(memory_total * random.random(), 1)
+        gpus.append(
+            {
+                "index": i,
+                "gpu_name": gpu_name,
+                "gpu_usage": round(random.random(), 2),
+                "temperature": float(random.randint(30, 90)),
+                "memory_free": memory_free,
+                "memory_total": memory_total,
+                "memory_usage": round(1 - memory_free / memory_total, 2),
+            }
+        )
+    return gpus
+
+
+def make_gpu_compute_processes(
+    n_procs: int = 8, n_gpus: int = 4
+) -> List[Dict[str, Any]]:
+    procs = []
+    for i in range(n_procs):
+        user = random.choice(USERS)
+        uptime = float(random.randint(10, 500000))
+        procs.append(
+            {
+                "pid": random.randint(1000, 4000000),
+                "user": user,
+                "gpu_uuid": f"GPU-{uuid.uuid4()}",
+                "gpu_index": i % max(n_gpus, 1),
+                "gpu_mem_used": float(random.randint(500, 40000)),
+                "gpu_mem_unit": "MiB",
+                "gpu_mem_usage": round(random.random(), 2),
+                "cpu_usage": round(random.random(), 2),
+                "cpu_mem_usage": round(random.random() / 10, 3),
+                "proc_uptime": uptime,
+                "proc_uptime_unit": "seconds",
+                "proc_uptime_str": "{:02d}:{:02d}:{:02d}".format(
+                    int(uptime // 3600), int(uptime % 3600 // 60), int(uptime % 60)
+                ),
+                "command": f"/home/{user}/miniconda3/envs/torch/bin/python train.py "
+                f"--config configs/exp_{i}.yaml --batch-size 64 --lr 3e-4 "
+                f"--output-dir /data/{user}/runs/exp_{i}",
+            }
+        )
+    return procs
+
+
+def make_status(
+    machine_id: str,
+    report_key: str,
+    n_gpus: int = 4,
+    n_disks: int = 5,
+    n_procs: int = 8,
+) -> Dict[str, Any]:
+    """
+    A MachineStatus payload as sent by client/main.py on a GPU node
+    """
+    return {
+        "created_at": None,
+        "name": f"gpu-node-{machine_id[:6]}",
+        "machine_id": machine_id,
+        "report_key": report_key,
+        "hostname": f"gpu-node-{machine_id[:6]}",
+        "local_ip": f"10.0.{random.randint(0, 255)}.{random.randint(1, 254)}",
+        "public_ip": f"203.0.113.{random.randint(1, 254)}",
+        "ipv4s": [f"10.0.0.{random.randint(1, 254)}", "172.17.0.1"],
+        "ipv6s": [
+            "fe80::1c2d:3eff:fe4f:5a6b",
+            "fe80::42:acff:fe11:1",
+            "2001:db8:85a3::8a2e:370:7334",
+        ],
+        "architecture": "x86_64",
+        "mac_address": "3c:ec:ef:12:34:56",
+        "platform": "Linux",
+        "platform_release": "5.15.0-91-generic",
+        "platform_version": "#101-Ubuntu SMP Tue Nov 14 13:30:08 UTC 2023",
+        "linux_distro": "Ubuntu 22.04.3 LTS",
+        "processor": "x86_64",
+        "uptime": float(random.randint(1000, 10000000)),
+        "uptime_unit": "seconds",
+        "uptime_str": "12 days, 3:04:05",
+        "cpu_model": "AMD EPYC 7742 64-Core Processor",
+        "cpu_cores": 128,
+        "cpu_usage": round(random.random(), 2),
+        "ram_free": float(random.randint(1000, 500000)),
+        "ram_total": 515857.0,
+        "ram_unit": "MiB",
+        "ram_usage": round(random.random(), 2),
+        "disk_info": make_disk_info(n_disks),
+        "gpu_status": make_gpu_status(n_gpus) if n_gpus else None,
+        "gpu_compute_processes": (
+            make_gpu_compute_processes(n_procs, n_gpus) if n_gpus else None
+        ),
+        "users_info": {
+            "all_users": USERS,
+            "online_users": USERS[:3],
+            "offline_users": USERS[3:],
+        },
+    }
@@ -0,0 +1,280 @@
+"""
+Load test a server with a synthetic fleet: N machines posting realistic
+reports at a fixed interval while M dashboards poll /view and /view_machine.
+Report keys and view groups are created through the admin endpoints.
+
+Prints the sustained throughput, p50/p99 latency and status codes of each
+endpoint, and the RSS of the server.
+
+Usage (from the repository root):
+    # in-process, through the ASGI app (the load generator shares the process)
+    python -m benchmarks.loadtest --machines 2000 --interval 10 --dashboards 20
+    # against a local uvicorn
+    python -m benchmarks.loadtest --uvicorn --workers 1 --machines 2000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+import psutil
+
+from benchmarks.bench_workers import wait_for_server
+from benchmarks.common import make_status, random_machine_id
+
+ROOT = Path(__file__).resolve().parent.parent
+HOST = "127.0.0.1"
+HEADERS = {"Content-type": "application/json", "Accept": "application/json"}
+
+
+class Stats:
+    """
+    Latencies and status codes by endpoint
+    """
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {}
+        self.statuses: Dict[str, Counter] = {}
+
+    def record(self, endpoint: str, status: int, seconds: float) -> None:
+        self.latencies.setdefault(endpoint, []).append(seconds)
+        self.statuses.setdefault(endpoint, Counter())[status] += 1
+
+    def print(self, duration: float) -> None:
+        print(
+            f"{'endpoint':>14} {'requests':>9} {'req/s':>8} "
+            f"{'p50 ms':>8} {'p99 ms':>8}  status codes"
+        )
+        for endpoint, latencies in sorted(self.latencies.items()):
+            latencies.sort()
+            p50 = latencies[len(latencies) // 2] * 1000
+            p99 = latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)] * 1000
+            statuses = ", ".join(
+                f"{status}: {n}"
+                for status, n in sorted(self.statuses[endpoint].items())
+            )
+            print(
+                f"{endpoint:>14} {len(latencies):>9} {len(latencies) / duration:>8.1f} "
+                f"{p50:>8.2f} {p99:>8.2f}  {statuses}"
+            )
+
+
+async def timed_request(
+    client: httpx.AsyncClient, stats: Stats, endpoint: str, method: str, url: str, **kw
+) -> Optional[httpx.Response]:
+    start = time.perf_counter()
+    try:
+        response = await client.request(method, url, **kw)
+    except httpx.HTTPError:
+        stats.record(endpoint, 0, time.perf_counter() - start)
+        return None
+    stats.record(endpoint, response.status_code, time.perf_counter() - start)
+    return response
+
+
+async def setup_fleet(
+    client: httpx.AsyncClient, machines: int, views: int
+) -> Tuple[str, List[str], Dict[str, List[str]]]:
+    """
+    Create a report_key and the view groups through the admin endpoints
+
+    Returns:
+        Tuple[str, List[str], Dict[str, List[str]]]: report_key, machine_ids
+            and machine_ids by view_key
+    """
+    r = await client.post("/create_report_key", params={"user_id": "1000"})
+    r.raise_for_status()
+    report_key = r.json()["report_key"]
+    machine_ids = [random_machine_id() for _ in range(machines)]
+    view_groups = {}
+    per_view = max(machines // views, 1)
+    for i in range(views):
+        view_machines = machine_ids[i * per_view : (i + 1) * per_view]
+        r = await client.post(
+            "/create_view_group",
+            params={"user_id": "1000"},
+            json={"view_name": f"loadtest-{i}", "view_machines": view_machines},
+        )
+        r.raise_for_status()
+        view_groups[r.json()["view_key"]] = view_machines
+    return report_key, machine_ids, view_groups
+
+
+async def run_machine(
+    client: httpx.AsyncClient,
+    stats: Stats,
+    body: bytes,
+    interval: float,
+    deadline: float,
+) -> None:
+    # spread the machines over the interval, like a fleet started over time
+    await asyncio.sleep(random.uniform(0, interval))
+    while time.perf_counter() < deadline:
+        next_report = time.perf_counter() + interval
+        await timed_request(
+            client, stats, "/report", "POST", "/report", content=body, headers=HEADERS
+        )
+        await asyncio.sleep(max(min(next_report, deadline) - time.perf_counter(), 0))
+
+
+async def run_dashboard(
+    client: httpx.AsyncClient,
+    stats: Stats,
+    view_key: str,
+    view_machines: List[str],
+    interval: float,
+    deadline: float,
+) -> None:
+    await asyncio.sleep(random.uniform(0, interval))
+    while time.perf_counter() < deadline:
+        next_poll = time.perf_counter() + interval
+        await timed_request(
+            client, stats, "/view", "GET", "/view", params={"view_key": view_key}
+        )
+        await timed_request(
+            client,
+            stats,
+            "/view_machine",
+            "GET",
+            "/view_machine",
+            params={"view_key": view_key, "machine_id": random.choice(view_machines)},
+        )
+        await asyncio.sleep(max(min(next_poll, deadline) - time.perf_counter(), 0))
+
+
+def rss_mb(pid: int) -> float:
+    """
+    RSS of a process and its children (uvicorn workers), in MiB
+    """
+    process = psutil.Process(pid)
+    processes = [process, *process.children(recursive=True)]
+    return sum(p.memory_info().rss for p in processes) / 1024 / 1024
+
+
+async def load_test(client: httpx.AsyncClient, args, pid: int) -> None:
+    report_key, machine_ids, view_groups = await setup_fleet(
+        client, args.machines, args.views
+    )
+    bodies = [
+        json.dumps(
+            make_status(machine_id, report_key, n_gpus=args.gpus, n_procs=args.procs)
+        ).encode()
+        for machine_id in machine_ids
+    ]
+    views = list(view_groups.items())
+    print(
+        f"{args.machines} machines reporting every {args.interval}s "
+        f"({args.machines / args.interval:.0f} reports/s), "
+        f"{args.dashboards} dashboards polling every {args.poll_interval}s, "
+        f"{len(views)} view groups"
+    )
+    rss_before = rss_mb(pid)
+
+    stats = Stats()
+    start = time.perf_counter()
+    deadline = start + args.duration
+    tasks = [
+        run_machine(client, stats, body, args.interval, deadline) for body in bodies
+    ]
+    for i in range(args.dashboards):
+        view_key, view_machines = views[i % len(views)]
+        tasks.append(
+            run_dashboard(
+                client, stats, view_key, view_machines, args.poll_interval, deadline
+            )
+        )
+    await asyncio.gather(*tasks)
+    duration = time.perf_counter() - start
+
+    stats.print(duration)
+    print(f"RSS: {rss_before:.1f} MiB before, {rss_mb(pid):.1f} MiB after")
+
+
+async def run_in_process(args) -> None:
+    from server.main import app
+
+    await app.router.startup()
+    try:
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://loadtest", timeout=60
+        ) as client:
+            await load_test(client, args, os.getpid())
+    finally:
+        await app.router.shutdown()
+
+
+async def run_against_uvicorn(args) -> None:
+    state_dir = tempfile.mkdtemp(prefix="mxstatus_loadtest_")
+    env = dict(os.environ)
+    env["PYTHONPATH"] = str(ROOT)
+    if args.workers > 1:
+        env["STATE_DB_PATH"] = os.path.join(state_dir, "state.db")
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "server.main:app",
+            "--host",
+            HOST,
+            "--port",
+            str(args.port),
+            "--workers",
+            str(args.workers),
+            "--log-level",
+            "warning",
+        ],
+        cwd=state_dir,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_server(args.port)
+        limits = httpx.Limits(max_connections=args.connections)
+        async with httpx.AsyncClient(
+            base_url=f"http://{HOST}:{args.port}", limits=limits, timeout=60
+        ) as client:
+            await load_test(client, args, server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--machines", type=int, default=1000)
+    parser.add_argument("--interval", type=float, default=10.0, help="seconds")
+    parser.add_argument("--gpus", type=int, default=4, help="GPUs per machine")
+    parser.add_argument("--procs", type=int, default=8, help="GPU processes")
+    parser.add_argument("--views", type=int, default=10, help="view groups")
+    parser.add_argument("--dashboards", type=int, default=10)
+    parser.add_argument("--poll-interval", type=float, default=5.0, help="seconds")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds")
+    parser.add_argument("--uvicorn", action="store_true", help="run a local uvicorn")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers")
+    parser.add_argument("--port", type=int, default=5098)
+    parser.add_argument("--connections", type=int, default=100)
+    args = parser.parse_args(argv)
+
+    if args.uvicorn:
+        asyncio.run(run_against_uvicorn(args))
+    else:
+        asyncio.run(run_in_process(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import datetime
+import gzip
 import json
 import platform
 import re
@@ -43,6 +44,9 @@ SERVER = str(configs.get("server_address", ""))
 REPORT_KEY = str(configs.get("report_key", ""))
 INTERVAL = int(configs.get("report_interval", 5))
 LOGGER_LVL = str(configs.get("logger_level", "INFO")).upper()
+DELTA_REPORT = bool(configs.get("delta_report", False))
+COMPRESSION = str(configs.get("compression", "")).lower()
+REPORT_FORMAT = str(configs.get("report_format", "json")).lower()
 
 if not SERVER:
     logger.error("Server address not found in config.json")
@@ -60,12 +64,41 @@ if LOGGER_LVL == "DEBUG":
 else:
     logger.setLevel(INFO)
 
+if COMPRESSION == "zstd":
+    try:
+        import zstandard
+    except ImportError:
+        logger.warning("zstandard is not installed, using gzip compression instead")
+        COMPRESSION = "gzip"
+elif COMPRESSION not in ("", "none", "gzip"):
+    logger.warning(f"Unknown compression: {COMPRESSION}, reports are not compressed")
+    COMPRESSION = ""
+
+if REPORT_FORMAT == "msgpack":
+    try:
+        import msgpack
+    except ImportError:
+        logger.warning("msgpack is not installed, sending reports as JSON instead")
+        REPORT_FORMAT = "json"
+elif REPORT_FORMAT != "json":
+    logger.warning(f"Unknown report format: {REPORT_FORMAT}, sending reports as JSON")
+    REPORT_FORMAT = "json"
+
 ###############################################################################
 ## Constants
 
 POST_URL = SERVER + "/report"
-HEADERS = {"Content-type": "application/json", "Accept": "application/json"}
+DELTA_URL = SERVER + "/report_delta"
+HEADERS = {
+    "Content-type": (
+        "application/msgpack" if REPORT_FORMAT == "msgpack" else "application/json"
+    ),
+    "Accept": "application/json",
+}
 PUBLIC_IP: str = ""
+# last report acknowledged by the server and its version, base of delta reports
+LAST_REPORT: Dict[str, Any] = {}
+LAST_VERSION: int = 0
 MACHINE_ID = guid()
 logger.info(f"This Machine ID: {MACHINE_ID}")
 
@@ -840,15 +873,61 @@ def get_status() -> MachineStatus:
 ## Main
 
 
+def post_report(url: str, payload: Any) -> requests.Response:
+    """
+    POST a payload as JSON or MessagePack, compressed as configured in config.json
+    """
+    if REPORT_FORMAT == "msgpack":
+        data = msgpack.packb(payload)
+    else:
+        data = json.dumps(payload).encode("utf-8")
+    headers = HEADERS
+    if COMPRESSION == "gzip":
+        data = gzip.compress(data)
+        headers = {**HEADERS, "Content-Encoding": "gzip"}
+    elif COMPRESSION == "zstd":
+        data = zstandard.ZstdCompressor().compress(data)
+        headers = {**HEADERS, "Content-Encoding": "zstd"}
+    return requests.post(url, data=data, headers=headers)
+
+
 def report_to_server(status: MachineStatus) -> bool:
+    global LAST_REPORT, LAST_VERSION
     # remove machine time
     status.created_at = None
-    data: str = status.model_dump_json()
-    r = requests.post(POST_URL, data=data, headers=HEADERS)
+    report: Dict[str, Any] = status.model_dump(mode="json")
+
+    if DELTA_REPORT and LAST_REPORT:
+        # only send the fields that changed since the last acknowledged report
+        patch = {k: v for k, v in report.items() if LAST_REPORT.get(k) != v}
+        delta = dict(
+            machine_id=status.machine_id,
+            report_key=status.report_key,
+            base_version=LAST_VERSION,
+            patch=patch,
+        )
+        r = post_report(DELTA_URL, delta)
+        if r.status_code == 201:
+            LAST_REPORT = report
+            LAST_VERSION = r.json().get("version", 0)
+            return True
+        if r.status_code in (429, 503):
+            # rate limited or overloaded, a full report would be rejected too
+            logger.warning(f"Report rejected ({r.status_code}), retrying later")
+            return False
+        # 409: server asks for a full report; 404: server without delta support
+        logger.info(f"Delta report not accepted ({r.status_code}), sending full report")
+        LAST_REPORT = {}
+
+    r = post_report(POST_URL, report)
     if r.status_code != 201:
         logger.error(f"status_code: {r.status_code}")
         return False
     else:
+        version = r.json().get("version", 0)
+        if version:
+            LAST_REPORT = report
+            LAST_VERSION = version
         return True
 
 
@@ -0,0 +1,372 @@
+import asyncio
+import heapq
+import json
+import os
+from fnmatch import fnmatchcase
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+import requests
+
+###############################################################################
+### Alert Rules
+#
+# Threshold rules over the metric samples of each report (see
+# server/metric_history.py for the names, e.g. gpu.*.temperature,
+# disk./home.usage, ram_usage), plus the staleness of machines:
+#
+#   {"name": "gpu_temperature", "metric": "gpu.*.temperature",
+#    "above": 90, "clear": 85, "for": 60}
+#
+# An alert fires once the value has been beyond the threshold ("above" or
+# "below") for "for" seconds of reports, and resolves once it is back past
+# "clear" (the threshold by default), so a value hovering around the
+# threshold does not flap. Only the transitions are notified, once each.
+#
+# Rules are compiled once: the rules of a metric name are matched on its
+# first sample and cached, and only the alerts not OK are kept, so a report
+# within bounds costs one dict lookup per metric. The "staleness" metric
+# (seconds since the last report) is checked by the periodic sweep instead,
+# with a heap of deadlines like server/liveness.py.
+#
+# Notifications are queued and POSTed to ALERT_WEBHOOK_URL off the hot path,
+# by a background task of the server.
+
+# JSON file with a list of rules, the built-in DEFAULT_RULES if empty
+ALERT_RULES = os.environ.get("ALERT_RULES", "")
+# URL notifications are POSTed to, empty to disable
+ALERT_WEBHOOK_URL = os.environ.get("ALERT_WEBHOOK_URL", "")
+# notifications waiting for delivery before new ones are dropped
+ALERT_QUEUE_SIZE = int(os.environ.get("ALERT_QUEUE_SIZE", 10000))
+# max notifications per webhook request
+ALERT_BATCH_SIZE = int(os.environ.get("ALERT_BATCH_SIZE", 100))
+# seconds before a webhook request times out
+ALERT_WEBHOOK_TIMEOUT = float(os.environ.get("ALERT_WEBHOOK_TIMEOUT", 5))
+
+STALENESS = "staleness"
+
+DEFAULT_RULES = [
+    {
+        "name": "gpu_temperature",
+        "metric": "gpu.*.temperature",
+        "above": 90,
+        "clear": 85,
+        "for": 60,
+    },
+    {"name": "disk_usage", "metric": "disk.*.usage", "above": 0.95, "clear": 0.9},
+    {
+        "name": "ram_usage",
+        "metric": "ram_usage",
+        "above": 0.95,
+        "clear": 0.9,
+        "for": 60,
+    },
+    {"name": "stale", "metric": STALENESS, "above": 15 * 60},
+]
+
+
+class Rule(NamedTuple):
+    name: str
+    metric: str  # glob pattern of the metric names
+    threshold: float
+    clear: float  # threshold to resolve at
+    above: bool  # breached above the threshold, else below
+    duration: float  # seconds breached before firing
+
+    def breached(self, value: float) -> bool:
+        return value >= self.threshold if self.above else value <= self.threshold
+
+    def cleared(self, value: float) -> bool:
+        return value < self.clear if self.above else value > self.clear
+
+
+def compile_rules(specs: Iterable[dict]) -> List[Rule]:
+    """
+    Raises:
+        ValueError: malformed or duplicate rule
+    """
+    rules = []
+    for spec in specs:
+        name = spec.get("name")
+        metric = spec.get("metric")
+        if not name or not metric:
+            raise ValueError(f"Alert rule without name or metric: {spec}")
+        if ("above" in spec) == ("below" in spec):
+            raise ValueError(f"Alert rule {name} needs either above or below")
+        above = "above" in spec
+        threshold = float(spec["above" if above else "below"])
+        clear = float(spec.get("clear", threshold))
+        if (clear > threshold) if above else (clear < threshold):
+            raise ValueError(f"Alert rule {name} clears beyond its threshold")
+        duration = float(spec.get("for", 0))
+        if duration < 0:
+            raise ValueError(f"Alert rule {name} has a negative duration")
+        if metric == STALENESS and not above:
+            raise ValueError(f"Alert rule {name}: staleness is only above")
+        if any(rule.name == name for rule in rules):
+            raise ValueError(f"Duplicate alert rule {name}")
+        rules.append(Rule(name, metric, threshold, clear, above, duration))
+    return rules
+
+
+def load_rules(path: str = ALERT_RULES) -> List[Rule]:
+    """
+    Rules of the JSON file at `path`, DEFAULT_RULES if empty
+    """
+    if not path:
+        return compile_rules(DEFAULT_RULES)
+    with open(path) as f:
+        return compile_rules(json.load(f))
+
+
+class Alert:
+    """
+    Alert of one rule on one metric of a machine, pending or firing
+    """
+
+    __slots__ = ("since", "firing", "value")
+
+    def __init__(self, since: float, value: float):
+        self.since = since  # first breaching sample
+        self.firing = False
+        self.value = value  # latest value
+
+
+class AlertEngine:
+    def __init__(
+        self, rules: List[Rule], sink: Optional[Callable[[dict], None]] = None
+    ):
+        self.rules = [rule for rule in rules if rule.metric != STALENESS]
+        self.staleness_rules = [rule for rule in rules if rule.metric == STALENESS]
+        self.sink = sink  # called with each notification
+        # metric name: rules matching it, filled on first sample
+        self._compiled: Dict[str, Tuple[Rule, ...]] = {}
+        # machine_id: {(rule name, metric name): alert}, alerts not OK only
+        self._alerts: Dict[str, Dict[Tuple[str, str], Alert]] = {}
+        # (deadline, machine_id) to check the staleness rules at, one entry
+        # per machine, see Liveness
+        self._stale_heap: List[Tuple[float, str]] = []
+        self._watched: Set[str] = set()  # machine_ids in _stale_heap
+        self.notified = 0
+
+    def _match(self, metric: str) -> Tuple[Rule, ...]:
+        rules = tuple(rule for rule in self.rules if fnmatchcase(metric, rule.metric))
+        self._compiled[metric] = rules
+        return rules
+
+    def _notify(
+        self, status: str, machine_id: str, rule: Rule, metric: str, alert: Alert, ts
+    ) -> None:
+        self.notified += 1
+        if self.sink is None:
+            return
+        self.sink(
+            {
+                # same for all workers, for receivers to deduplicate
+                "id": f"{rule.name}/{machine_id}/{metric}/{int(alert.since)}",
+                "status": status,
+                "rule": rule.name,
+                "machine_id": machine_id,
+                "metric": metric,
+                "value": alert.value,
+                "threshold": rule.threshold if status == "firing" else rule.clear,
+                "since": alert.since,
+                "at": ts,
+            }
+        )
+
+    def evaluate(
+        self,
+        machine_id: str,
+        timestamp: float,
+        values: Dict[str, float],
+        notify: bool = True,
+    ) -> None:
+        """
+        Update the alerts of a machine with the samples of a report,
+        notifying the transitions unless `notify` is False
+        """
+        alerts = self._alerts.get(machine_id)
+        compiled = self._compiled
+        for metric, value in values.items():
+            rules = compiled.get(metric)
+            if rules is None:
+                rules = self._match(metric)
+            for rule in rules:
+                key = (rule.name, metric)
+                alert = alerts.get(key) if alerts else None
+                if alert is None:
+                    if not rule.breached(value):
+                        continue
+                    if alerts is None:
+                        alerts = self._alerts[machine_id] = {}
+                    alert = alerts[key] = Alert(timestamp, value)
+                else:
+                    alert.value = value
+                if alert.firing:
+                    if rule.cleared(value):
+                        del alerts[key]
+                        if notify:
+                            self._notify(
+                                "resolved", machine_id, rule, metric, alert, timestamp
+                            )
+                elif not rule.breached(value):
+                    del alerts[key]  # pending, never fired
+                elif timestamp - alert.since >= rule.duration:
+                    alert.firing = True
+                    if notify:
+                        self._notify(
+                            "firing", machine_id, rule, metric, alert, timestamp
+                        )
+        self.seen(machine_id, timestamp, notify)
+
+    ### Staleness
+
+    def seen(self, machine_id: str, timestamp: float, notify: bool = False) -> None:
+        """
+        Resolve the staleness alerts of a machine that reported at `timestamp`
+        and watch it for the next ones
+        """
+        if not self.staleness_rules:
+            return
+        alerts = self._alerts.get(machine_id)
+        if alerts:
+            for rule in self.staleness_rules:
+                alert = alerts.pop((rule.name, STALENESS), None)
+                if alert is not None and notify:
+                    alert.value = 0.0
+                    self._notify(
+                        "resolved", machine_id, rule, STALENESS, alert, timestamp
+                    )
+        if machine_id not in self._watched:
+            self._watched.add(machine_id)
+            deadline = timestamp + min(rule.threshold for rule in self.staleness_rules)
+            heapq.heappush(self._stale_heap, (deadline, machine_id))
+
+    def sweep(self, now: float, last_seen: Dict[str, float]) -> None:
+        """
+        Fire the staleness rules of the machines silent for too long
+
+        Args:
+            now (float): unix time
+            last_seen (Dict[str, float]): machine_id: time of the last report
+        """
+        heap = self._stale_heap
+        while heap and heap[0][0] <= now:
+            _, machine_id = heapq.heappop(heap)
+            seen = last_seen.get(machine_id)
+            if seen is None:
+                self._watched.discard(machine_id)  # evicted
+                continue
+            alerts = self._alerts.setdefault(machine_id, {})
+            deadline = None
+            for rule in self.staleness_rules:
+                key = (rule.name, STALENESS)
+                if key in alerts:
+                    continue
+                if now - seen < rule.threshold:
+                    due = seen + rule.threshold
+                    deadline = due if deadline is None else min(deadline, due)
+                    continue
+                alert = alerts[key] = Alert(seen + rule.threshold, now - seen)
+                alert.firing = True
+                self._notify("firing", machine_id, rule, STALENESS, alert, now)
+            if not alerts:
+                del self._alerts[machine_id]
+            if deadline is None:
+                # every staleness rule fired, watched again on the next report
+                self._watched.discard(machine_id)
+            else:
+                heapq.heappush(heap, (deadline, machine_id))
+
+    ### Reading
+
+    def forget(self, machine_id: str) -> None:
+        """
+        Drop the alerts of an evicted machine, without notifying
+        """
+        self._alerts.pop(machine_id, None)
+
+    def firing(self, machine_ids: Optional[Iterable[str]] = None) -> List[dict]:
+        """
+        Firing alerts of the given machines, all machines by default
+        """
+        if machine_ids is None:
+            machine_ids = list(self._alerts)
+        found = []
+        for machine_id in machine_ids:
+            for (rule, metric), alert in (self._alerts.get(machine_id) or {}).items():
+                if alert.firing:
+                    found.append(
+                        {
+                            "rule": rule,
+                            "machine_id": machine_id,
+                            "metric": metric,
+                            "value": alert.value,
+                            "since": alert.since,
+                        }
+                    )
+        return found
+
+
+###############################################################################
+### Webhook Sink
+
+
+class WebhookSink:
+    """
+    Queue of notifications POSTed in batches to a webhook, as
+    {"alerts": [notification, ...]}. submit() never blocks, notifications
+    beyond `queue_size` are dropped.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        queue_size: int = ALERT_QUEUE_SIZE,
+        batch_size: int = ALERT_BATCH_SIZE,
+        timeout: float = ALERT_WEBHOOK_TIMEOUT,
+    ):
+        self.url = url
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size)
+        self.session = requests.Session()
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def submit(self, notification: dict) -> None:
+        try:
+            self.queue.put_nowait(notification)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def next_batch(self) -> List[dict]:
+        """
+        Wait for a notification, then take the queued ones up to batch_size
+        """
+        batch = [await self.queue.get()]
+        while len(batch) < self.batch_size and not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        return batch
+
+    def post(self, batch: List[dict]) -> None:
+        """
+        POST a batch, blocking, run it in a thread
+
+        Raises:
+            requests.RequestException: delivery failed
+        """
+        response = self.session.post(
+            self.url, json={"alerts": batch}, timeout=self.timeout
+        )
+        response.raise_for_status()
+        self.sent += len(batch)
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queue.qsize(),
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
@@ -0,0 +1,199 @@
+import json
+import re
+import struct
+from typing import Any, Dict, Optional, Tuple, Type, TypeVar
+
+from fastapi import Request
+from fastapi.exceptions import RequestValidationError
+from pydantic import BaseModel, ValidationError
+
+from server import ingest
+from server.perf import timed
+
+try:
+    import msgpack
+except ImportError:  # msgpack is optional
+    msgpack = None
+
+###############################################################################
+### Wire Formats
+#
+# Reports can be posted and views requested as JSON (default) or MessagePack.
+# Both carry the same schema as server/data_model.py; MessagePack payloads
+# hold the JSON-compatible values (datetimes as ISO 8601 strings).
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+_MSGPACK_TYPES = (MSGPACK, "application/x-msgpack", "application/vnd.msgpack")
+
+Model = TypeVar("Model", bound=BaseModel)
+
+
+class UnsupportedMediaType(Exception):
+    pass
+
+
+def is_msgpack(media_type: str) -> bool:
+    return media_type.split(";", 1)[0].strip().lower() in _MSGPACK_TYPES
+
+
+def request_format(request: Request) -> str:
+    """
+    Format of the request body from its Content-Type
+    """
+    if is_msgpack(request.headers.get("content-type", "")):
+        if msgpack is None:
+            raise UnsupportedMediaType("MessagePack is not supported by this server")
+        return MSGPACK
+    return JSON
+
+
+def response_format(request: Request) -> str:
+    """
+    Format of the response from the Accept header, JSON unless MessagePack
+    is explicitly accepted (and available)
+    """
+    if msgpack is not None:
+        accept = request.headers.get("accept", "")
+        if any(is_msgpack(media_type) for media_type in accept.split(",")):
+            return MSGPACK
+    return JSON
+
+
+async def read_body(request: Request) -> Any:
+    """
+    Decode the request body to python objects
+    """
+    fmt = request_format(request)
+    body = await request.body()
+    try:
+        if fmt == MSGPACK:
+            return msgpack.unpackb(body)
+        return json.loads(body)
+    except ValueError as e:
+        # msgpack decoding errors are ValueError as well
+        raise RequestValidationError(
+            [
+                {
+                    "type": "value_error",
+                    "loc": ("body",),
+                    "msg": str(e) or "Invalid request body",
+                    "input": None,
+                }
+            ]
+        )
+
+
+@timed("report.parse")
+async def read_model(request: Request, model: Type[Model]) -> Model:
+    """
+    Parse and validate the request body as `model` in a single pass
+    """
+    try:
+        if request_format(request) == MSGPACK:
+            return model.model_validate(await read_body(request))
+        return model.model_validate_json(await request.body())
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+
+
+@timed("report.parse")
+async def read_report(request: Request) -> dict:
+    """
+    Parse and validate a MachineStatus request body straight into the stored
+    dict, see server/ingest.py
+    """
+    try:
+        if request_format(request) == MSGPACK:
+            return ingest.parse_report(await read_body(request))
+        return ingest.parse_report_json(await request.body())
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+
+
+# a JSON string, possibly unterminated (then up to the end of the body and
+# without its closing quote group), or a bracket; numbers, literals and
+# separators in between are skipped
+_JSON_TOKEN = re.compile(rb'"[^"\\]*(?:\\[\s\S]?[^"\\]*)*(")?|[{}\[\]]')
+_JSON_COLON = re.compile(rb"\s*:\s*")
+_PEEKED_KEYS = {b"report_key", b"machine_id"}
+# bytes of a JSON body scanned for them: clients send them first, the
+# reports peeked without them are only rejected later, by the validation
+_PEEK_MAX_BYTES = 64 * 1024
+
+
+def _peek_json(body: bytes, fields: Dict[str, Any]) -> None:
+    """
+    Fill fields with the top-level report_key and machine_id of a JSON
+    object, in one forward scan tracking the depth, up to both of them
+    """
+    depth = 0
+    for token in _JSON_TOKEN.finditer(body, 0, _PEEK_MAX_BYTES):
+        text = token.group()
+        if text == b"{" or text == b"[":
+            depth += 1
+        elif text == b"}" or text == b"]":
+            depth -= 1
+        elif token.group(1) is None:
+            return  # unterminated string, left to the validation
+        elif depth == 1 and text[1:-1] in _PEEKED_KEYS:
+            key = text[1:-1].decode()
+            colon = _JSON_COLON.match(body, token.end())
+            if key in fields or colon is None:
+                continue  # a value rather than a key
+            value = _JSON_TOKEN.match(body, colon.end(), _PEEK_MAX_BYTES)
+            if value is None or value.group(1) is None:
+                continue  # not a string, left to the validation
+            fields[key] = json.loads(value.group())
+            if len(fields) == 2:
+                return
+
+
+@timed("report.peek")
+def peek_fields(body: bytes, fmt: str) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Top-level report_key and machine_id of a report body, without decoding
+    or validating the rest of it, for rejecting reports early
+
+    Returns:
+        Tuple[Optional[str], Optional[str]]: report_key and machine_id,
+            None if not found
+    """
+    fields: Dict[str, Any] = {}
+    try:
+        if fmt == MSGPACK:
+            unpacker = msgpack.Unpacker()
+            unpacker.feed(body)
+            for _ in range(unpacker.read_map_header()):
+                key = unpacker.unpack()
+                if key in ("report_key", "machine_id"):
+                    fields[key] = unpacker.unpack()
+                    if len(fields) == 2:
+                        break
+                else:
+                    unpacker.skip()
+        else:
+            _peek_json(body, fields)
+    except Exception:
+        # left to the validation of the whole body
+        pass
+    report_key, machine_id = fields.get("report_key"), fields.get("machine_id")
+    return (
+        report_key if isinstance(report_key, str) else None,
+        machine_id if isinstance(machine_id, str) else None,
+    )
+
+
+def pack(obj: Any) -> bytes:
+    return msgpack.packb(obj)
+
+
+def msgpack_array_header(length: int) -> bytes:
+    """
+    Header of a MessagePack array, followed by the packed items
+    """
+    if length < 16:
+        return bytes([0x90 | length])
+    if length < 1 << 16:
+        return struct.pack(">BH", 0xDC, length)
+    return struct.pack(">BI", 0xDD, length)
@@ -0,0 +1,193 @@
+import json
+import os
+import zlib
+from typing import Callable, Optional
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional
+    zstandard = None
+
+###############################################################################
+### Compressed Request Bodies
+
+# max size of a decompressed request body, protects against zip bombs
+MAX_DECOMPRESSED_SIZE = int(os.environ.get("MAX_DECOMPRESSED_SIZE", 16 * 1024 * 1024))
+
+
+# a 4 bytes RLE block of zstd decodes to up to 128 KiB
+_ZSTD_MAX_RATIO = 128 * 1024 // 4
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+class InvalidCompressedBody(Exception):
+    pass
+
+
+def _check_end(decoder, data_left: bool = False) -> None:
+    """
+    Reject data after the end of the compressed stream, a single gzip member
+    or zstd frame is expected
+    """
+    if data_left or (decoder.eof and decoder.unused_data):
+        raise InvalidCompressedBody("data after the end of the compressed stream")
+
+
+class _GzipDecoder:
+    def __init__(self):
+        # 16 + MAX_WBITS: expect a gzip header
+        self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def decode(self, data: bytes, max_length: int) -> bytes:
+        out = self._decoder.decompress(data, max_length + 1)
+        if len(out) > max_length or self._decoder.unconsumed_tail:
+            raise BodyTooLarge()
+        _check_end(self._decoder)
+        return out
+
+    def flush(self) -> bytes:
+        out = self._decoder.flush()
+        if not self._decoder.eof:
+            raise InvalidCompressedBody("truncated gzip stream")
+        _check_end(self._decoder)
+        return out
+
+
+class _ZstdDecoder:
+    def __init__(self):
+        self._decoder = zstandard.ZstdDecompressor().decompressobj()
+
+    def decode(self, data: bytes, max_length: int) -> bytes:
+        # decompressobj decodes all of its input at once, it is given slices
+        # small enough that a small frame decoding to a huge body is stopped
+        # soon after passing the limit
+        step = max(64, max_length // _ZSTD_MAX_RATIO)
+        view = memoryview(data)
+        chunks = []
+        size = 0
+        for start in range(0, len(view), step):
+            if self._decoder.eof:
+                _check_end(self._decoder, data_left=True)
+            out = self._decoder.decompress(view[start : start + step])
+            size += len(out)
+            if size > max_length:
+                raise BodyTooLarge()
+            chunks.append(out)
+        _check_end(self._decoder)
+        return b"".join(chunks)
+
+    def flush(self) -> bytes:
+        if not self._decoder.eof:
+            raise InvalidCompressedBody("truncated zstd frame")
+        return b""
+
+
+def get_decoder(content_encoding: str) -> Optional[Callable[[], object]]:
+    """
+    Decoder factory of a Content-Encoding, None if not supported
+    """
+    if content_encoding in ("gzip", "x-gzip"):
+        return _GzipDecoder
+    if content_encoding == "zstd" and zstandard is not None:
+        return _ZstdDecoder
+    return None
+
+
+def supported_encodings() -> str:
+    return "gzip, zstd" if zstandard is not None else "gzip"
+
+
+class DecompressMiddleware:
+    """
+    Decode request bodies sent with Content-Encoding: gzip or zstd.
+
+    The body is decompressed chunk by chunk as it is received, so neither
+    the compressed body nor more than MAX_DECOMPRESSED_SIZE decoded bytes
+    are ever held in memory.
+    """
+
+    def __init__(self, app, max_size: int = MAX_DECOMPRESSED_SIZE):
+        self.app = app
+        self.max_size = max_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        content_encoding = ""
+        for name, value in scope["headers"]:
+            if name == b"content-encoding":
+                content_encoding = value.decode("latin-1").strip().lower()
+                break
+        if not content_encoding or content_encoding == "identity":
+            return await self.app(scope, receive, send)
+
+        decoder_factory = get_decoder(content_encoding)
+        if decoder_factory is None:
+            return await self._reject(
+                send,
+                415,
+                f"Unsupported Content-Encoding, supported: {supported_encodings()}",
+            )
+
+        decoder = decoder_factory()
+        chunks = []
+        size = 0
+        try:
+            more_body = True
+            while more_body:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    return
+                more_body = message.get("more_body", False)
+                chunk = decoder.decode(message.get("body", b""), self.max_size - size)
+                if not more_body:
+                    chunk += decoder.flush()
+                size += len(chunk)
+                if size > self.max_size:
+                    raise BodyTooLarge()
+                chunks.append(chunk)
+        except BodyTooLarge:
+            return await self._reject(send, 413, "Decompressed body too large")
+        except (InvalidCompressedBody, zlib.error, EOFError) as e:
+            return await self._reject(send, 400, f"Invalid compressed body: {e}")
+        except Exception as e:
+            if zstandard is not None and isinstance(e, zstandard.ZstdError):
+                return await self._reject(send, 400, f"Invalid compressed body: {e}")
+            raise
+
+        body = b"".join(chunks)
+        headers = [
+            (name, value)
+            for name, value in scope["headers"]
+            if name not in (b"content-encoding", b"content-length")
+        ]
+        headers.append((b"content-length", str(len(body)).encode("latin-1")))
+        scope = dict(scope, headers=headers)
+        sent = False
+
+        async def receive_decoded():
+            nonlocal sent
+            if sent:
+                return await receive()
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        await self.app(scope, receive_decoded, send)
+
+    @staticmethod
+    async def _reject(send, status_code: int, detail: str) -> None:
+        body = json.dumps({"detail": detail}).encode()
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status_code,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode("latin-1")),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
@@ -1,9 +1,9 @@
 from datetime import datetime
-from typing import Dict, List, Optional, Tuple, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 from pydantic import BaseModel, validator
 
-from .helpers import mask_sensitive_string
+from .helpers import check_timestamp, mask_sensitive_string
 
 
 class DiskInfo(BaseModel):
@@ -88,6 +88,10 @@ class MachineStatus(BaseModel):
     def default_created_at(cls, v):
         return v or datetime.now()
 
+    @validator("created_at")
+    def created_at_in_range(cls, v):
+        return check_timestamp(v)
+
     @validator("users_info", pre=True, always=True)
     def process_users_info(cls, v):
         if isinstance(v, dict):
@@ -104,6 +108,18 @@ class MachineStatus(BaseModel):
         return self.__repr__()
 
 
+class MachineStatusDelta(BaseModel):
+    """
+    Fields of MachineStatus that changed since the report the server
+    acknowledged with `base_version`
+    """
+
+    machine_id: Union[str, None] = None
+    report_key: Union[str, None] = None
+    base_version: Union[int, None] = None
+    patch: Dict[str, Any] = {}
+
+
 ##################################################################
 ### Web
 
@@ -1,9 +1,49 @@
+import asyncio
+import functools
+import gc
 import random
 import string
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Dict, List, Optional, Set, Union
-
-from server.data_model import MachineStatus, ViewGroup
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+from server import codec, export, ingest, perf
+from server.alerts import AlertEngine, load_rules
+from server.data_model import MachineStatus, MachineStatusDelta, ViewGroup
+from server.gpu_index import GPUIndex
+from server.history import HISTORY_SIZE, ReportHistory
+from server.liveness import REPORT_KEY_MAX_MACHINES, Liveness
+from server.metric_history import METRIC_HISTORY_SIZE, MetricHistory
+from server.metric_history import memory_report as _memory_report
+from server.metric_history import samples as _metric_samples
+from server.metrics import MetricsCache
+from server.profiles import compact, share_unchanged
+from server.rollup import RESOLUTIONS as ROLLUP_RESOLUTIONS
+from server.rollup import STATS as ROLLUP_STATS
+from server.rollup import Rollups
+from server.segments import SEGMENTS
+from server.ratelimit import RateLimited
+from server.shared_log import STATE_DB_PATH, SharedLog
+from server.snapshot import FrozenMap, FrozenOrderedSet, Snapshot, freeze_view_group
+from server.stream import Broadcaster
+from server.summary import Contribution, Summaries
+from server.stream import stream_view as _stream_view
+from server.view_cache import ViewCache
 
 ###############################################################################
 ### Databse Definition and Initialization
@@ -11,10 +51,53 @@ from server.data_model import MachineStatus, ViewGroup
 
 class Database:
     def __init__(self):
-        self.STATUS_DATA: Dict[str, MachineStatus] = {
-            # machine_id: MachineStatus object
-            # TODO: future work: use a FIFO fixed size queue to store the last N reports
+        # statuses and view groups, replaced as a whole on every change,
+        # read through STATUS_DATA and ALL_VIEW_KEYS
+        self.SNAPSHOT = Snapshot(
+            version=0,
+            statuses=FrozenMap(),
+            views=FrozenMap(
+                {
+                    "markhuang": freeze_view_group(
+                        {
+                            "view_key": "markhuang",
+                            "view_name": "Default",
+                            "view_desc": "Default",
+                            "view_enabled": True,
+                            "view_machines": ["f330a5467d474a4c83761c57f9663492"],
+                            "view_timer": None,
+                        }
+                    ),
+                }
+            ),
+        )
+        # machine_id to the last N reports
+        self.HISTORY: Dict[str, ReportHistory] = {
+            # machine_id: ReportHistory object
+        }
+        # machine_id to the numeric fields of the last N reports, columnar
+        self.METRIC_HISTORY: Dict[str, MetricHistory] = {
+            # machine_id: MetricHistory object
+        }
+        # machine_id to the min/max/mean/last of the numeric fields by
+        # minute, hour..., columnar
+        self.ROLLUPS: Dict[str, Rollups] = {
+            # machine_id: Rollups object
         }
+        # alerts pending or firing by machine, derived from the reports
+        self.ALERTS = AlertEngine(load_rules())
+        # serialized statuses and views, not part of the state
+        self.VIEW_CACHE = ViewCache()
+        # rendered Prometheus samples by machine, not part of the state
+        self.METRICS_CACHE = MetricsCache()
+        # last seen time and offline set, derived from STATUS_DATA
+        self.LIVENESS = Liveness()
+        # aggregates of each view, derived from STATUS_DATA and LIVENESS
+        self.SUMMARIES = Summaries()
+        # GPUs sorted by free memory, derived from STATUS_DATA
+        self.GPU_INDEX = GPUIndex()
+        # streaming subscribers by view_key, not part of the state
+        self.SUBSCRIBERS = Broadcaster()
         # user_id to user_email
         self.UID_USERS: Dict[str, str] = {
             # UID: User Email
@@ -33,27 +116,241 @@ class Database:
             # report_key: set of machine_id
             "dev@markhh.com": set(["f330a5467d474a4c83761c57f9663492"]),
         }
-        # All view_key
-        self.ALL_VIEW_KEYS: Dict[str, dict] = {
-            # view_key: view_group object
-            "markhuang": {
-                "view_key": "markhuang",
-                "view_name": "Default",
-                "view_desc": "Default",
-                "view_enabled": True,
-                "view_machines": ["f330a5467d474a4c83761c57f9663492"],
-                "view_timer": None,
-            },
-        }
         # user_id to view_key to view_group
         self.USER_VIEW_KEYS: Dict[str, Set[str]] = {
             # user_id: set of view_key
             "1000": set(["markhuang"])
         }
+        # machine_id to the view_keys containing it, derived from ALL_VIEW_KEYS
+        self.MACHINE_VIEWS: Dict[str, Set[str]] = {
+            # machine_id: set of view_key
+            "f330a5467d474a4c83761c57f9663492": set(["markhuang"])
+        }
+
+    @property
+    def STATUS_DATA(self) -> Mapping[str, Mapping]:
+        # machine_id: latest report (Status, read like a dict)
+        return self.SNAPSHOT.statuses
+
+    @property
+    def ALL_VIEW_KEYS(self) -> Mapping[str, Mapping]:
+        # view_key: read-only view_group
+        # with view_machines as a FrozenOrderedSet of machine_id (dict keys)
+        return self.SNAPSHOT.views
 
 
 DB = Database()
 
+# serializes the writers, readers take DB.SNAPSHOT and never lock
+_WRITE_LOCK = threading.RLock()
+
+
+def _writer(func: Callable) -> Callable:
+    """
+    Run a mutation of DB under _WRITE_LOCK
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with _WRITE_LOCK:
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+###############################################################################
+### Shared state between workers and durability
+
+SHARED_LOG: Optional[SharedLog] = SharedLog(STATE_DB_PATH) if STATE_DB_PATH else None
+
+
+@perf.timed("report.store.publish")
+def _publish(op: str, *args, key: str = "") -> None:
+    """
+    Record a mutation already applied to DB so other workers can replay it
+    """
+    if SHARED_LOG is not None:
+        SHARED_LOG.append(op, *args, key=key)
+
+
+@contextmanager
+def _transaction():
+    """
+    Publish the mutations made within the block in a single commit
+    """
+    if SHARED_LOG is None:
+        yield
+    else:
+        with SHARED_LOG.transaction():
+            yield
+
+
+def _replay(op: str, *args) -> None:
+    """
+    Apply a mutation recorded by another worker
+    """
+    _APPLY[op](*args)
+
+
+def sync() -> int:
+    """
+    Catch up with the mutations made by other workers.
+    This is a no-op when STATE_DB_PATH is not set (single worker).
+
+    Returns:
+        int: number of mutations replayed
+    """
+    if SHARED_LOG is None:
+        return 0
+    return SHARED_LOG.catch_up(_replay)
+
+
+def apply_mutations(rows: List[Tuple[int, str, bytes]]) -> int:
+    """
+    Replay the mutations read by SHARED_LOG.fetch, e.g. in a thread
+
+    Returns:
+        int: number of mutations replayed
+    """
+    return SHARED_LOG.apply(rows, _replay)
+
+
+def _catch_up_on_miss() -> bool:
+    """
+    Catch up with the other workers at once, when a request refers to a
+    report_key, a view_key or a report this worker does not have: it may
+    have been created by another worker since the last background sync
+
+    Returns:
+        bool: True if mutations were replayed
+    """
+    return SHARED_LOG is not None and sync() > 0
+
+
+def known_report_key(report_key: str) -> bool:
+    return report_key in DB.ALL_REPORT_KEYS or (
+        _catch_up_on_miss() and report_key in DB.ALL_REPORT_KEYS
+    )
+
+
+def _snapshot_with_view(view_key: str) -> Snapshot:
+    """
+    DB.SNAPSHOT, caught up with the other workers if view_key is missing
+    """
+    snapshot = DB.SNAPSHOT
+    if view_key not in snapshot.views and _catch_up_on_miss():
+        snapshot = DB.SNAPSHOT
+    return snapshot
+
+
+def _dump_state() -> dict:
+    """
+    Copy the containers of DB that are mutated in place, so the state can be
+    pickled in another thread while requests keep being served.
+    Statuses are replaced on every report and never mutated, they are shared.
+    """
+    snapshot = DB.SNAPSHOT
+    return {
+        "STATUS_DATA": dict(snapshot.statuses),
+        "UID_USERS": dict(DB.UID_USERS),
+        "USER_REPORT_KEYS": {k: dict(v) for k, v in DB.USER_REPORT_KEYS.items()},
+        "ALL_REPORT_KEYS": {k: set(v) for k, v in DB.ALL_REPORT_KEYS.items()},
+        "ALL_VIEW_KEYS": {
+            k: {**v, "view_machines": dict(v["view_machines"])}
+            for k, v in snapshot.views.items()
+        },
+        "USER_VIEW_KEYS": {k: set(v) for k, v in DB.USER_VIEW_KEYS.items()},
+    }
+
+
+@_writer
+def _load_state(state: dict, rebuild: bool = True) -> None:
+    """
+    Args:
+        rebuild (bool): rebuild the derived indexes, see _rebuild_derived
+    """
+    state = dict(state)
+    DB.SNAPSHOT = Snapshot(
+        version=DB.SNAPSHOT.version + 1,
+        # states saved before reports were compacted hold dicts
+        statuses=FrozenMap(
+            (machine_id, compact(report))
+            for machine_id, report in state.pop("STATUS_DATA").items()
+        ),
+        views=FrozenMap(
+            (view_key, freeze_view_group(view_group))
+            for view_key, view_group in state.pop("ALL_VIEW_KEYS").items()
+        ),
+    )
+    for name, value in state.items():
+        setattr(DB, name, value)
+    DB.MACHINE_VIEWS = {}
+    for view_key, view_group in DB.ALL_VIEW_KEYS.items():
+        for machine_id in view_group["view_machines"]:
+            DB.MACHINE_VIEWS.setdefault(machine_id, set()).add(view_key)
+    if rebuild:
+        _rebuild_derived()
+
+
+# set while restoring: replayed mutations leave the derived indexes alone,
+# they are rebuilt once from the restored statuses instead
+_RESTORING = False
+
+
+@_writer
+def _rebuild_derived() -> None:
+    """
+    Rebuild the caches and indexes derived from the statuses and views
+    """
+    DB.VIEW_CACHE.clear()
+    DB.METRICS_CACHE.clear()
+    DB.LIVENESS = Liveness()
+    statuses = DB.STATUS_DATA
+    for machine_id, report in statuses.items():
+        timestamp = report["created_at"].timestamp()
+        DB.LIVENESS.seen(machine_id, timestamp)
+        # a machine silent since before the restart still goes stale
+        DB.ALERTS.seen(machine_id, timestamp)
+    DB.GPU_INDEX.rebuild(statuses.items(), DB.MACHINE_VIEWS)
+    DB.SUMMARIES.rebuild(
+        ((machine_id, Contribution(report)) for machine_id, report in statuses.items()),
+        DB.MACHINE_VIEWS,
+    )
+
+
+def capture_state() -> Tuple[int, dict]:
+    """
+    Returns:
+        Tuple[int, dict]: position in the shared log and the state at that position
+    """
+    return SHARED_LOG.capture(_replay, _dump_state)
+
+
+def restore() -> int:
+    """
+    Load the latest snapshot and replay the tail of the shared log.
+    This is a no-op when STATE_DB_PATH is not set.
+
+    Returns:
+        int: number of mutations replayed after the snapshot
+    """
+    global _RESTORING
+    if SHARED_LOG is None:
+        return 0
+    # loading creates many small containers, the cyclic GC is not needed here
+    gc.disable()
+    _RESTORING = True
+    try:
+        state = SHARED_LOG.load_snapshot()
+        if state is not None:
+            _load_state(state, rebuild=False)
+        return SHARED_LOG.catch_up(_replay, latest_only=True)
+    finally:
+        _RESTORING = False
+        _rebuild_derived()
+        gc.enable()
+
+
 ###############################################################################
 ### User
 
@@ -87,81 +384,627 @@ def random_key_gen(length: int = 8, digits: bool = True) -> str:
 ###############################################################################
 ### report_status
 
+# fields a delta report is allowed to change
+PATCHABLE_FIELDS = set(MachineStatus.model_fields) - {
+    "created_at",
+    "machine_id",
+    "report_key",
+}
+
+
+class ResyncRequired(Exception):
+    """
+    The stored status is not the base of a delta report, a full report is required
+    """
+
+
+def report_version(report: dict) -> int:
+    """
+    Version of a stored report, acknowledged to the client as the base of its
+    next delta report. Derived from created_at (microseconds), so that every
+    worker agrees on it without extra state.
+    """
+    return int(report["created_at"].timestamp() * 1_000_000)
+
+
+def store_new_report(status: MachineStatus) -> int:
+    return store_report(status.model_dump())
+
+
+@perf.timed("report.store")
+def store_report(report: dict) -> int:
+    """
+    Store a validated report, as returned by ingest.parse_report
+
+    Returns:
+        int: version of the report
 
-def store_new_report(status: MachineStatus) -> None:
+    Raises:
+        ValueError: invalid report_key or machine_id, or a newer report of
+            the machine is stored
+    """
+    report_key, machine_id = report["report_key"], report["machine_id"]
     # check report_key is valid
     # report_key has to be pre-existing
-    if status.report_key not in DB.ALL_REPORT_KEYS:
+    if not known_report_key(report_key):
         raise ValueError("Invalid report_key")
 
     # check machine_id is not empty
-    if not status.machine_id:
+    if not machine_id:
         raise ValueError("Invalid machine_id")
 
     # check first time reporting
-    if status.machine_id not in DB.ALL_REPORT_KEYS[status.report_key]:
+    if machine_id not in DB.ALL_REPORT_KEYS[report_key]:
         # new machine_id reporting to this report_key
-        DB.ALL_REPORT_KEYS[status.report_key].add(status.machine_id)
         print(
-            f"New machine_id ({status.machine_id}) reporting using report_key ({status.report_key})"
+            f"New machine_id ({machine_id}) reporting using report_key ({report_key})"
         )
 
+    return _accept_report(report)
+
+
+def store_report_batch(
+    reports: List[Any],
+    admit: Optional[Callable[[Optional[str], Optional[str]], None]] = None,
+) -> List[dict]:
+    """
+    Validate and store many reports, one invalid report does not fail the others
+
+    Args:
+        reports (List[Any]): decoded reports
+        admit: called with the report_key and machine_id of each report before
+            it is validated, raises ValueError or RateLimited to reject it
+
+    Returns:
+        List[dict]: one result per report, in the same order, with the
+            status_code and either the version or the error detail
+    """
+    results = []
+    with _transaction():
+        for index, report in enumerate(reports):
+            try:
+                if admit is not None and isinstance(report, dict):
+                    admit(report.get("report_key"), report.get("machine_id"))
+                version = store_report(ingest.parse_report(report))
+                results.append({"index": index, "status_code": 201, "version": version})
+            except RateLimited as e:
+                results.append(
+                    {
+                        "index": index,
+                        "status_code": 429,
+                        "detail": str(e),
+                        "retry_after": e.retry_after,
+                    }
+                )
+            except ValueError as e:
+                results.append({"index": index, "status_code": 400, "detail": str(e)})
+    if perf.PERF is not None:
+        for result in results:
+            perf.count_report(result["status_code"])
+    return results
+
+
+def store_report_delta(delta: MachineStatusDelta) -> int:
+    """
+    Merge a delta report into the stored status of the machine
+
+    Returns:
+        int: version of the merged report
+
+    Raises:
+        ValueError: invalid report_key or machine_id, or a newer report of
+            the machine is stored
+        ResyncRequired: the stored status is not the base of the delta
+    """
+    if not known_report_key(delta.report_key):
+        raise ValueError("Invalid report_key")
+    if not delta.machine_id:
+        raise ValueError("Invalid machine_id")
+
+    latest = DB.STATUS_DATA.get(delta.machine_id)
+    if not _is_delta_base(latest, delta) and _catch_up_on_miss():
+        # the base may have been stored by another worker
+        latest = DB.STATUS_DATA.get(delta.machine_id)
+    if not _is_delta_base(latest, delta):
+        raise ResyncRequired("Full report required")
+
+    # only validate the fields that changed
+    fields = PATCHABLE_FIELDS.intersection(delta.patch)
+    patch = ingest.parse_report({k: delta.patch[k] for k in fields})
+    patch = {k: patch[k] for k in fields}
+
+    return _accept_report({**latest, **patch, "created_at": datetime.now()})
+
+
+def _is_delta_base(latest: Optional[Mapping], delta: MachineStatusDelta) -> bool:
+    return (
+        latest is not None
+        and latest["report_key"] == delta.report_key
+        and report_version(latest) == delta.base_version
+    )
+
+
+def _accept_report(report: dict) -> int:
+    """
+    Raises:
+        ValueError: the report was dropped, its report_key was deleted or a
+            newer report of the machine is stored
+    """
+    # stored and replayed as a compact Status sharing the static fields
+    report = compact(report)
+    values = _apply_report(report, received=True)
+    if values is None:
+        # the client must not get a version that was never stored, it would
+        # be the base of its next delta
+        if report["report_key"] not in DB.ALL_REPORT_KEYS:
+            raise ValueError("Invalid report_key")
+        raise ValueError("Report older than the stored status")
+    # only the worker that received the report writes it to disk, replays
+    # from other workers are not
+    if SEGMENTS is not None:
+        SEGMENTS.append(report["machine_id"], report["created_at"].timestamp(), values)
+    _publish("report", report, key=report["machine_id"])
+    return report_version(report)
+
+
+@perf.timed("report.store.apply")
+@_writer
+def _apply_report(report: dict, received: bool = False) -> Optional[Dict[str, float]]:
+    """
+    Args:
+        received (bool): the report was received by this worker, rather than
+            replayed from another worker: only then it is kept in the
+            histories and rollups and its alerts are evaluated and notified
+
+    Returns:
+        Optional[Dict[str, float]]: metric samples of the report, None if the
+            report was dropped or replayed
+    """
+    machine_id = report["machine_id"]
+    report_key = report["report_key"]
+    # report_key might have been deleted by another worker meanwhile
+    if report_key not in DB.ALL_REPORT_KEYS:
+        return None
+    # reports from different workers may be replayed out of order
+    latest = DB.STATUS_DATA.get(machine_id)
+    if latest is not None and latest["created_at"] > report["created_at"]:
+        return None
+    report = compact(report)
+    if _RESTORING:
+        # only the statuses are restored, the histories start over and the
+        # derived indexes are rebuilt once at the end, see restore
+        DB.ALL_REPORT_KEYS[report_key].add(machine_id)
+        DB.SNAPSHOT = DB.SNAPSHOT.set_status(machine_id, report)
+        return None
+    # the history keeps the previous reports, share what did not change
+    report = share_unchanged(report, latest)
+    timestamp = report["created_at"].timestamp()
+
+    values = None
+    if received:
+        # the worker that received the report keeps its history, rollups and
+        # alerts, see shared_log. Appended first: a report they reject is
+        # not published
+        values = _metric_samples(report)
+        metric_history = DB.METRIC_HISTORY.get(machine_id)
+        if metric_history is None:
+            metric_history = DB.METRIC_HISTORY[machine_id] = MetricHistory(
+                METRIC_HISTORY_SIZE
+            )
+        metric_history.append(timestamp, values)
+        rollups = DB.ROLLUPS.get(machine_id)
+        if rollups is None:
+            rollups = DB.ROLLUPS[machine_id] = Rollups(ROLLUP_RESOLUTIONS)
+        rollups.append(timestamp, values)
+        history = DB.HISTORY.get(machine_id)
+        if history is None:
+            history = DB.HISTORY[machine_id] = ReportHistory(HISTORY_SIZE)
+        history.append(report)
+
     # store update
-    DB.STATUS_DATA[status.machine_id] = status.model_dump()
+    DB.ALL_REPORT_KEYS[report_key].add(machine_id)
+    DB.SNAPSHOT = DB.SNAPSHOT.set_status(machine_id, report)
+    view_keys = _views_of_machine(machine_id)
+    DB.VIEW_CACHE.invalidate_machine(machine_id, view_keys)
+    DB.METRICS_CACHE.invalidate_machine(machine_id)
+    DB.LIVENESS.seen(machine_id, timestamp)
+    DB.SUMMARIES.update_machine(machine_id, Contribution(report), view_keys)
+    DB.GPU_INDEX.update_machine(machine_id, report, view_keys)
+
+    # push to streaming subscribers, serialized once for all of them
+    if DB.SUBSCRIBERS.has_subscribers(view_keys):
+        data = DB.VIEW_CACHE.status_bytes(machine_id, report)
+        DB.SUBSCRIBERS.publish(view_keys, machine_id, data)
+
+    # fire and resolve alerts, staleness only needs the last report time
+    if received:
+        DB.ALERTS.evaluate(machine_id, timestamp, values)
+    else:
+        DB.ALERTS.seen(machine_id, timestamp)
+    return values
+
+
+###############################################################################
+### Liveness and eviction
 
-    return
+
+@_writer
+def sweep(now: Optional[float] = None) -> Tuple[List[str], List[str]]:
+    """
+    Flip the machines without a recent report to offline and evict the
+    machines past the retention or beyond the budget of their report_key.
+
+    Returns:
+        Tuple[List[str], List[str]]: machine_ids that went offline and
+            machine_ids evicted
+    """
+    now = time.time() if now is None else now
+    went_offline, expired = DB.LIVENESS.sweep(now)
+    DB.ALERTS.sweep(now, DB.LIVENESS.last_seen)
+    for machine_id in went_offline:
+        view_keys = _views_of_machine(machine_id)
+        for view_key in view_keys:
+            DB.VIEW_CACHE.invalidate_view(view_key)
+        DB.SUMMARIES.update_machine(machine_id, Contribution(online=False), view_keys)
+
+    if REPORT_KEY_MAX_MACHINES:
+        expired = set(expired)
+        for machine_ids in DB.ALL_REPORT_KEYS.values():
+            excess = len(machine_ids) - REPORT_KEY_MAX_MACHINES
+            if excess > 0:
+                expired.update(
+                    DB.LIVENESS.least_recently_seen(machine_ids - expired, excess)
+                )
+
+    evicted = []
+    with _transaction():
+        for machine_id in expired:
+            report = DB.STATUS_DATA.get(machine_id)
+            created_at = report["created_at"] if report else None
+            if _apply_evict_machine(machine_id, created_at):
+                _publish("evict_machine", machine_id, created_at, key=machine_id)
+                evicted.append(machine_id)
+    return went_offline, evicted
+
+
+@_writer
+def _apply_evict_machine(machine_id: str, created_at: Optional[datetime]) -> bool:
+    """
+    Drop a machine, unless it reported after `created_at` meanwhile
+
+    Returns:
+        bool: False if the machine reported meanwhile
+    """
+    report = DB.STATUS_DATA.get(machine_id)
+    if report is not None:
+        if created_at is None or report["created_at"] > created_at:
+            return False
+        DB.SNAPSHOT = DB.SNAPSHOT.remove_status(machine_id)
+    DB.HISTORY.pop(machine_id, None)
+    DB.METRIC_HISTORY.pop(machine_id, None)
+    DB.ROLLUPS.pop(machine_id, None)
+    DB.ALERTS.forget(machine_id)
+    for machine_ids in DB.ALL_REPORT_KEYS.values():
+        machine_ids.discard(machine_id)
+    if _RESTORING:
+        return True
+    view_keys = _views_of_machine(machine_id)
+    DB.VIEW_CACHE.invalidate_machine(machine_id, view_keys)
+    DB.METRICS_CACHE.invalidate_machine(machine_id)
+    DB.SUMMARIES.remove_machine(machine_id, view_keys)
+    DB.GPU_INDEX.remove_machine(machine_id, view_keys)
+    DB.LIVENESS.forget(machine_id)
+    return True
 
 
 ###############################################################################
 ### view_status
 
 
-def get_view(view_key: str) -> Dict[str, Dict[str, MachineStatus]]:
+def _views_of_machine(machine_id: str) -> Set[str]:
+    """
+    view_keys of the view groups containing machine_id
+    """
+    return DB.MACHINE_VIEWS.get(machine_id, set())
+
+
+def _get_enabled_view_group(
+    view_key: str, snapshot: Optional[Snapshot] = None
+) -> Mapping:
+    views = (snapshot or _snapshot_with_view(view_key)).views
     # check view_key is valid
-    if view_key not in DB.ALL_VIEW_KEYS:
+    if view_key not in views:
         raise ValueError("Invalid view_key.")
     # TODO: check access permission and stuff...
     ...
     # get view_group object
-    view_group = DB.ALL_VIEW_KEYS[view_key]
+    view_group = views[view_key]
     # TODO: maybe check timer here?
     ...
     # check if view is enabled
     view_enabled = view_group.get("view_enabled", False)
     if not view_enabled:
         raise ValueError("View is unavailable.")
+    return view_group
+
+
+def get_view(view_key: str) -> Dict[str, Dict[str, MachineStatus]]:
+    snapshot = _snapshot_with_view(view_key)
+    view_group = _get_enabled_view_group(view_key, snapshot)
     # get machine_id set
-    machine_ids = view_group.get("view_machines", [])
+    machine_ids = view_group["view_machines"]
     # get status data
     status_data = []
     for machine_id in machine_ids:
-        if machine_id in DB.STATUS_DATA:
-            status_data.append(DB.STATUS_DATA[machine_id])
+        if machine_id in snapshot.statuses:
+            status_data.append(snapshot.statuses[machine_id])
     return status_data
 
 
+def get_view_bytes(
+    view_key: str, fmt: str = codec.JSON, online_only: bool = False
+) -> bytes:
+    """
+    Same as get_view, serialized to a JSON or MessagePack array and cached
+    until one of the machines of the view reports, goes offline or the
+    machines of the view change
+
+    Args:
+        online_only (bool): leave out the machines flipped to offline
+    """
+    # taken before the snapshot, a view built from a snapshot older than the
+    # latest invalidation is not cached
+    epoch = DB.VIEW_CACHE.epoch(view_key)
+    snapshot = _snapshot_with_view(view_key)
+    view_group = _get_enabled_view_group(view_key, snapshot)
+    data = DB.VIEW_CACHE.view_bytes(view_key, fmt, online_only)
+    if data is None:
+        machine_ids = view_group["view_machines"]
+        statuses = snapshot.statuses
+        offline = DB.LIVENESS.offline if online_only else ()
+        data = DB.VIEW_CACHE.build_view_bytes(
+            view_key,
+            (
+                (machine_id, statuses[machine_id])
+                for machine_id in machine_ids
+                if machine_id in statuses and machine_id not in offline
+            ),
+            fmt,
+            online_only,
+            epoch,
+        )
+    return data
+
+
+def get_view_metrics(view_key: str) -> bytes:
+    """
+    Gauges of the machines of a view in the Prometheus text format
+    """
+    snapshot = _snapshot_with_view(view_key)
+    view_group = _get_enabled_view_group(view_key, snapshot)
+    return DB.METRICS_CACHE.render(
+        (machine_id, snapshot.statuses[machine_id])
+        for machine_id in view_group["view_machines"]
+        if machine_id in snapshot.statuses
+    )
+
+
+def get_view_summary(view_key: str) -> dict:
+    """
+    Aggregates of a view, maintained on every report
+    """
+    _get_enabled_view_group(view_key)
+    return {"view_key": view_key, **DB.SUMMARIES.get(view_key).to_dict()}
+
+
+def find_available_gpus(
+    view_key: str,
+    min_free_mb: float = 0,
+    max_usage: Optional[float] = None,
+    gpu_name: str = "",
+    count: int = 1,
+) -> List[dict]:
+    """
+    GPUs of the online machines of a view, with the most free memory first
+    """
+    snapshot = _snapshot_with_view(view_key)
+    _get_enabled_view_group(view_key, snapshot)
+    statuses = snapshot.statuses
+    offline = DB.LIVENESS.offline
+    entries = DB.GPU_INDEX.query(
+        view_key,
+        min_free_mb=min_free_mb,
+        max_usage=max_usage,
+        gpu_name=gpu_name,
+        count=count,
+        machine_filter=lambda m: m in statuses and m not in offline,
+    )
+    gpus = []
+    for _, _, machine_id, position in entries:
+        report = statuses[machine_id]
+        gpu_status = report.get("gpu_status") or ()
+        if position >= len(gpu_status):
+            continue  # the index is ahead of the snapshot
+        gpu = gpu_status[position]
+        gpus.append(
+            {
+                "machine_id": machine_id,
+                "name": report.get("name"),
+                "hostname": report.get("hostname"),
+                **gpu,
+            }
+        )
+    return gpus
+
+
 def get_view_machine(view_key: str, machine_id: str) -> Union[MachineStatus, None]:
+    snapshot = _snapshot_with_view(view_key)
     # check view_key is valid
-    if view_key not in DB.ALL_VIEW_KEYS:
+    if view_key not in snapshot.views:
         return None
     # check machine_id is valid
-    if machine_id not in DB.STATUS_DATA:
+    if machine_id not in snapshot.statuses:
         return None
     # check access permission and stuff...
     ...
     # get view_group object
-    view_group = DB.ALL_VIEW_KEYS[view_key]
+    view_group = snapshot.views[view_key]
     # check if view is enabled
     view_enabled = view_group.get("view_enabled", False)
     if not view_enabled:
         return None
     # get machine_id set
-    machine_ids = view_group.get("view_machines", [])
+    machine_ids = view_group["view_machines"]
     # check if machine_id is in view
     if machine_id not in machine_ids:
         return None
     # get status data
-    return DB.STATUS_DATA[machine_id]
+    return snapshot.statuses[machine_id]
+
+
+def get_view_machine_history(
+    view_key: str,
+    machine_id: str,
+    since: Optional[datetime] = None,
+    step: int = 0,
+) -> Union[List[dict], None]:
+    # check view_key and machine_id, same rules as get_view_machine
+    if get_view_machine(view_key, machine_id) is None:
+        return None
+    history = DB.HISTORY.get(machine_id)
+    if history is None:
+        return []
+    return history.query(since=since, step=step)
+
+
+async def get_view_machine_metrics(
+    view_key: str,
+    machine_id: str,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    step: int = 0,
+    metrics: Optional[List[str]] = None,
+    stat: str = "mean",
+) -> Union[dict, None]:
+    """
+    Numeric history of a machine: the coarsest rollup satisfying `step` (see
+    Rollups.query), else the samples (see MetricHistory.query). Without
+    `since`, the samples are those in memory; the segments on disk are read
+    in a thread, only for a range starting before them.
+
+    Raises:
+        ValueError: unknown stat
+    """
+    # check view_key and machine_id, same rules as get_view_machine
+    if get_view_machine(view_key, machine_id) is None:
+        return None
+    since = since.timestamp() if since else None
+    until = until.timestamp() if until else None
+    rollups = DB.ROLLUPS.get(machine_id)
+    # the rollup is chosen by `step` only, the segments on disk are read
+    # instead only for a range starting before the rollup
+    rollup = rollups.level(step) if rollups is not None else None
+    if rollup is not None and (
+        SEGMENTS is None or since is None or since >= rollup.oldest()
+    ):
+        return rollups.query(since, until, step, metrics, stat)
+    if stat not in ROLLUP_STATS:
+        raise ValueError(f"Invalid stat, expected one of {', '.join(ROLLUP_STATS)}")
+    history = DB.METRIC_HISTORY.get(machine_id)
+    # the segments on disk go further back than the history in memory
+    if (
+        SEGMENTS is not None
+        and since is not None
+        and (history is None or since < history.oldest())
+    ):
+        result = await asyncio.to_thread(
+            SEGMENTS.query, machine_id, since, until, step, metrics
+        )
+    elif history is None:
+        result = {"timestamps": [], "metrics": {}}
+    else:
+        result = history.query(since=since, until=until, step=step, metrics=metrics)
+    # samples, not aggregated
+    result["resolution"] = 0
+    return result
+
+
+def metric_history_memory() -> dict:
+    """
+    Memory used by the columnar metric history and rollups of all machines
+    """
+    report = _memory_report(DB.METRIC_HISTORY.values())
+    report["rollup_bytes"] = sum(r.nbytes() for r in DB.ROLLUPS.values())
+    return report
+
+
+def export_view(
+    view_key: str,
+    table: str = "machine",
+    history: bool = False,
+    since: Optional[datetime] = None,
+) -> Iterator[dict]:
+    """
+    Rows of the machines of a view flattened per `table`, see server.export.
+    The view and its statuses are those of the snapshot taken on call, and
+    the history the reports retained on call, less those overwritten before
+    their rows are produced. Rows are produced lazily one machine at a time,
+    possibly in a threadpool.
+
+    Args:
+        table (str): machine, disk, gpu or process
+        history (bool): export the retained history instead of the latest
+            status, oldest report first for each machine
+        since (datetime): only reports created at or after this time
+
+    Raises:
+        ValueError: invalid view_key or table
+    """
+    if table not in export.TABLES:
+        raise ValueError(f"Invalid table, expected one of {', '.join(export.TABLES)}")
+    snapshot = _snapshot_with_view(view_key)
+    view_group = _get_enabled_view_group(view_key, snapshot)
+    machine_ids = view_group["view_machines"]
+    if history:
+        # the buffers keep moving as reports are stored, only the bounds of
+        # the reports retained now are taken here: the reports are read as
+        # the rows are produced, in another thread, and the ones overwritten
+        # meanwhile are skipped
+        ranges = [
+            (DB.HISTORY[machine_id], DB.HISTORY[machine_id].bounds(since))
+            for machine_id in machine_ids
+            if machine_id in DB.HISTORY
+        ]
+        reports = (history.iter_range(*bounds) for history, bounds in ranges)
+    else:
+        reports = _latest_reports(snapshot, machine_ids, since)
+    return _export_rows(export.TABLES[table], reports)
+
+
+def _latest_reports(
+    snapshot: Snapshot, machine_ids: Iterable[str], since: Optional[datetime]
+) -> Iterator[Tuple[dict]]:
+    for machine_id in machine_ids:
+        report = snapshot.statuses.get(machine_id)
+        if report is not None and not (since and report["created_at"] < since):
+            yield (report,)
+
+
+def _export_rows(
+    table: export.Table, reports: Iterable[Iterable[dict]]
+) -> Iterator[dict]:
+    for machine_reports in reports:
+        for report in machine_reports:
+            yield from table.rows(report)
+
+
+def stream_view(view_key: str) -> AsyncIterator[bytes]:
+    """
+    Server-Sent Events of a view, see server.stream.stream_view
+    """
+    # check view_key is valid and enabled before streaming
+    _get_enabled_view_group(view_key)
+    return _stream_view(DB.SUBSCRIBERS, view_key, lambda: get_view_bytes(view_key))
 
 
 ###############################################################################
@@ -223,10 +1066,8 @@ def create_new_report_key(
         raise ValueError(
             "Invalid report_key: report_key is already in use or does not meet requirements"
         )
-    # add report_key to DB
-    DB.ALL_REPORT_KEYS[report_key] = set()
-    # add to user report_key_desc map
-    DB.USER_REPORT_KEYS[user_id][report_key] = report_key_desc
+    _apply_create_report_key(user_id, report_key, report_key_desc)
+    _publish("create_report_key", user_id, report_key, report_key_desc)
 
     return {
         "report_key": report_key,
@@ -234,25 +1075,44 @@ def create_new_report_key(
     }
 
 
+@_writer
+def _apply_create_report_key(
+    user_id: str, report_key: str, report_key_desc: Optional[str]
+) -> None:
+    valid_user_id(user_id)
+    # add report_key to DB, replaying this twice must keep its machines
+    DB.ALL_REPORT_KEYS.setdefault(report_key, set())
+    # add to user report_key_desc map
+    DB.USER_REPORT_KEYS[user_id][report_key] = report_key_desc
+
+
 def delete_report_key(user_id: str, report_key: str) -> None:
     # check user_id is valid
     if not valid_user_id(user_id):
         raise ValueError(f"Invalid user_id: {user_id}")
     # check report_key exists
+    if report_key not in DB.USER_REPORT_KEYS[user_id]:
+        _catch_up_on_miss()
     if report_key not in DB.USER_REPORT_KEYS[user_id]:
         raise ValueError("report_key does not exist")  # TODO: maybe refine this
-    # remove from user report_key list
-    del DB.USER_REPORT_KEYS[user_id][report_key]
-    # remove from report_key list
-    if report_key in DB.ALL_REPORT_KEYS:
-        del DB.ALL_REPORT_KEYS[report_key]
-    else:
+    if report_key not in DB.ALL_REPORT_KEYS:
         print(
             "Unexpected Error: report_key exists in user list but not in all list, code logic might be wrong"
         )
+    _apply_delete_report_key(user_id, report_key)
+    _publish("delete_report_key", user_id, report_key)
     return
 
 
+@_writer
+def _apply_delete_report_key(user_id: str, report_key: str) -> None:
+    valid_user_id(user_id)
+    # remove from user report_key list
+    DB.USER_REPORT_KEYS[user_id].pop(report_key, None)
+    # remove from report_key list
+    DB.ALL_REPORT_KEYS.pop(report_key, None)
+
+
 ###############################################################################
 ### view_group related helpers
 
@@ -309,15 +1169,38 @@ def create_new_view_group(
         )
     # check view_machines is valid
     ...
+    # drop duplicate machine_id, keeping the order
+    view_group.view_machines = list(dict.fromkeys(view_group.view_machines or []))
     # check view_timer is valid
     ...
-    # add to view_key set
-    DB.ALL_VIEW_KEYS[view_group.view_key] = view_group.model_dump()
-    # add to user view_key map
-    DB.USER_VIEW_KEYS[user_id].add(view_group.view_key)
+    view_group_dict = view_group.model_dump()
+    _apply_create_view_group(user_id, view_group_dict)
+    _publish("create_view_group", user_id, view_group_dict)
     return view_group
 
 
+@_writer
+def _apply_create_view_group(user_id: str, view_group: dict) -> None:
+    valid_user_id(user_id)
+    view_key = view_group["view_key"]
+    # add to view_key set, machines are added below to maintain MACHINE_VIEWS
+    if view_key in DB.ALL_VIEW_KEYS:
+        _apply_set_view_machines(view_key, [])
+    DB.SNAPSHOT = DB.SNAPSHOT.set_view_group(
+        view_key, {**view_group, "view_machines": []}
+    )
+    _apply_update_view_machines(view_key, view_group["view_machines"] or [], [])
+    # add to user view_key map
+    DB.USER_VIEW_KEYS[user_id].add(view_key)
+
+
+def _export_view_group(view_group: dict) -> dict:
+    """
+    view_group with view_machines as a list, as expected by ViewGroup
+    """
+    return {**view_group, "view_machines": list(view_group["view_machines"])}
+
+
 def check_view_group(view_key: str) -> ViewGroup:
     """
     Return the view_group object if view_key exists
@@ -331,7 +1214,7 @@ def check_view_group(view_key: str) -> ViewGroup:
     Raises:
         KeyError: view_key does not exist
     """
-    return DB.ALL_VIEW_KEYS[view_key]
+    return _export_view_group(_snapshot_with_view(view_key).views[view_key])
 
 
 def update_machines_in_view(
@@ -346,25 +1229,18 @@ def update_machines_in_view(
     if not valid_user_id(user_id):
         raise ValueError(f"Invalid user_id: {user_id}")
     # check view_key is valid
-    if view_key not in DB.ALL_VIEW_KEYS:
+    if view_key not in _snapshot_with_view(view_key).views:
         raise ValueError("Invalid view_key")
     # check view_key belongs to user
     if view_key not in DB.USER_VIEW_KEYS[user_id]:
         raise ValueError("Invalid view_key")
     if not overwrite:
-        # add machines
-        for machine_id in add:
-            if machine_id not in DB.ALL_REPORT_KEYS:
-                # do nothing
-                # this is ok because machine_id might not be reporting yet
-                pass
-            # TODO: maybe some machine_id validation here?
-            ...
-            DB.ALL_VIEW_KEYS[view_key]["view_machines"].append(machine_id)
-        # remove machines
-        for machine_id in remove:
-            if machine_id in DB.ALL_VIEW_KEYS[view_key]["view_machines"]:
-                DB.ALL_VIEW_KEYS[view_key]["view_machines"].remove(machine_id)
+        # TODO: maybe some machine_id validation here?
+        # machine_id not reporting yet is ok, it might report later
+        ...
+        # add machines, ignoring duplicates; remove machines
+        _apply_update_view_machines(view_key, add, remove)
+        _publish("update_view_machines", view_key, add, remove)
     else:
         # TODO: maybe some machine_id validation here?
         ...
@@ -372,9 +1248,95 @@ def update_machines_in_view(
         assert isinstance(update, list), "update must be a list"
         assert all(isinstance(x, str) for x in update), "update must be a list of str"
         assert len(set(update)) == len(update), "duplicate machine_id in update"
-        DB.ALL_VIEW_KEYS[view_key]["view_machines"] = update
+        _apply_set_view_machines(view_key, update)
+        _publish("set_view_machines", view_key, update)
+
+    return _export_view_group(DB.ALL_VIEW_KEYS[view_key])
+
 
-    return DB.ALL_VIEW_KEYS[view_key]
+@_writer
+def _apply_update_view_machines(
+    view_key: str, add: List[str], remove: List[str]
+) -> None:
+    """
+    Add and remove machines, keeping MACHINE_VIEWS in sync
+    """
+    view_group = DB.ALL_VIEW_KEYS.get(view_key)
+    if view_group is None:
+        return
+    current = view_group["view_machines"]
+    # added then removed, a machine in both is not in the view
+    remove = dict.fromkeys(remove)
+    added = [m for m in dict.fromkeys(add) if m not in current and m not in remove]
+    removed = [m for m in remove if m in current]
+    _replace_view_machines(view_key, view_group, added, removed)
+
+
+@_writer
+def _apply_set_view_machines(view_key: str, view_machines: List[str]) -> None:
+    view_group = DB.ALL_VIEW_KEYS.get(view_key)
+    if view_group is None:
+        return
+    current = view_group["view_machines"]
+    new = dict.fromkeys(view_machines)
+    _replace_view_machines(
+        view_key,
+        view_group,
+        [m for m in new if m not in current],
+        [m for m in current if m not in new],
+        FrozenOrderedSet(new),
+    )
+
+
+def _replace_view_machines(
+    view_key: str,
+    view_group: Mapping,
+    added: List[str],
+    removed: List[str],
+    view_machines: Optional[FrozenOrderedSet] = None,
+) -> None:
+    """
+    Publish a copy of view_group with the machines added and removed, and
+    update the indexes of these machines only. Readers holding the previous
+    snapshot keep seeing the previous machines.
+
+    Args:
+        view_machines (FrozenOrderedSet): the new machines if already built,
+            the current machines updated by default
+    """
+    if view_machines is None:
+        if not added and not removed:
+            return
+        view_machines = view_group["view_machines"].update(added, removed)
+    DB.SNAPSHOT = DB.SNAPSHOT.set_view_group(
+        view_key, {**view_group, "view_machines": view_machines}
+    )
+    for machine_id in added:
+        DB.MACHINE_VIEWS.setdefault(machine_id, set()).add(view_key)
+        if not _RESTORING:
+            DB.SUMMARIES.add_to_view(view_key, machine_id)
+            DB.GPU_INDEX.add_to_view(view_key, machine_id)
+    for machine_id in removed:
+        view_keys = DB.MACHINE_VIEWS[machine_id]
+        view_keys.discard(view_key)
+        if not view_keys:
+            del DB.MACHINE_VIEWS[machine_id]
+        if not _RESTORING:
+            DB.SUMMARIES.remove_from_view(view_key, machine_id)
+            DB.GPU_INDEX.remove_from_view(view_key, machine_id)
+    DB.VIEW_CACHE.invalidate_view(view_key)
+
+
+# replay functions for the mutations recorded in the shared log
+_APPLY = {
+    "report": _apply_report,
+    "create_report_key": _apply_create_report_key,
+    "delete_report_key": _apply_delete_report_key,
+    "create_view_group": _apply_create_view_group,
+    "update_view_machines": _apply_update_view_machines,
+    "set_view_machines": _apply_set_view_machines,
+    "evict_machine": _apply_evict_machine,
+}
 
 
 if __name__ == "__main__":
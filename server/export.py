@@ -0,0 +1,197 @@
+import csv
+import io
+import json
+import os
+import typing
+from datetime import datetime
+from itertools import islice
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple
+
+from pydantic import BaseModel
+
+from server.data_model import DiskInfo, GPUComputeProcess, GPUStatus, MachineStatus
+
+try:
+    import pyarrow
+except ImportError:  # pyarrow is optional, Arrow IPC is unavailable without it
+    pyarrow = None
+
+###############################################################################
+### Bulk Export
+#
+# Statuses or history of a view, flattened to one row per machine, disk, GPU
+# or GPU process and encoded as NDJSON, CSV or an Arrow IPC stream. Rows are
+# produced by generators and encoded in chunks of EXPORT_CHUNK_ROWS, so the
+# memory used does not depend on the number of rows exported; a history
+# export only lists the references to the retained reports first.
+
+# rows encoded at once, one chunk of the response
+EXPORT_CHUNK_ROWS = int(os.environ.get("EXPORT_CHUNK_ROWS", 1000))
+
+NDJSON = "ndjson"
+CSV = "csv"
+ARROW = "arrow"
+MEDIA_TYPES = {
+    NDJSON: "application/x-ndjson",
+    CSV: "text/csv",
+    ARROW: "application/vnd.apache.arrow.stream",
+}
+
+
+class UnsupportedFormat(Exception):
+    pass
+
+
+# columns identifying the report of every row
+_KEY_COLUMNS = ("created_at", "machine_id", "name")
+# fields of MachineStatus left out of the machine table: nested (own tables),
+# not scalar, or secret
+_MACHINE_EXCLUDED = {
+    "report_key",
+    "ipv4s",
+    "ipv6s",
+    "disk_info",
+    "gpu_status",
+    "gpu_compute_processes",
+    "users_info",
+}
+
+
+def _scalar_type(annotation: Any) -> type:
+    """
+    str, int, float, bool or datetime of Union[X, None]
+    """
+    args = [a for a in typing.get_args(annotation) if a is not type(None)]
+    return args[0] if args else annotation
+
+
+def _columns(model: typing.Type[BaseModel], exclude=()) -> List[Tuple[str, type]]:
+    return [
+        (name, _scalar_type(field.annotation))
+        for name, field in model.model_fields.items()
+        if name not in exclude
+    ]
+
+
+class Table:
+    """
+    Flattening of reports into rows with fixed columns
+    """
+
+    def __init__(self, name: str, field: str, model: typing.Type[BaseModel]):
+        self.name = name
+        self.field = field  # list field of MachineStatus, "" for the machine
+        if field:
+            key_types = dict(_columns(MachineStatus))
+            self.columns = [(c, key_types[c]) for c in _KEY_COLUMNS]
+            self.columns += _columns(model, exclude=_KEY_COLUMNS)
+        else:
+            self.columns = _columns(model, exclude=_MACHINE_EXCLUDED)
+        self.names = [name for name, _ in self.columns]
+        # columns taken from each item of the list field
+        self.item_names = self.names[len(_KEY_COLUMNS) :] if field else []
+
+    def rows(self, report: dict) -> Iterator[dict]:
+        if not self.field:
+            yield {name: report.get(name) for name in self.names}
+            return
+        key = {name: report.get(name) for name in _KEY_COLUMNS}
+        for item in report.get(self.field) or ():
+            yield {**key, **{name: item.get(name) for name in self.item_names}}
+
+
+TABLES: Dict[str, Table] = {
+    table.name: table
+    for table in (
+        Table("machine", "", MachineStatus),
+        Table("disk", "disk_info", DiskInfo),
+        Table("gpu", "gpu_status", GPUStatus),
+        Table("process", "gpu_compute_processes", GPUComputeProcess),
+    )
+}
+
+
+def _chunks(rows: Iterable[dict]) -> Iterator[List[dict]]:
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, EXPORT_CHUNK_ROWS))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _json_default(value: Any) -> str:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _ndjson(table: Table, rows: Iterable[dict]) -> Iterator[bytes]:
+    dumps = json.JSONEncoder(default=_json_default).encode
+    for chunk in _chunks(rows):
+        yield "".join(dumps(row) + "\n" for row in chunk).encode()
+
+
+def _csv(table: Table, rows: Iterable[dict]) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, table.names, lineterminator="\n")
+    writer.writeheader()
+    for chunk in _chunks(rows):
+        writer.writerows(chunk)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def arrow_schema(table: Table) -> "pyarrow.Schema":
+    types = {
+        str: pyarrow.string(),
+        int: pyarrow.int64(),
+        float: pyarrow.float64(),
+        bool: pyarrow.bool_(),
+        datetime: pyarrow.timestamp("us"),
+    }
+    return pyarrow.schema([(name, types[kind]) for name, kind in table.columns])
+
+
+def _arrow(table: Table, rows: Iterable[dict]) -> Iterator[bytes]:
+    schema = arrow_schema(table)
+    # drained after every record batch
+    sink = io.BytesIO()
+    with pyarrow.ipc.new_stream(sink, schema) as writer:
+        for chunk in _chunks(rows):
+            writer.write_batch(pyarrow.RecordBatch.from_pylist(chunk, schema=schema))
+            yield sink.getvalue()
+            sink.seek(0)
+            sink.truncate()
+    # end-of-stream marker
+    yield sink.getvalue()
+
+
+ENCODERS: Dict[str, Callable[[Table, Iterable[dict]], Iterator[bytes]]] = {
+    NDJSON: _ndjson,
+    CSV: _csv,
+    ARROW: _arrow,
+}
+
+
+def check_format(fmt: str) -> None:
+    """
+    Raises:
+        ValueError: unknown export format
+        UnsupportedFormat: Arrow IPC requested without pyarrow
+    """
+    if fmt not in ENCODERS:
+        raise ValueError(f"Invalid format, expected one of {', '.join(ENCODERS)}")
+    if fmt == ARROW and pyarrow is None:
+        raise UnsupportedFormat("Arrow IPC is not supported by this server")
+
+
+def encode(fmt: str, table: Table, rows: Iterable[dict]) -> Iterator[bytes]:
+    """
+    Encode rows of `table` in `fmt`, one chunk of EXPORT_CHUNK_ROWS at a time
+    """
+    check_format(fmt)
+    return ENCODERS[fmt](table, rows)
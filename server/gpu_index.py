@@ -0,0 +1,177 @@
+import heapq
+from bisect import bisect_left, bisect_right, insort
+from itertools import islice
+from typing import Callable, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple
+
+###############################################################################
+### GPU Free-Capacity Index
+#
+# The GPUs of the machines of each view, sorted by free memory (largest
+# first) then by utilisation (lowest first), in one sorted list per gpu_name.
+# GPUs with at least `min_free_mb` are a prefix of each list, found by
+# bisection, and the lists of the matching names are merged lazily, so a
+# query only walks the GPUs it returns plus those filtered out by usage or
+# because their machine is offline: O(log n + k) when few are filtered out.
+#
+# A GPU is in the lists of every view of its machine, a report updates the
+# lists of each of them.
+
+# (-memory_free, gpu_usage, machine_id, position in gpu_status)
+Entry = Tuple[float, float, str, int]
+# gpu_name: entries
+Entries = Dict[str, List[Entry]]
+
+
+def _neg_free(entry: Entry) -> float:
+    return entry[0]
+
+
+def _entries(report: dict) -> Entries:
+    """
+    Index entries of the GPUs of a report by gpu_name
+    """
+    entries: Entries = {}
+    machine_id = report["machine_id"]
+    for position, gpu in enumerate(report.get("gpu_status") or ()):
+        memory_free = gpu.get("memory_free")
+        if memory_free is None:
+            continue  # cannot be ranked
+        gpu_usage = gpu.get("gpu_usage")
+        entries.setdefault(gpu.get("gpu_name") or "", []).append(
+            (
+                -memory_free,
+                float("inf") if gpu_usage is None else gpu_usage,
+                machine_id,
+                position,
+            )
+        )
+    return entries
+
+
+def _insert(by_name: Entries, entries: Entries) -> None:
+    for gpu_name, gpus in entries.items():
+        sorted_entries = by_name.setdefault(gpu_name, [])
+        for entry in gpus:
+            insort(sorted_entries, entry)
+
+
+def _delete(by_name: Entries, entries: Entries) -> None:
+    for gpu_name, gpus in entries.items():
+        sorted_entries = by_name[gpu_name]
+        for entry in gpus:
+            del sorted_entries[bisect_left(sorted_entries, entry)]
+        if not sorted_entries:
+            del by_name[gpu_name]
+
+
+class GPUIndex:
+    """
+    Sorted GPUs by view and gpu_name, derived from STATUS_DATA and the view
+    groups, not part of the state
+    """
+
+    def __init__(self):
+        self._views: Dict[str, Entries] = {}  # view_key: sorted entries
+        self._machines: Dict[str, Entries] = {}  # machine_id: its entries
+
+    def __len__(self) -> int:
+        return sum(
+            len(gpus)
+            for entries in self._machines.values()
+            for gpus in entries.values()
+        )
+
+    def clear(self) -> None:
+        self._views.clear()
+        self._machines.clear()
+
+    def rebuild(
+        self,
+        items: Iterable[Tuple[str, dict]],
+        machine_views: Mapping[str, Iterable[str]],
+    ) -> None:
+        """
+        Index the reports of all machines at once, one sort per list
+        """
+        self.clear()
+        for machine_id, report in items:
+            entries = self._machines[machine_id] = _entries(report)
+            for view_key in machine_views.get(machine_id, ()):
+                by_name = self._views.setdefault(view_key, {})
+                for gpu_name, gpus in entries.items():
+                    by_name.setdefault(gpu_name, []).extend(gpus)
+        for by_name in self._views.values():
+            for sorted_entries in by_name.values():
+                sorted_entries.sort()
+
+    def update_machine(
+        self, machine_id: str, report: dict, view_keys: Iterable[str]
+    ) -> None:
+        """
+        Replace the GPUs of a machine in the lists of its views
+        """
+        entries = _entries(report)
+        previous = self._machines.get(machine_id)
+        if previous == entries:
+            return
+        self._machines[machine_id] = entries
+        for view_key in view_keys:
+            by_name = self._views.setdefault(view_key, {})
+            if previous is not None:
+                _delete(by_name, previous)
+            _insert(by_name, entries)
+
+    def remove_machine(self, machine_id: str, view_keys: Iterable[str]) -> None:
+        previous = self._machines.pop(machine_id, None)
+        if previous is not None:
+            for view_key in view_keys:
+                _delete(self._views[view_key], previous)
+
+    def add_to_view(self, view_key: str, machine_id: str) -> None:
+        entries = self._machines.get(machine_id)
+        if entries is not None:
+            _insert(self._views.setdefault(view_key, {}), entries)
+
+    def remove_from_view(self, view_key: str, machine_id: str) -> None:
+        entries = self._machines.get(machine_id)
+        if entries is not None:
+            _delete(self._views[view_key], entries)
+
+    def query(
+        self,
+        view_key: str,
+        min_free_mb: float = 0,
+        max_usage: Optional[float] = None,
+        gpu_name: str = "",
+        count: int = 1,
+        machine_filter: Optional[Callable[[str], bool]] = None,
+    ) -> List[Entry]:
+        """
+        GPUs of the machines of a view with the most free memory first
+
+        Args:
+            view_key (str): view_key
+            min_free_mb (float): minimum free memory in MB
+            max_usage (float): maximum utilisation, range [0, 1]
+            gpu_name (str): case-insensitive substring of the GPU name
+            count (int): maximum number of GPUs returned
+            machine_filter: only GPUs of the machines it returns True for
+        """
+        needle = gpu_name.lower()
+        prefixes = [
+            # entries with memory_free >= min_free_mb
+            islice(entries, bisect_right(entries, -min_free_mb, key=_neg_free))
+            for name, entries in self._views.get(view_key, {}).items()
+            if needle in name.lower()
+        ]
+        candidates: Iterator[Entry] = heapq.merge(*prefixes)
+        found = []
+        for entry in candidates:
+            if len(found) >= count:
+                break
+            if max_usage is not None and entry[1] > max_usage:
+                continue
+            if machine_filter is not None and not machine_filter(entry[2]):
+                continue
+            found.append(entry)
+        return found
@@ -1,3 +1,6 @@
+from datetime import datetime
+
+
 def mask_sensitive_string(value: str) -> str:
     """
     Mask sensitive string
@@ -17,3 +20,21 @@ def mask_sensitive_string(value: str) -> str:
         return value[0] + "*" * (len(value) - 2) + value[-1]
     else:
         return value[0:2] + "*" * (len(value) - 3) + value[-1]
+
+
+# report times are stored as unsigned 32-bit unix times, see metric_history
+MAX_TIMESTAMP = 2**32 - 1
+
+
+def check_timestamp(value: datetime) -> datetime:
+    """
+    Raises:
+        ValueError: value before 1970 or after 2106, not storable
+    """
+    try:
+        timestamp = value.timestamp()
+    except (OverflowError, ValueError, OSError):
+        timestamp = -1.0
+    if not 0 <= timestamp <= MAX_TIMESTAMP:
+        raise ValueError("Time out of range, must be between 1970 and 2106")
+    return value
@@ -0,0 +1,123 @@
+import os
+from datetime import datetime
+from typing import Iterator, List, Optional, Tuple
+
+###############################################################################
+### Report History
+#
+# The last HISTORY_SIZE reports of every machine, as stored (compact Status
+# records, see server/profiles.py), each sharing with the previous report of
+# the machine the values that did not change. Memory is bounded by
+# machines x HISTORY_SIZE x bytes per report: ~3.3 KB per report for a node
+# with 4 GPUs, 8 GPU processes and 5 disks (benchmarks/bench_history.py,
+# 10.7 KB as dicts), i.e. ~600 MB per worker for 2k such machines at the
+# default size. Lower HISTORY_SIZE to shrink it, the columnar metric history
+# keeps the numbers for longer at ~4 bytes per value.
+
+# number of reports kept per machine (90 reports = 15 minutes at 10s interval)
+HISTORY_SIZE = int(os.environ.get("HISTORY_SIZE", 90))
+
+
+class ReportHistory:
+    """
+    Fixed size ring buffer holding the last N status reports of one machine.
+
+    Both slot lists are preallocated on creation, so memory per machine is
+    bounded by `size` regardless of how often the machine reports. Reports
+    are stored by reference (the same record kept as the latest status), no
+    copy is made on append.
+    """
+
+    __slots__ = ("size", "_times", "_reports", "_head", "_count", "_appended")
+
+    def __init__(self, size: int = HISTORY_SIZE):
+        if size <= 0:
+            raise ValueError("History size must be positive")
+        self.size = size
+        self._times: List[float] = [0.0] * size  # epoch seconds
+        self._reports: List[Optional[dict]] = [None] * size
+        self._head = 0  # physical index of the next write
+        self._count = 0
+        self._appended = 0  # sequence number of the next write
+
+    def __len__(self) -> int:
+        return self._count
+
+    def append(self, report: dict) -> None:
+        """
+        Append a report in O(1), overwriting the oldest one when full
+        """
+        created_at: datetime = report.get("created_at") or datetime.now()
+        # counted before the slot is overwritten, see iter_range
+        self._appended += 1
+        self._times[self._head] = created_at.timestamp()
+        self._reports[self._head] = report
+        self._head = (self._head + 1) % self.size
+        if self._count < self.size:
+            self._count += 1
+
+    def _slot(self, i: int) -> int:
+        """
+        Physical index of the i-th oldest report
+        """
+        return (self._head - self._count + i) % self.size
+
+    def _bisect(self, ts: float) -> int:
+        """
+        Logical index of the oldest report created at or after ts
+        """
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._times[self._slot(mid)] < ts:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def iter_reports(
+        self, since: Optional[datetime] = None, step: int = 0
+    ) -> Iterator[dict]:
+        """
+        Iterate reports from oldest to newest without copying the buffer
+
+        Args:
+            since (datetime): only reports created at or after this time
+            step (int): minimum number of seconds between two returned
+                reports, 0 returns every report
+        """
+        start = self._bisect(since.timestamp()) if since else 0
+        next_ts = None
+        for i in range(start, self._count):
+            slot = self._slot(i)
+            ts = self._times[slot]
+            if next_ts is not None and ts < next_ts:
+                continue
+            if step > 0:
+                next_ts = ts + step
+            yield self._reports[slot]
+
+    def bounds(self, since: Optional[datetime] = None) -> Tuple[int, int]:
+        """
+        Sequence numbers [start, end) of the reports retained now, created
+        at or after `since`, for iter_range
+        """
+        start = self._appended - self._count
+        if since:
+            start += self._bisect(since.timestamp())
+        return start, self._appended
+
+    def iter_range(self, start: int, end: int) -> Iterator[dict]:
+        """
+        Reports of the sequence numbers [start, end) from oldest to newest,
+        skipping the ones overwritten since: safe to call from another
+        thread while reports are appended
+        """
+        for seq in range(start, end):
+            report = self._reports[seq % self.size]
+            # read after the report, append counts before it overwrites
+            if seq >= self._appended - self.size:
+                yield report
+
+    def query(self, since: Optional[datetime] = None, step: int = 0) -> List[dict]:
+        return list(self.iter_reports(since=since, step=step))
@@ -0,0 +1,156 @@
+import typing
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from pydantic import BaseModel
+from pydantic_core import SchemaSerializer, SchemaValidator, core_schema
+
+from server.data_model import MachineStatus
+from server.helpers import check_timestamp, mask_sensitive_string
+from server.perf import timed
+
+###############################################################################
+### Lean Report Validation
+#
+# Reports are validated straight into the dict that is stored, as
+# MachineStatus(...).model_dump() would return it, by a pydantic-core schema
+# compiled from the fields of MachineStatus: no model objects are built and
+# nothing is dumped afterwards. Values must already have the right JSON type
+# (strict mode), e.g. "0.5" is not accepted for a float.
+
+_SCALARS = {
+    str: core_schema.str_schema,
+    float: core_schema.float_schema,
+    int: core_schema.int_schema,
+    bool: core_schema.bool_schema,
+    list: core_schema.list_schema,
+    dict: core_schema.dict_schema,
+}
+
+
+def _schema(annotation: Any) -> core_schema.CoreSchema:
+    """
+    Strict core schema of a field annotation of the models in data_model.py
+    """
+    origin = typing.get_origin(annotation)
+    if origin is typing.Union:
+        (inner,) = [a for a in typing.get_args(annotation) if a is not type(None)]
+        return core_schema.nullable_schema(_schema(inner))
+    if origin is list:
+        (item,) = typing.get_args(annotation)
+        return core_schema.list_schema(_schema(item), strict=True)
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        return _model_schema(annotation)
+    return _SCALARS[annotation](strict=True)
+
+
+def _model_schema(
+    model: typing.Type[BaseModel],
+    overrides: Optional[Dict[str, core_schema.CoreSchema]] = None,
+) -> core_schema.TypedDictSchema:
+    overrides = overrides or {}
+    return core_schema.typed_dict_schema(
+        {
+            name: core_schema.typed_dict_field(
+                core_schema.with_default_schema(
+                    overrides[name] if name in overrides else _schema(field.annotation),
+                    default=field.default,
+                    # overrides also apply to missing fields
+                    validate_default=name in overrides,
+                ),
+                required=False,
+            )
+            for name, field in model.model_fields.items()
+        }
+    )
+
+
+# same as the validators of MachineStatus
+
+
+@timed("report.parse.created_at")
+def _default_created_at(value: Optional[datetime]) -> datetime:
+    return check_timestamp(value) if value else datetime.now()
+
+
+def _dict_or_none(value: Any) -> Optional[dict]:
+    return value if isinstance(value, dict) else None
+
+
+@timed("report.parse.users_info")
+def _mask_users_info(value: Optional[dict]) -> dict:
+    if value is None:
+        return {}
+    return {
+        key: [mask_sensitive_string(user) for user in users]
+        for key, users in value.items()
+    }
+
+
+REPORT_SCHEMA = _model_schema(
+    MachineStatus,
+    {
+        # ISO 8601 strings are accepted in MessagePack reports too
+        "created_at": core_schema.no_info_after_validator_function(
+            _default_created_at,
+            core_schema.nullable_schema(core_schema.datetime_schema()),
+        ),
+        # anything but an object is stored as {}, users are lists of strings
+        "users_info": core_schema.no_info_after_validator_function(
+            _mask_users_info,
+            core_schema.no_info_before_validator_function(
+                _dict_or_none,
+                core_schema.nullable_schema(
+                    core_schema.dict_schema(
+                        core_schema.str_schema(strict=True),
+                        core_schema.list_schema(
+                            core_schema.nullable_schema(
+                                core_schema.str_schema(strict=True)
+                            ),
+                            strict=True,
+                        ),
+                    )
+                ),
+            ),
+        ),
+    },
+)
+# named like the model in validation errors
+_VALIDATOR = SchemaValidator(
+    REPORT_SCHEMA, core_schema.CoreConfig(title="MachineStatus")
+)
+_SERIALIZER = SchemaSerializer(REPORT_SCHEMA)
+
+
+def parse_report_json(body: bytes) -> dict:
+    """
+    Validate a JSON report into the stored dict
+
+    Raises:
+        pydantic.ValidationError
+    """
+    return _VALIDATOR.validate_json(body)
+
+
+def parse_report(obj: Any) -> dict:
+    """
+    Validate a decoded report (e.g. from MessagePack) into the stored dict
+
+    Raises:
+        pydantic.ValidationError
+    """
+    return _VALIDATOR.validate_python(obj)
+
+
+def dump_report_json(report: dict) -> bytes:
+    """
+    Serialize a stored report, same output as MachineStatus.model_dump_json
+    """
+    return _SERIALIZER.to_json(report)
+
+
+def dump_report(report: dict) -> dict:
+    """
+    Stored report with JSON-compatible values
+    """
+    return _SERIALIZER.to_python(report, mode="json")
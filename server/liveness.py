@@ -0,0 +1,148 @@
+import heapq
+import os
+from typing import Dict, List, Set, Tuple
+
+###############################################################################
+### Machine Liveness
+#
+# Deadlines of the machines are kept in two heaps, one to flip machines to
+# offline and one to evict them. A machine has at most one entry per heap,
+# tracked in a set per heap: a report only updates its last seen time, and
+# when an entry is popped before its actual deadline it is pushed back with
+# the deadline it has now. Flipping or evicting a machine is therefore
+# O(log n), and reporting is O(1) unless the machine was offline. The entries
+# of a forgotten (evicted) machine stay in the heaps until popped, and are
+# reused if the machine reports again meanwhile.
+
+# seconds without a report before a machine is considered offline
+OFFLINE_SECONDS = int(os.environ.get("OFFLINE_SECONDS", 5 * 60))
+# seconds without a report before a machine is evicted, 0 to keep forever
+RETENTION_SECONDS = int(os.environ.get("RETENTION_SECONDS", 30 * 24 * 3600))
+# max number of machines per report_key, the least recently seen machines
+# beyond it are evicted, 0 for no limit. This bounds the memory of a
+# report_key by a number of machines rather than of bytes: the cost of a
+# machine is dominated by its report history, metric history and rollups,
+# whose sizes are documented in history.py, metric_history.py and rollup.py
+REPORT_KEY_MAX_MACHINES = int(os.environ.get("REPORT_KEY_MAX_MACHINES", 0))
+# seconds between two sweeps
+SWEEP_INTERVAL = int(os.environ.get("SWEEP_INTERVAL", 5))
+
+
+class Liveness:
+    """
+    Last seen time of each machine and the set of offline machines
+    """
+
+    def __init__(
+        self,
+        offline_seconds: float = OFFLINE_SECONDS,
+        retention_seconds: float = RETENTION_SECONDS,
+    ):
+        self.offline_seconds = offline_seconds
+        self.retention_seconds = retention_seconds
+        self.last_seen: Dict[str, float] = {}  # machine_id: unix time
+        self.offline: Set[str] = set()
+        # (deadline, machine_id) of the online machines
+        self._offline_heap: List[Tuple[float, str]] = []
+        # (deadline, machine_id) of all machines
+        self._expiry_heap: List[Tuple[float, str]] = []
+        # machine_ids with an entry in each heap
+        self._offline_queued: Set[str] = set()
+        self._expiry_queued: Set[str] = set()
+
+    def __len__(self) -> int:
+        return len(self.last_seen)
+
+    def seen(self, machine_id: str, timestamp: float) -> bool:
+        """
+        Record a report of the machine
+
+        Returns:
+            bool: True if the machine was offline or unknown
+        """
+        last_seen = self.last_seen.get(machine_id)
+        if last_seen is not None and timestamp <= last_seen:
+            return False
+        self.last_seen[machine_id] = timestamp
+        if last_seen is None:
+            if self.retention_seconds:
+                self._push(
+                    self._expiry_heap,
+                    self._expiry_queued,
+                    timestamp + self.retention_seconds,
+                    machine_id,
+                )
+        elif machine_id not in self.offline:
+            return False
+        self.offline.discard(machine_id)
+        self._push(
+            self._offline_heap,
+            self._offline_queued,
+            timestamp + self.offline_seconds,
+            machine_id,
+        )
+        return True
+
+    def forget(self, machine_id: str) -> None:
+        """
+        Drop the machine, its heap entries are discarded when popped, or
+        reused if it reports again before
+        """
+        self.last_seen.pop(machine_id, None)
+        self.offline.discard(machine_id)
+
+    def is_offline(self, machine_id: str) -> bool:
+        return machine_id in self.offline
+
+    def sweep(self, now: float) -> Tuple[List[str], List[str]]:
+        """
+        Flip the machines past their offline deadline and find the machines
+        past their retention
+
+        Returns:
+            Tuple[List[str], List[str]]: machine_ids that just went offline
+                and machine_ids to evict, the latter are not forgotten yet
+        """
+        went_offline = self._pop_due(
+            self._offline_heap, self._offline_queued, self.offline_seconds, now
+        )
+        self.offline.update(went_offline)
+        expired = self._pop_due(
+            self._expiry_heap, self._expiry_queued, self.retention_seconds, now
+        )
+        return went_offline, expired
+
+    @staticmethod
+    def _push(
+        heap: List[Tuple[float, str]],
+        queued: Set[str],
+        deadline: float,
+        machine_id: str,
+    ) -> None:
+        if machine_id not in queued:
+            queued.add(machine_id)
+            heapq.heappush(heap, (deadline, machine_id))
+
+    def _pop_due(
+        self, heap: List[Tuple[float, str]], queued: Set[str], delay: float, now: float
+    ) -> List[str]:
+        due = []
+        while heap and heap[0][0] <= now:
+            _, machine_id = heapq.heappop(heap)
+            last_seen = self.last_seen.get(machine_id)
+            if last_seen is None:
+                queued.discard(machine_id)  # forgotten
+                continue
+            deadline = last_seen + delay
+            if deadline > now:
+                # reported since the entry was pushed
+                heapq.heappush(heap, (deadline, machine_id))
+            else:
+                queued.discard(machine_id)
+                due.append(machine_id)
+        return due
+
+    def least_recently_seen(self, machine_ids: Set[str], count: int) -> List[str]:
+        return heapq.nsmallest(
+            count, machine_ids, key=lambda m: self.last_seen.get(m, float("-inf"))
+        )
@@ -1,15 +1,26 @@
+import asyncio
 import os
 import sys
+import time
 from datetime import datetime
 from logging import DEBUG, INFO
-from typing import List, Union
+from typing import List, Optional, Union
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from puts import get_logger
 
 import server.database as db
-from server.data_model import MachineStatus, ViewGroup
+from server import codec, export, metrics, perf
+from server.alerts import ALERT_WEBHOOK_URL, WebhookSink
+from server.compression import DecompressMiddleware
+from server.data_model import MachineStatus, MachineStatusDelta, ViewGroup
+from server.liveness import SWEEP_INTERVAL
+from server.ratelimit import LoadShedder, RateLimited, ReportLimiter
+from server.segments import SEGMENT_SWEEP_INTERVAL, SEGMENTS
+from server.shared_log import STATE_SNAPSHOT_INTERVAL, STATE_SYNC_INTERVAL
 
 logger = get_logger()
 logger.setLevel(INFO)
@@ -17,7 +28,10 @@ logger.setLevel(INFO)
 ###############################################################################
 # Constants
 
-app = FastAPI()
+# the response class is only swapped to measure serialization
+app = FastAPI(
+    default_response_class=(perf.TimedJSONResponse if perf.PERF_STATS else JSONResponse)
+)
 origins = [
     "http://localhost",
     "http://localhost:8080",
@@ -33,6 +47,28 @@ app.add_middleware(
 )
 
 
+app.add_middleware(DecompressMiddleware)
+if perf.PERF_STATS:
+    app.add_middleware(perf.PerfMiddleware)
+# added last, so outermost: shed requests cost as little as possible
+app.add_middleware(LoadShedder)
+report_limiter = ReportLimiter()
+
+
+@app.exception_handler(codec.UnsupportedMediaType)
+async def unsupported_media_type_handler(request: Request, exc: Exception):
+    return JSONResponse(status_code=415, content={"detail": str(exc)})
+
+
+@app.exception_handler(RateLimited)
+async def rate_limited_handler(request: Request, exc: RateLimited):
+    return JSONResponse(
+        status_code=429,
+        content={"detail": str(exc)},
+        headers={"Retry-After": exc.retry_after_header},
+    )
+
+
 # print timezone and current time
 print()
 logger.info(f"Environ 'TZ'    : {os.environ.get('TZ', 'N.A.')}")
@@ -42,6 +78,120 @@ logger.info(f"Python Version  : {sys.version}")
 print()
 
 
+###############################################################################
+## Background Tasks
+
+
+async def sync_shared_log():
+    """
+    Replay the mutations of the other workers and snapshot the state
+    """
+    while True:
+        await asyncio.sleep(STATE_SYNC_INTERVAL)
+        try:
+            # SQLite is read in a thread, the mutations are applied on the
+            # loop like the requests
+            rows = await asyncio.to_thread(db.SHARED_LOG.fetch)
+            if rows:
+                db.apply_mutations(rows)
+            if db.SHARED_LOG.snapshot_age() > STATE_SNAPSHOT_INTERVAL:
+                seq, state = db.capture_state()
+                # pickling takes a while with many machines, keep it off the loop
+                await asyncio.to_thread(
+                    db.SHARED_LOG.write_snapshot, seq, state, STATE_SNAPSHOT_INTERVAL
+                )
+        except Exception as e:
+            logger.error(f"Shared log sync failed: {e}")
+
+
+async def sweep_machines():
+    """
+    Flip machines without a recent report to offline and evict stale machines
+    """
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL)
+        try:
+            went_offline, evicted = db.sweep()
+            if went_offline or evicted:
+                logger.info(
+                    f"Sweep: {len(went_offline)} machines went offline, "
+                    f"{len(evicted)} machines evicted"
+                )
+        except Exception as e:
+            logger.error(f"Sweep failed: {e}")
+
+
+async def sweep_segments():
+    """
+    Delete the metric history segments past their retention
+    """
+    while True:
+        await asyncio.sleep(SEGMENT_SWEEP_INTERVAL)
+        try:
+            deleted = await asyncio.to_thread(SEGMENTS.sweep)
+            if deleted:
+                logger.info(f"Segment sweep: {deleted} segments deleted")
+        except Exception as e:
+            logger.error(f"Segment sweep failed: {e}")
+
+
+# attempts to deliver a batch of alert notifications
+ALERT_DELIVERY_ATTEMPTS = 3
+
+
+async def deliver_alerts(sink: WebhookSink):
+    """
+    POST the alert notifications queued by the rule engine to the webhook
+    """
+    while True:
+        batch = await sink.next_batch()
+        for attempt in range(ALERT_DELIVERY_ATTEMPTS):
+            try:
+                await asyncio.to_thread(sink.post, batch)
+                break
+            except Exception as e:
+                logger.warning(f"Alert webhook failed ({attempt + 1}): {e}")
+                await asyncio.sleep(2**attempt)
+        else:
+            sink.failed += len(batch)
+            logger.error(f"{len(batch)} alert notifications dropped")
+
+
+@app.on_event("startup")
+async def start_background_tasks():
+    app.state.sweep_task = asyncio.create_task(sweep_machines())
+    if ALERT_WEBHOOK_URL:
+        app.state.alert_sink = WebhookSink(ALERT_WEBHOOK_URL)
+        db.DB.ALERTS.sink = app.state.alert_sink.submit
+        app.state.alert_task = asyncio.create_task(deliver_alerts(app.state.alert_sink))
+    if SEGMENTS is not None:
+        app.state.segment_task = asyncio.create_task(sweep_segments())
+    if db.SHARED_LOG is not None:
+        _start = time.perf_counter()
+        replayed = db.restore()
+        logger.info(
+            f"State restored from {db.SHARED_LOG.path} in "
+            f"{time.perf_counter() - _start:.3f}s ({replayed} mutations replayed)"
+        )
+        app.state.sync_task = asyncio.create_task(sync_shared_log())
+
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    app.state.sweep_task.cancel()
+    if ALERT_WEBHOOK_URL:
+        app.state.alert_task.cancel()
+        db.DB.ALERTS.sink = None
+    if SEGMENTS is not None:
+        app.state.segment_task.cancel()
+        SEGMENTS.close()
+    if db.SHARED_LOG is not None:
+        app.state.sync_task.cancel()
+        # a fresh snapshot leaves (almost) nothing to replay on the next start
+        seq, state = db.capture_state()
+        db.SHARED_LOG.write_snapshot(seq, state)
+
+
 ###############################################################################
 ## ENDPOINTS for DEBUGGING
 
@@ -57,23 +207,156 @@ async def get_status():
     return list(db.DB.STATUS_DATA.values())
 
 
+@app.get("/debug/perf")
+async def debug_perf(reset: bool = False):
+    """
+    Latency histograms per endpoint (p50/p95/p99), timers per ingest stage
+    and accepted/rejected report counters, since startup or the last reset.
+    Only collected when the server runs with PERF_STATS=1.
+    """
+    if perf.PERF is None:
+        return {"enabled": False}
+    stats = perf.PERF.to_dict()
+    if reset:
+        perf.reset()
+    return stats
+
+
+@app.get("/debug/alerts")
+async def debug_alerts():
+    """
+    Firing alerts and the delivery counters of the webhook
+    """
+    return {
+        "firing": db.DB.ALERTS.firing(),
+        "notified": db.DB.ALERTS.notified,
+        "webhook": app.state.alert_sink.stats() if ALERT_WEBHOOK_URL else None,
+    }
+
+
+@app.get("/debug/history")
+async def debug_history():
+    """
+    Memory used by the columnar metric history, in bytes per sample
+    (one report of one machine) and per value
+    """
+    return db.metric_history_memory()
+
+
 ###############################################################################
 ## ENDPOINTS
 
 
+@perf.timed("report.admit")
+def admit_report(report_key: Optional[str], machine_id: Optional[str]) -> None:
+    """
+    Reject a report before it is validated
+
+    Raises:
+        ValueError: unknown report_key
+        RateLimited: too many reports from the machine or for the report_key
+    """
+    if report_key is not None and not db.known_report_key(report_key):
+        raise ValueError("Invalid report_key")
+    report_limiter.check(report_key, machine_id)
+
+
+async def admit_report_body(request: Request) -> None:
+    """
+    admit_report with the report_key and machine_id found in the raw body
+    """
+    body = await request.body()
+    report_key, machine_id = codec.peek_fields(body, codec.request_format(request))
+    try:
+        admit_report(report_key, machine_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
 @app.post("/report", status_code=201)
-async def report_status(status: MachineStatus):
+async def report_status(request: Request):
     """
     POST Endpoint for receiving status report from client (machines under monitoring).
     Incoming status report needs to have a valid report_key.
     Invalid report_key will be rejected.
+    The returned version is the base of the next delta report.
+    The body is a MachineStatus, as JSON or as MessagePack
+    (Content-Type: application/msgpack).
+
+    Status Codes:
+        201: Created - Report stored
+        400: Bad Request - Invalid report_key or machine_id, or older than the stored report
+        429: Too Many Requests - Rate limited, retry after Retry-After seconds
+        503: Service Unavailable - Overloaded, retry after Retry-After seconds
     """
+    await admit_report_body(request)
+    report = await codec.read_report(request)
     try:
-        db.store_new_report(status)
+        version = db.store_report(report)
         logger.debug(
-            f"Received status report from: {status.name} (report_key: {status.report_key})"
+            f"Received status report from: {report['name']} (report_key: {report['report_key']})"
         )
-        return {"msg": "OK"}
+        return {"msg": "OK", "version": version}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/report_batch", status_code=200)
+async def report_status_batch(request: Request):
+    """
+    POST Endpoint for receiving many status reports at once, e.g. from a relay
+    in front of several machines.
+    Each report is validated and stored on its own, the response holds one
+    result per report in the same order:
+        {"index": 0, "status_code": 201, "version": ...}
+        {"index": 1, "status_code": 400, "detail": "Invalid report_key"}
+    The body is a JSON or MessagePack array.
+    """
+    reports = await codec.read_body(request)
+    if not isinstance(reports, list):
+        raise RequestValidationError(
+            [
+                {
+                    "type": "list_type",
+                    "loc": ("body",),
+                    "msg": "Input should be a valid list",
+                }
+            ]
+        )
+    try:
+        results = db.store_report_batch(reports, admit=admit_report)
+        logger.debug(f"Received batch of {len(reports)} status reports")
+        return {"msg": "OK", "results": results}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/report_delta", status_code=201)
+async def report_status_delta(request: Request):
+    """
+    POST Endpoint for receiving the fields of a status report that changed
+    since the report acknowledged with `base_version`.
+
+    Status Codes:
+        201: Created - Delta merged, the new version is returned
+        400: Bad Request - Invalid report_key or machine_id
+        409: Conflict - Stored status differs from base_version, send a full report to /report
+        429: Too Many Requests - Rate limited, retry after Retry-After seconds
+    """
+    await admit_report_body(request)
+    delta = await codec.read_model(request, MachineStatusDelta)
+    try:
+        version = db.store_report_delta(delta)
+        logger.debug(
+            f"Received delta report from: {delta.machine_id} (report_key: {delta.report_key})"
+        )
+        return {"msg": "OK", "version": version}
+    except db.ResyncRequired as e:
+        raise HTTPException(status_code=409, detail=str(e))
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
@@ -85,13 +368,117 @@ async def report_status(status: MachineStatus):
 
 
 @app.get("/view", status_code=200, response_model=List[MachineStatus])
-async def view_status(view_key: str):
+async def view_status(view_key: str, request: Request, online_only: bool = False):
     """
     GET Endpoint for receiving view request from web (users).
     Incoming view request needs to have a valid view_key.
+    The serialized response is cached until one of the machines reports.
+    Sent as MessagePack if requested with Accept: application/msgpack.
+
+    Args:
+        view_key (str): a valid view_key is required
+        online_only (bool): leave out the machines without a report in the
+            last OFFLINE_SECONDS (default: False)
+    """
+    try:
+        fmt = codec.response_format(request)
+        return Response(
+            content=db.get_view_bytes(view_key, fmt, online_only),
+            media_type=fmt,
+            headers={"Vary": "Accept"},
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/view_summary", status_code=200)
+async def view_summary(view_key: str):
+    """
+    GET Endpoint for the totals of a view, without downloading the whole view.
+    GPUs and disks are only counted for online machines.
+
+    Returns:
+        machines, online, offline: machines of the view that reported
+        gpus, gpu_memory_total, gpu_memory_free (MB), gpu_usage_avg ([0, 1])
+        disks_over_90: disks with usage above 90%
     """
     try:
-        return db.get_view(view_key)
+        return db.get_view_summary(view_key)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/gpus/available", status_code=200)
+async def available_gpus(
+    view_key: str,
+    min_free_mb: float = 0,
+    max_usage: Optional[float] = None,
+    gpu_name: str = "",
+    count: int = 1,
+):
+    """
+    GET Endpoint for finding GPUs with free capacity in the online machines of a view.
+
+    Args:
+        view_key (str): a valid view_key is required
+        min_free_mb (float): minimum free GPU memory in MB (default: 0)
+        max_usage (float): maximum GPU utilisation, range [0, 1] (default: any)
+        gpu_name (str): case-insensitive part of the GPU name, e.g. "A100"
+        count (int): maximum number of GPUs to return (default: 1)
+
+    Returns:
+        List[dict]: GPUStatus fields with machine_id, name and hostname,
+            the GPUs with the most free memory (then the lowest usage) first
+    """
+    try:
+        if count < 0:
+            raise ValueError("count must not be negative")
+        return db.find_available_gpus(view_key, min_free_mb, max_usage, gpu_name, count)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/metrics", status_code=200)
+async def view_metrics(view_key: str):
+    """
+    GET Endpoint exposing the CPU, RAM, disk, GPU and GPU process gauges of
+    the machines of a view in the Prometheus text format.
+    Samples are rendered once per report, a scrape only joins them.
+    """
+    try:
+        return Response(
+            content=db.get_view_metrics(view_key), media_type=metrics.CONTENT_TYPE
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/view_stream", status_code=200)
+async def view_stream(view_key: str):
+    """
+    GET Endpoint streaming the updates of a view as Server-Sent Events,
+    an alternative to polling /view.
+
+    Events:
+        view: JSON array of all statuses of the view, sent first and again
+            whenever the stream fell too far behind
+        status: JSON status of a machine of the view that just reported,
+            bursts of reports are coalesced to the latest status per machine
+    """
+    try:
+        return StreamingResponse(
+            db.stream_view(view_key),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
@@ -138,6 +525,144 @@ async def view_machine(view_key: str, machine_id: str, seconds_to_expire: int =
         if not _gpu_status:
             raise HTTPException(status_code=418, detail="GPU Not Available")
         return status_dict
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/history", status_code=200, response_model=List[MachineStatus])
+async def view_machine_history(
+    view_key: str,
+    machine_id: str,
+    since: Optional[datetime] = None,
+    step: int = 0,
+):
+    """
+    GET Endpoint for receiving the recent status reports of a specific machine.
+    Reports are returned from oldest to newest.
+
+    Args:
+        view_key (str): a valid view_key is required
+        machine_id (str): the machine_id of the machine to view, this machine_id
+            must be in the view group associated with the view_key
+        since (datetime): only return reports created at or after this time
+        step (int): downsample to at most one report every `step` seconds (default: 0, no downsampling)
+
+    Status Codes:
+        200: OK - Reports are returned
+        404: Not Found - Invalid view_key or machine_id
+    """
+    try:
+        if step < 0:
+            raise ValueError("step must not be negative")
+        reports = db.get_view_machine_history(view_key, machine_id, since, step)
+        if reports is None:
+            raise HTTPException(status_code=404, detail="Machine Not Found")
+        return reports
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/history/metrics", status_code=200)
+async def view_machine_metric_history(
+    view_key: str,
+    machine_id: str,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    step: int = 0,
+    metrics: List[str] = Query([]),
+    stat: str = "mean",
+):
+    """
+    GET Endpoint for receiving the numeric metrics of a specific machine over
+    time, e.g. for charts. Longer than /history: only numbers are kept.
+    From a `step` of a minute on, points are read from the coarsest rollup
+    (min/max/mean/last by minute, 5 minutes, hour) finer than `step`.
+
+    Args:
+        view_key (str): a valid view_key is required
+        machine_id (str): the machine_id of the machine to view, this machine_id
+            must be in the view group associated with the view_key
+        since (datetime): only samples created at or after this time
+            (default: the samples kept in memory); older samples are read
+            from HISTORY_DIR, at most SEGMENT_QUERY_MAX_POINTS of them
+        until (datetime): only samples created at or before this time
+        step (int): downsample to at most one sample every `step` seconds (default: 0, no downsampling)
+        metrics (List[str]): metric names or glob patterns, repeated, e.g.
+            cpu_usage, gpu.*.temperature, disk./home.usage (default: all)
+        stat (str): min, max, mean or last of the samples of each point read
+            from a rollup (default: mean)
+
+    Returns:
+        dict: {"timestamps": [epoch seconds], "resolution": seconds of the
+            rollup or 0 for samples, "metrics": {name: [value or null]}}
+
+    Status Codes:
+        200: OK - Samples are returned
+        404: Not Found - Invalid view_key or machine_id
+    """
+    try:
+        if step < 0:
+            raise ValueError("step must not be negative")
+        history = await db.get_view_machine_metrics(
+            view_key, machine_id, since, until, step, metrics, stat
+        )
+        if history is None:
+            raise HTTPException(status_code=404, detail="Machine Not Found")
+        return history
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/export", status_code=200)
+async def export_view(
+    view_key: str,
+    table: str = "machine",
+    fmt: str = Query(export.NDJSON, alias="format"),
+    history: bool = False,
+    since: Optional[datetime] = None,
+):
+    """
+    GET Endpoint streaming the statuses of the machines of a view, or their
+    retained history, for bulk analysis. Rows are produced and encoded in
+    chunks, memory use does not depend on the number of rows.
+
+    Args:
+        view_key (str): a valid view_key is required
+        table (str): one row per machine, disk, gpu or process
+            (GPU compute process), each with created_at, machine_id and name
+        format (str): ndjson, csv or arrow (Arrow IPC stream)
+        history (bool): export every retained report instead of the latest
+        since (datetime): only reports created at or after this time
+
+    Status Codes:
+        200: OK - Rows are streamed
+        400: Bad Request - Invalid view_key, table or format
+        406: Not Acceptable - Arrow IPC is not supported by this server
+    """
+    try:
+        export.check_format(fmt)
+        rows = db.export_view(view_key, table, history, since)
+        return StreamingResponse(
+            export.encode(fmt, export.TABLES[table], rows),
+            media_type=export.MEDIA_TYPES[fmt],
+            headers={
+                "Content-Disposition": f'attachment; filename="{view_key}-{table}.{fmt}"'
+            },
+        )
+    except export.UnsupportedFormat as e:
+        raise HTTPException(status_code=406, detail=str(e))
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
@@ -0,0 +1,278 @@
+import functools
+import math
+import os
+import sys
+from array import array
+from bisect import bisect_left
+from fnmatch import fnmatchcase
+from typing import Dict, Iterable, List, Optional, Tuple
+
+###############################################################################
+### Columnar Metric History
+#
+# The numeric fields of each report, kept per machine as one float32 array
+# per metric next to one array of epoch-second timestamps, ~4 bytes per
+# value instead of the ~1 KiB per report of a dict. All arrays of a machine
+# have one slot per report, a metric missing from a report is NaN.
+#
+# Metric names:
+#   cpu_usage, ram_free, ...                machine fields
+#   gpu.<index>.temperature, ...            GPUStatus fields by GPU index
+#   disk.<mounted_on>.usage, ...            DiskInfo fields by mount point
+
+# number of samples kept per machine (360 samples = 1 hour at 10s interval)
+METRIC_HISTORY_SIZE = int(os.environ.get("METRIC_HISTORY_SIZE", 360))
+
+MACHINE_METRICS = (
+    "uptime",
+    "cpu_cores",
+    "cpu_usage",
+    "ram_free",
+    "ram_total",
+    "ram_usage",
+)
+GPU_METRICS = (
+    "gpu_usage",
+    "temperature",
+    "memory_free",
+    "memory_total",
+    "memory_usage",
+)
+DISK_METRICS = ("size", "used", "avail", "usage")
+
+# epoch seconds, unsigned 32-bit (until 2106)
+_TIME_TYPE = "I"
+# 32-bit float
+_VALUE_TYPE = "f"
+_NAN = float("nan")
+
+
+@functools.lru_cache(maxsize=4096)
+def _metric_names(prefix: str, fields: Tuple[str, ...]) -> Tuple[Tuple[str, str], ...]:
+    """
+    (field, metric name) of the fields of a GPU or disk, built once
+    """
+    return tuple((field, f"{prefix}.{field}") for field in fields)
+
+
+def samples(report: dict) -> Dict[str, float]:
+    """
+    Numeric values of a report by metric name, None values left out
+    """
+    values = {}
+    for name in MACHINE_METRICS:
+        value = report.get(name)
+        if value is not None:
+            values[name] = value
+    for position, gpu in enumerate(report.get("gpu_status") or ()):
+        index = gpu.get("index")
+        prefix = f"gpu.{position if index is None else index}"
+        for field, name in _metric_names(prefix, GPU_METRICS):
+            value = gpu.get(field)
+            if value is not None:
+                values[name] = value
+    for position, disk in enumerate(report.get("disk_info") or ()):
+        prefix = f"disk.{disk.get('mounted_on') or position}"
+        for field, name in _metric_names(prefix, DISK_METRICS):
+            value = disk.get(field)
+            if value is not None:
+                values[name] = value
+    return values
+
+
+def _to_list(values: array) -> List[Optional[float]]:
+    """
+    JSON-compatible values, NaN as None. Values are float32 widened to
+    float, e.g. 0.14 reads back as 0.14000000059604645.
+    """
+    return [None if value != value else value for value in values.tolist()]
+
+
+class MetricHistory:
+    """
+    Metric history of one machine, at most `size` samples.
+
+    Arrays grow by appending and are compacted once they hold `size / 8`
+    samples more than `size`, by dropping the oldest ones, so appending is
+    amortized O(1) and every query is a contiguous slice.
+    """
+
+    __slots__ = ("size", "times", "series")
+
+    def __init__(self, size: int = METRIC_HISTORY_SIZE):
+        if size <= 0:
+            raise ValueError("History size must be positive")
+        self.size = size
+        self.times = array(_TIME_TYPE)
+        self.series: Dict[str, array] = {}  # metric name: values
+
+    def __len__(self) -> int:
+        return min(len(self.times), self.size)
+
+    def append(self, timestamp: float, values: Dict[str, float]) -> None:
+        n = len(self.times)
+        self.times.append(int(timestamp))
+        new = len(values)
+        for name, series in self.series.items():
+            value = values.get(name)
+            if value is None:
+                series.append(_NAN)
+            else:
+                series.append(value)
+                new -= 1
+        if new:
+            for name, value in values.items():
+                if name not in self.series:
+                    # NaN for the samples before the metric appeared
+                    series = self.series[name] = array(_VALUE_TYPE, [_NAN]) * n
+                    series.append(value)
+        if n + 1 >= self.size + max(self.size // 8, 1):
+            self._compact()
+
+    def _compact(self) -> None:
+        drop = len(self.times) - self.size
+        del self.times[:drop]
+        for name in list(self.series):
+            series = self.series[name]
+            del series[:drop]
+            # metrics gone for the whole window, e.g. an unmounted disk
+            if math.isnan(series[-1]) and all(math.isnan(v) for v in series):
+                del self.series[name]
+
+    def oldest(self) -> float:
+        """
+        Timestamp of the oldest retained sample, inf if there is none
+        """
+        if not self.times:
+            return math.inf
+        return self.times[len(self.times) - len(self)]
+
+    def _range(self, since: Optional[float], until: Optional[float]) -> Tuple[int, int]:
+        """
+        Slice of the retained samples created in [since, until]
+        """
+        times = self.times
+        start = len(times) - len(self)
+        if since is not None:
+            start = max(start, bisect_left(times, math.ceil(since)))
+        end = len(times)
+        if until is not None:
+            end = bisect_left(times, math.floor(until) + 1, lo=start)
+        return start, end
+
+    def metric_names(self, patterns: Optional[Iterable[str]] = None) -> List[str]:
+        return match_metrics(self.series, patterns)
+
+    def query(
+        self,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        step: int = 0,
+        metrics: Optional[Iterable[str]] = None,
+    ) -> dict:
+        """
+        Samples in a time range, as arrays sliced in bulk
+
+        Args:
+            since (float): epoch seconds, inclusive
+            until (float): epoch seconds, inclusive
+            step (int): at most one sample every `step` seconds, the first one
+                of each interval, 0 returns every sample
+            metrics (Iterable[str]): glob patterns of the metric names,
+                all metrics if empty
+
+        Returns:
+            dict: {"timestamps": [...], "metrics": {name: [...]}},
+                missing values are None
+        """
+        start, end = self._range(since, until)
+        names = self.metric_names(metrics)
+        return select(
+            self.times, {name: self.series[name] for name in names}, step, start, end
+        )
+
+    def nbytes(self) -> int:
+        """
+        Bytes allocated for the arrays of the machine and their index,
+        metric names are shared between machines and not counted
+        """
+        return (
+            sys.getsizeof(self.times)
+            + sys.getsizeof(self.series)
+            + sum(sys.getsizeof(series) for series in self.series.values())
+        )
+
+
+def match_metrics(
+    names: Iterable[str], patterns: Optional[Iterable[str]] = None
+) -> List[str]:
+    """
+    Metric names matching any of the glob patterns, e.g. gpu.*.temperature,
+    all of them without patterns
+    """
+    if not patterns:
+        return sorted(names)
+    patterns = list(patterns)
+    return sorted(
+        name
+        for name in names
+        if any(fnmatchcase(name, pattern) for pattern in patterns)
+    )
+
+
+def select(
+    times: array,
+    columns: Dict[str, array],
+    step: int = 0,
+    start: int = 0,
+    end: Optional[int] = None,
+) -> dict:
+    """
+    Samples [start, end) of aligned timestamp and value arrays, downsampled
+    to at most one sample every `step` seconds (the first one of each
+    interval). The downsampled indexes are found by bisection, in
+    O(points returned x log samples) rather than O(samples).
+
+    Returns:
+        dict: {"timestamps": [...], "metrics": {name: [...]}},
+            missing values are None
+    """
+    end = len(times) if end is None else end
+    if step <= 0 or start >= end:
+        return {
+            "timestamps": times[start:end].tolist(),
+            "metrics": {
+                name: _to_list(values[start:end]) for name, values in columns.items()
+            },
+        }
+    indexes = []
+    while start < end:
+        indexes.append(start)
+        start = bisect_left(times, times[start] + step, lo=start + 1, hi=end)
+    return {
+        "timestamps": [times[i] for i in indexes],
+        "metrics": {
+            name: _to_list(array(_VALUE_TYPE, map(values.__getitem__, indexes)))
+            for name, values in columns.items()
+        },
+    }
+
+
+def memory_report(histories: Iterable[MetricHistory]) -> dict:
+    """
+    Memory used by the metric histories of all machines
+    """
+    machines = samples_count = values = allocated = 0
+    for history in histories:
+        machines += 1
+        samples_count += len(history.times)
+        values += len(history.times) * len(history.series)
+        allocated += history.nbytes()
+    return {
+        "machines": machines,
+        "samples": samples_count,
+        "values": values,
+        "bytes": allocated,
+        "bytes_per_sample": round(allocated / samples_count, 1) if samples_count else 0,
+        "bytes_per_value": round(allocated / values, 2) if values else 0,
+    }
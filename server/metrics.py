@@ -0,0 +1,188 @@
+from typing import Dict, Iterable, List, Tuple
+
+###############################################################################
+### Prometheus Text Exposition
+#
+# Gauges of a view rendered in the Prometheus text format (version 0.0.4).
+# The samples of each machine are rendered once per report and cached by
+# metric family, a scrape only joins the cached fragments under the headers.
+
+# starlette appends "; charset=utf-8"
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+# field of the report: metric name, help
+MACHINE_GAUGES: Dict[str, Tuple[str, str]] = {
+    "cpu_cores": ("mxstatus_cpu_cores", "Number of CPU cores"),
+    "cpu_usage": ("mxstatus_cpu_usage_ratio", "CPU usage, range [0, 1]"),
+    "ram_total": ("mxstatus_ram_total_megabytes", "Total RAM in MB"),
+    "ram_free": ("mxstatus_ram_free_megabytes", "Free RAM in MB"),
+    "ram_usage": ("mxstatus_ram_usage_ratio", "RAM usage, range [0, 1]"),
+    "uptime": ("mxstatus_uptime_seconds", "System uptime in seconds"),
+}
+DISK_GAUGES: Dict[str, Tuple[str, str]] = {
+    "size": ("mxstatus_disk_size_gibibytes", "Disk size in GiB"),
+    "used": ("mxstatus_disk_used_gibibytes", "Used disk space in GiB"),
+    "avail": ("mxstatus_disk_avail_gibibytes", "Available disk space in GiB"),
+    "usage": ("mxstatus_disk_usage_ratio", "Disk usage, range [0, 1]"),
+}
+GPU_GAUGES: Dict[str, Tuple[str, str]] = {
+    "gpu_usage": ("mxstatus_gpu_usage_ratio", "GPU utilisation, range [0, 1]"),
+    "temperature": ("mxstatus_gpu_temperature_celsius", "GPU temperature"),
+    "memory_total": ("mxstatus_gpu_memory_total_megabytes", "GPU memory in MB"),
+    "memory_free": ("mxstatus_gpu_memory_free_megabytes", "Free GPU memory in MB"),
+    "memory_usage": ("mxstatus_gpu_memory_usage_ratio", "GPU memory usage, [0, 1]"),
+}
+PROCESS_GAUGES: Dict[str, Tuple[str, str]] = {
+    "gpu_mem_used": (
+        "mxstatus_process_gpu_memory_mebibytes",
+        "GPU memory used by a compute process in MiB",
+    ),
+    "gpu_mem_usage": (
+        "mxstatus_process_gpu_memory_usage_ratio",
+        "GPU memory usage of a compute process, range [0, 1]",
+    ),
+    "cpu_usage": (
+        "mxstatus_process_cpu_usage_ratio",
+        "CPU usage of a GPU compute process, range [0, 1]",
+    ),
+    "cpu_mem_usage": (
+        "mxstatus_process_memory_usage_ratio",
+        "RAM usage of a GPU compute process, range [0, 1]",
+    ),
+    "proc_uptime": (
+        "mxstatus_process_uptime_seconds",
+        "Uptime of a GPU compute process in seconds",
+    ),
+}
+REPORT_TIMESTAMP = (
+    "mxstatus_report_timestamp_seconds",
+    "Unix time the latest report was received",
+)
+
+# metric families in exposition order
+FAMILIES: List[Tuple[str, str]] = [
+    REPORT_TIMESTAMP,
+    *MACHINE_GAUGES.values(),
+    *DISK_GAUGES.values(),
+    *GPU_GAUGES.values(),
+    *PROCESS_GAUGES.values(),
+]
+_HEADERS: Dict[str, bytes] = {
+    name: f"# HELP {name} {help}\n# TYPE {name} gauge\n".encode()
+    for name, help in FAMILIES
+}
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels: Dict[str, object]) -> str:
+    return ",".join(
+        f'{key}="{escape_label(value)}"'
+        for key, value in labels.items()
+        if value is not None
+    )
+
+
+def _number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _add_samples(
+    samples: Dict[str, List[str]],
+    gauges: Dict[str, Tuple[str, str]],
+    item: dict,
+    labels: str,
+) -> None:
+    for field, (name, _) in gauges.items():
+        value = item.get(field)
+        if _number(value):
+            samples.setdefault(name, []).append(f"{name}{{{labels}}} {value}\n")
+
+
+def render_machine(report: dict) -> Dict[str, bytes]:
+    """
+    Samples of a stored report by metric family
+    """
+    base = {"machine_id": report.get("machine_id"), "name": report.get("name")}
+    machine_labels = _labels(base)
+    samples: Dict[str, List[str]] = {}
+
+    created_at = report.get("created_at")
+    if created_at is not None:
+        name = REPORT_TIMESTAMP[0]
+        samples[name] = [f"{name}{{{machine_labels}}} {created_at.timestamp()}\n"]
+    _add_samples(samples, MACHINE_GAUGES, report, machine_labels)
+
+    for disk in report.get("disk_info") or ():
+        labels = _labels(
+            {
+                **base,
+                "mounted_on": disk.get("mounted_on"),
+                "filesystem": disk.get("filesystem"),
+            }
+        )
+        _add_samples(samples, DISK_GAUGES, disk, labels)
+
+    for gpu in report.get("gpu_status") or ():
+        labels = _labels(
+            {**base, "gpu": gpu.get("index"), "gpu_name": gpu.get("gpu_name")}
+        )
+        _add_samples(samples, GPU_GAUGES, gpu, labels)
+
+    for process in report.get("gpu_compute_processes") or ():
+        labels = _labels(
+            {
+                **base,
+                "gpu": process.get("gpu_index"),
+                "pid": process.get("pid"),
+                "user": process.get("user"),
+            }
+        )
+        _add_samples(samples, PROCESS_GAUGES, process, labels)
+
+    return {name: "".join(lines).encode() for name, lines in samples.items()}
+
+
+class MetricsCache:
+    """
+    Rendered samples of each machine's latest report, not part of the state
+    """
+
+    def __init__(self):
+        # machine_id: (report, {metric name: samples})
+        self._fragments: Dict[str, Tuple[dict, Dict[str, bytes]]] = {}
+
+    def invalidate_machine(self, machine_id: str) -> None:
+        self._fragments.pop(machine_id, None)
+
+    def clear(self) -> None:
+        self._fragments.clear()
+
+    def fragments(self, machine_id: str, report: dict) -> Dict[str, bytes]:
+        entry = self._fragments.get(machine_id)
+        # rendered from an older report by a reader of an older snapshot
+        if entry is not None and entry[0] is report:
+            return entry[1]
+        fragments = render_machine(report)
+        self._fragments[machine_id] = (report, fragments)
+        return fragments
+
+    def render(self, statuses: Iterable[Tuple[str, dict]]) -> bytes:
+        """
+        Exposition of the machines, grouped by metric family
+
+        Args:
+            statuses (Iterable[Tuple[str, dict]]): machine_id and report
+        """
+        machines = [
+            self.fragments(machine_id, report) for machine_id, report in statuses
+        ]
+        parts = []
+        for name, _ in FAMILIES:
+            samples = [fragments[name] for fragments in machines if name in fragments]
+            if samples:
+                parts.append(_HEADERS[name])
+                parts.extend(samples)
+        return b"".join(parts)
@@ -0,0 +1,243 @@
+import functools
+import inspect
+import math
+import os
+import time
+from typing import Callable, Dict, Optional, Set, Tuple
+
+from fastapi.responses import JSONResponse
+from starlette.routing import Match
+
+###############################################################################
+### Performance Counters
+#
+# Latency histograms per endpoint, timers per ingest stage and counters,
+# exposed at /debug/perf. Enabled with PERF_STATS=1; when disabled nothing is
+# measured at all: the middleware is not installed and `timed` returns the
+# decorated functions unchanged.
+
+PERF_STATS = bool(int(os.environ.get("PERF_STATS", 0)))
+
+# histogram buckets: 8 per power of 2 from 1 us, about 9% resolution, up to ~2 min
+_BUCKETS_PER_OCTAVE = 8
+_MIN_SECONDS = 1e-6
+_N_BUCKETS = 27 * _BUCKETS_PER_OCTAVE
+
+# endpoints receiving one report, counted as accepted or rejected by status
+_REPORT_PATHS = ("/report", "/report_delta")
+# endpoints whose latency is the lifetime of a stream, not recorded
+_STREAM_PATHS = ("/view_stream", "/export")
+
+
+class Histogram:
+    """
+    Log-bucketed latency histogram, O(1) per sample
+    """
+
+    __slots__ = ("buckets", "count", "total", "max")
+
+    def __init__(self):
+        self.buckets = [0] * _N_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float) -> None:
+        if seconds > _MIN_SECONDS:
+            bucket = int(math.log2(seconds / _MIN_SECONDS) * _BUCKETS_PER_OCTAVE)
+            bucket = min(bucket, _N_BUCKETS - 1)
+        else:
+            bucket = 0
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q: float) -> float:
+        """
+        Upper bound of the bucket holding the q-th percentile, in seconds
+        """
+        if not self.count:
+            return 0.0
+        rank = math.ceil(self.count * q / 100)
+        seen = 0
+        for bucket, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                upper = _MIN_SECONDS * 2 ** ((bucket + 1) / _BUCKETS_PER_OCTAVE)
+                return min(upper, self.max)
+        return self.max
+
+    def to_dict(self) -> dict:
+        ms = 1000
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count * ms, 3) if self.count else 0.0,
+            "p50_ms": round(self.percentile(50) * ms, 3),
+            "p95_ms": round(self.percentile(95) * ms, 3),
+            "p99_ms": round(self.percentile(99) * ms, 3),
+            "max_ms": round(self.max * ms, 3),
+        }
+
+
+class PerfStats:
+    def __init__(self):
+        self.started_at = time.time()
+        self.endpoints: Dict[str, Histogram] = {}  # "METHOD path"
+        self.statuses: Dict[str, Dict[int, int]] = {}  # "METHOD path": {status: n}
+        self.stages: Dict[str, Histogram] = {}
+        self.counters: Dict[str, int] = {}
+
+    def record_request(self, endpoint: str, status: int, seconds: float) -> None:
+        histogram = self.endpoints.get(endpoint)
+        if histogram is None:
+            histogram = self.endpoints[endpoint] = Histogram()
+            self.statuses[endpoint] = {}
+        histogram.record(seconds)
+        statuses = self.statuses[endpoint]
+        statuses[status] = statuses.get(status, 0) + 1
+
+    def record_stage(self, stage: str, seconds: float) -> None:
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages[stage] = Histogram()
+        histogram.record(seconds)
+
+    def count(self, name: str, n: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def to_dict(self) -> dict:
+        return {
+            "enabled": True,
+            "seconds": round(time.time() - self.started_at, 1),
+            "endpoints": {
+                endpoint: {
+                    **histogram.to_dict(),
+                    "status": dict(sorted(self.statuses[endpoint].items())),
+                }
+                for endpoint, histogram in sorted(self.endpoints.items())
+            },
+            "stages": {
+                stage: histogram.to_dict()
+                for stage, histogram in sorted(self.stages.items())
+            },
+            "counters": dict(sorted(self.counters.items())),
+        }
+
+
+PERF: Optional[PerfStats] = PerfStats() if PERF_STATS else None
+
+
+def reset() -> None:
+    global PERF
+    if PERF is not None:
+        PERF = PerfStats()
+
+
+def timed(stage: str) -> Callable[[Callable], Callable]:
+    """
+    Decorator recording the duration of each call as `stage`,
+    the function is returned unchanged when PERF_STATS is disabled
+    """
+
+    def decorator(func: Callable) -> Callable:
+        if PERF is None:
+            return func
+        clock = time.perf_counter
+
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                start = clock()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    PERF.record_stage(stage, clock() - start)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                PERF.record_stage(stage, clock() - start)
+
+        return wrapper
+
+    return decorator
+
+
+class TimedJSONResponse(JSONResponse):
+    """
+    JSONResponse recording the time spent serializing the content
+    """
+
+    @timed("response.serialize")
+    def render(self, content) -> bytes:
+        return super().render(content)
+
+
+class PerfMiddleware:
+    """
+    Record the latency and the status code of each request, from the first
+    byte received to the last byte sent
+    """
+
+    def __init__(self, app):
+        self.app = app
+        # (method, path) of the requests that matched a route
+        self._known: Set[Tuple[str, str]] = set()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or PERF is None or scope["path"] in _STREAM_PATHS:
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # unknown paths are not recorded, their number is unbounded
+            if self._is_route(scope):
+                PERF.record_request(
+                    f"{scope['method']} {scope['path']}",
+                    status,
+                    time.perf_counter() - start,
+                )
+            if scope["path"] in _REPORT_PATHS:
+                count_report(status)
+
+    def _is_route(self, scope) -> bool:
+        """
+        Whether the method and path of the request match a route of the app,
+        the routes have no path parameters so the matches are few
+        """
+        key = (scope["method"], scope["path"])
+        if key in self._known:
+            return True
+        for route in scope["app"].router.routes:
+            if route.matches(scope)[0] == Match.FULL:
+                self._known.add(key)
+                return True
+        return False
+
+
+def count_report(status: int) -> None:
+    """
+    Count an accepted or rejected report by status code
+    """
+    if PERF is not None:
+        if status < 300:
+            PERF.count("reports.accepted")
+        else:
+            PERF.count(f"reports.rejected.{status}")
@@ -0,0 +1,219 @@
+import sys
+import weakref
+from collections.abc import Mapping
+from operator import itemgetter
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from server.data_model import DiskInfo, MachineStatus
+
+###############################################################################
+### Interned Static Profiles
+#
+# Most fields of a report never change between reports of a machine, and
+# many are the same across the fleet, e.g. cpu_model or the filesystem of
+# the disks. Stored reports are split into:
+#
+#   Profile   the fields shared by a fleet of identical machines (hardware,
+#             OS, disk layout), interned by content: every report with the
+#             same values shares one Profile, whichever the machine
+#   Status    the Profile plus a tuple of the other fields, disks as tuples
+#             of their other fields, instead of a dict of every field
+#
+# The fields unique to a machine but the same in all of its reports, e.g.
+# mac_address, stay in the record and are interned, so the reports of a
+# machine share one copy.
+#
+# Status is a read-only Mapping with the keys of MachineStatus, so it is read
+# like the report dict it replaces; disk_info and to_dict() rebuild dicts.
+
+STATIC_FIELDS = (
+    "architecture",
+    "platform",
+    "platform_release",
+    "platform_version",
+    "linux_distro",
+    "processor",
+    "cpu_model",
+)
+DISK_STATIC_FIELDS = ("filesystem", "type", "mounted_on")
+MACHINE_FIELDS = ("machine_id", "report_key", "name", "hostname", "mac_address")
+
+FIELDS = tuple(MachineStatus.model_fields)
+DYNAMIC_FIELDS = tuple(name for name in FIELDS if name not in STATIC_FIELDS)
+DISK_FIELDS = tuple(DiskInfo.model_fields)
+DISK_DYNAMIC_FIELDS = tuple(n for n in DISK_FIELDS if n not in DISK_STATIC_FIELDS)
+
+# field name: index in the dynamic record, or -1 - index in the profile
+_INDEX: Dict[str, int] = {
+    **{name: i for i, name in enumerate(DYNAMIC_FIELDS)},
+    **{name: -1 - i for i, name in enumerate(STATIC_FIELDS)},
+}
+_DISK_INFO = _INDEX["disk_info"]
+_MACHINE_INDEXES = tuple(_INDEX[name] for name in MACHINE_FIELDS)
+
+# reports validated by ingest have every key
+_get_static = itemgetter(*STATIC_FIELDS)
+_get_dynamic = itemgetter(*DYNAMIC_FIELDS)
+_get_disk_static = itemgetter(*DISK_STATIC_FIELDS)
+_get_disk_dynamic = itemgetter(*DISK_DYNAMIC_FIELDS)
+_DISK_NONE = dict.fromkeys(DISK_FIELDS)
+
+
+def _intern(value: Any) -> Any:
+    return sys.intern(value) if type(value) is str else value
+
+
+class Profile:
+    """
+    Static fields of a machine and of its disks, never mutated
+    """
+
+    __slots__ = ("values", "disks", "template", "disk_templates", "__weakref__")
+
+    def __init__(self, values: tuple, disks: Optional[Tuple[tuple, ...]]):
+        self.values = values  # in STATIC_FIELDS order
+        self.disks = disks  # per disk, in DISK_STATIC_FIELDS order
+        # dicts with every key in order and the static values, copied and
+        # updated with the dynamic values to rebuild a report
+        self.template = dict.fromkeys(FIELDS)
+        self.template.update(zip(STATIC_FIELDS, values))
+        self.disk_templates = []
+        for disk in disks or ():
+            template = dict.fromkeys(DISK_FIELDS)
+            template.update(zip(DISK_STATIC_FIELDS, disk))
+            self.disk_templates.append(template)
+
+    def __reduce__(self):
+        # interned again when unpickled, e.g. replayed from another worker
+        return intern_profile, (self.values, self.disks)
+
+
+# (values, disks): Profile, dropped once no Status refers to it
+_PROFILES: "weakref.WeakValueDictionary[tuple, Profile]" = weakref.WeakValueDictionary()
+
+
+def intern_profile(values: tuple, disks: Optional[Tuple[tuple, ...]]) -> Profile:
+    """
+    The shared Profile of these static fields, created on first use
+    """
+    key = (values, disks)
+    profile = _PROFILES.get(key)
+    if profile is None:
+        values = tuple(map(_intern, values))
+        if disks is not None:
+            disks = tuple(tuple(map(_intern, disk)) for disk in disks)
+        profile = _PROFILES[key] = Profile(values, disks)
+    return profile
+
+
+def profile_count() -> int:
+    return len(_PROFILES)
+
+
+class Status(Mapping):
+    """
+    Stored report: the interned Profile and a tuple of the dynamic fields
+    """
+
+    __slots__ = ("profile", "record")
+
+    def __init__(self, profile: Profile, record: tuple):
+        self.profile = profile
+        self.record = record  # in DYNAMIC_FIELDS order
+
+    def __getitem__(self, key: str) -> Any:
+        index = _INDEX[key]
+        if index < 0:
+            return self.profile.values[-1 - index]
+        if index == _DISK_INFO:
+            return self._disk_info()
+        return self.record[index]
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if key in _INDEX:
+            return self[key]
+        return default
+
+    def __contains__(self, key: object) -> bool:
+        return key in _INDEX
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(FIELDS)
+
+    def __len__(self) -> int:
+        return len(FIELDS)
+
+    def __repr__(self) -> str:
+        return f"Status({self.to_dict()!r})"
+
+    def _disk_info(self) -> Optional[List[dict]]:
+        disks = self.record[_DISK_INFO]
+        if disks is None:
+            return None
+        disk_info = []
+        for template, dynamic in zip(self.profile.disk_templates, disks):
+            disk = template.copy()
+            disk.update(zip(DISK_DYNAMIC_FIELDS, dynamic))
+            disk_info.append(disk)
+        return disk_info
+
+    def to_dict(self) -> dict:
+        """
+        The report dict, as returned by ingest.parse_report
+        """
+        report = self.profile.template.copy()
+        report.update(zip(DYNAMIC_FIELDS, self.record))
+        report["disk_info"] = self._disk_info()
+        return report
+
+
+def compact(report: Mapping) -> Status:
+    """
+    Split a report dict into its interned Profile and dynamic record
+    """
+    if isinstance(report, Status):
+        return report
+    if len(report) != len(FIELDS):
+        # not validated by ingest, missing fields are None
+        report = {**dict.fromkeys(FIELDS), **report}
+    disk_info = report["disk_info"]
+    disks = dynamic_disks = None
+    if disk_info is not None:
+        disk_info = [
+            disk if len(disk) == len(DISK_FIELDS) else {**_DISK_NONE, **disk}
+            for disk in disk_info
+        ]
+        disks = tuple(map(_get_disk_static, disk_info))
+        dynamic_disks = tuple(map(_get_disk_dynamic, disk_info))
+    profile = intern_profile(_get_static(report), disks)
+    record = list(_get_dynamic(report))
+    record[_DISK_INFO] = dynamic_disks
+    for index in _MACHINE_INDEXES:
+        record[index] = _intern(record[index])
+    return Status(profile, tuple(record))
+
+
+def share_unchanged(status: Status, previous: Optional[Status]) -> Status:
+    """
+    `status` with the values equal to those of the previous report of the
+    machine replaced by the previous objects, so that the reports kept in
+    the history share what did not change (users_info, IPs, units, disks...)
+    """
+    if previous is None:
+        return status
+    record = list(status.record)
+    for index, (value, old) in enumerate(zip(record, previous.record)):
+        if value is old:
+            continue
+        if value == old:
+            record[index] = old
+        elif index == _DISK_INFO and value is not None and old is not None:
+            # disks one by one, usually only some of them changed
+            record[index] = (
+                tuple(
+                    old_disk if disk == old_disk else disk
+                    for disk, old_disk in zip(value, old)
+                )
+                + value[len(old) :]
+            )
+    return Status(status.profile, tuple(record))
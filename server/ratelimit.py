@@ -0,0 +1,172 @@
+import json
+import math
+import os
+import time
+from typing import Dict, List, Optional
+
+###############################################################################
+### Rate Limiting and Load Shedding
+#
+# Reports are admitted by two token buckets, one per report_key and one per
+# machine_id, checked on the raw body before it is validated. On top of
+# that, the number of report requests in flight is capped, requests beyond
+# it are shed with 503 so that /view keeps being served under overload.
+
+# reports per second allowed per machine_id and burst size, 0 to disable
+MACHINE_REPORT_RATE = float(os.environ.get("MACHINE_REPORT_RATE", 1))
+MACHINE_REPORT_BURST = float(os.environ.get("MACHINE_REPORT_BURST", 5))
+# reports per second allowed per report_key and burst size, 0 to disable
+REPORT_KEY_RATE = float(os.environ.get("REPORT_KEY_RATE", 0))
+REPORT_KEY_BURST = float(os.environ.get("REPORT_KEY_BURST", 1000))
+# max report requests handled at once, 0 to disable
+MAX_CONCURRENT_REPORTS = int(os.environ.get("MAX_CONCURRENT_REPORTS", 64))
+# seconds a shed client is asked to wait
+SHED_RETRY_AFTER = 1
+
+# paths of the endpoints receiving reports
+REPORT_PATHS = ("/report", "/report_delta", "/report_batch")
+
+
+class RateLimited(Exception):
+    def __init__(self, detail: str, retry_after: float):
+        super().__init__(detail)
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self) -> str:
+        return str(max(math.ceil(self.retry_after), 1))
+
+
+class TokenBucketLimiter:
+    """
+    One token bucket per key, refilled at `rate` tokens per second up to `burst`
+    """
+
+    # buckets are pruned every PRUNE_EVERY acquisitions
+    PRUNE_EVERY = 4096
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._buckets: Dict[str, List[float]] = {}  # key: [tokens, last refill]
+        self._acquired = 0
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def acquire(self, key: str, now: Optional[float] = None) -> float:
+        """
+        Take a token of the bucket of `key`
+
+        Returns:
+            float: 0 if a token was taken, else seconds until one is available
+        """
+        now = time.monotonic() if now is None else now
+        self._acquired += 1
+        if self._acquired % self.PRUNE_EVERY == 0:
+            self.prune(now)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            self._buckets[key] = [self.burst - 1, now]
+            return 0.0
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens >= 1:
+            bucket[0] = tokens - 1
+            return 0.0
+        bucket[0] = tokens
+        return (1 - tokens) / self.rate
+
+    def prune(self, now: float) -> None:
+        """
+        Drop the buckets that are full again, they are recreated full
+        """
+        refill = self.burst / self.rate
+        self._buckets = {
+            key: bucket
+            for key, bucket in self._buckets.items()
+            if now - bucket[1] < refill
+        }
+
+
+class ReportLimiter:
+    """
+    Token buckets per report_key and per machine_id
+    """
+
+    def __init__(
+        self,
+        machine_rate: float = MACHINE_REPORT_RATE,
+        machine_burst: float = MACHINE_REPORT_BURST,
+        report_key_rate: float = REPORT_KEY_RATE,
+        report_key_burst: float = REPORT_KEY_BURST,
+    ):
+        self.machines = (
+            TokenBucketLimiter(machine_rate, machine_burst)
+            if machine_rate > 0
+            else None
+        )
+        self.report_keys = (
+            TokenBucketLimiter(report_key_rate, report_key_burst)
+            if report_key_rate > 0
+            else None
+        )
+
+    def check(self, report_key: Optional[str], machine_id: Optional[str]) -> None:
+        """
+        Raises:
+            RateLimited: the report_key or the machine_id sends too many reports
+        """
+        if self.machines is not None and machine_id:
+            retry_after = self.machines.acquire(machine_id)
+            if retry_after:
+                raise RateLimited("Too many reports from this machine", retry_after)
+        if self.report_keys is not None and report_key:
+            retry_after = self.report_keys.acquire(report_key)
+            if retry_after:
+                raise RateLimited("Too many reports for this report_key", retry_after)
+
+
+class LoadShedder:
+    """
+    ASGI middleware answering 503 to report requests beyond
+    `max_concurrent` in flight
+    """
+
+    def __init__(self, app, max_concurrent: int = MAX_CONCURRENT_REPORTS):
+        self.app = app
+        self.max_concurrent = max_concurrent
+        self.in_flight = 0
+        self.shed = 0
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or not self.max_concurrent
+            or scope["path"] not in REPORT_PATHS
+        ):
+            return await self.app(scope, receive, send)
+        if self.in_flight >= self.max_concurrent:
+            self.shed += 1
+            return await self._reject(send)
+        self.in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.in_flight -= 1
+
+    @staticmethod
+    async def _reject(send) -> None:
+        body = json.dumps({"detail": "Server overloaded, retry later"}).encode()
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 503,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode("latin-1")),
+                    (b"retry-after", str(SHED_RETRY_AFTER).encode("latin-1")),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,372 @@
+import math
+import os
+import sys
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from server.metric_history import match_metrics
+
+###############################################################################
+### Metric Rollups
+#
+# The metric samples of a machine (see server/metric_history.py) are also
+# aggregated into min/max/mean/last buckets at several resolutions, e.g.
+# 1 minute, 5 minutes and 1 hour, so that a chart over a week reads a few
+# hundred buckets instead of 60k samples.
+#
+# Only the open bucket of the finest resolution is updated per sample. When
+# it closes, it is stored and merged into the open bucket of the next
+# resolution, which closes in turn when the time passes its end, and so on.
+# Every resolution is thus a multiple of the previous one. Closed buckets are
+# stored columnar like MetricHistory: one array of bucket starts and, per
+# metric, one float32 array per statistic and one array of sample counts.
+#
+# A bucket costs 18 bytes per metric (4 float32 and a uint16 count), and the
+# arrays grow by up to 1/8 before the oldest buckets are dropped. With the
+# 46 metrics of a node with 4 GPUs and 5 disks, the 576 buckets of the
+# default take ~600 KiB per machine (benchmarks/bench_history.py). The finest
+# resolution only bridges the samples in memory (1 hour) and the 5 minute
+# buckets: give it fewer buckets, or drop a resolution, to use less.
+
+# resolution in seconds and buckets kept, finest first, each resolution a
+# multiple of the previous one (2 hours of 1m, 1 day of 5m, 1 week of 1h)
+ROLLUP_RESOLUTIONS = os.environ.get("ROLLUP_RESOLUTIONS", "60:120,300:288,3600:168")
+
+STATS = ("min", "max", "mean", "last")
+
+_NAN = float("nan")
+# position of the statistics in an accumulator, [min, max, sum, last, count]
+_MIN, _MAX, _SUM, _LAST, _COUNT = range(5)
+
+
+def parse_resolutions(spec: str) -> List[Tuple[int, int]]:
+    """
+    [(resolution, buckets)] of "60:360,300:288,..."
+
+    Raises:
+        ValueError: malformed spec or a resolution not a multiple of the
+            previous one
+    """
+    resolutions = []
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        resolution, _, buckets = item.partition(":")
+        resolution, buckets = int(resolution), int(buckets)
+        if resolution <= 0 or buckets <= 0:
+            raise ValueError(f"Invalid rollup resolution {item!r}")
+        if resolutions and resolution % resolutions[-1][0]:
+            raise ValueError(
+                f"Rollup resolution {resolution} is not a multiple of "
+                f"{resolutions[-1][0]}"
+            )
+        resolutions.append((resolution, buckets))
+    return resolutions
+
+
+def _merge(into: Dict[str, list], acc: Dict[str, list]) -> None:
+    """
+    Merge the accumulators `acc` into `into`, `acc` holding the later samples
+    """
+    for name, stats in acc.items():
+        target = into.get(name)
+        if target is None:
+            into[name] = stats.copy()
+            continue
+        if stats[_MIN] < target[_MIN]:
+            target[_MIN] = stats[_MIN]
+        if stats[_MAX] > target[_MAX]:
+            target[_MAX] = stats[_MAX]
+        target[_SUM] += stats[_SUM]
+        target[_LAST] = stats[_LAST]
+        target[_COUNT] += stats[_COUNT]
+
+
+def _store(column: List[array], stats: list) -> None:
+    """
+    Append the statistics of an accumulator to a column
+    """
+    column[0].append(stats[_MIN])
+    column[1].append(stats[_MAX])
+    column[2].append(stats[_SUM] / stats[_COUNT])
+    column[3].append(stats[_LAST])
+    column[4].append(min(stats[_COUNT], 0xFFFF))
+
+
+def _reduce(stat: str, values: array, counts: array, i: int, j: int) -> Optional[float]:
+    """
+    `stat` of the buckets [i, j), from their own `stat` values (and sample
+    counts for the mean), None without samples
+    """
+    if j - i == 1:
+        value = values[i]
+        return None if value != value else value
+    if stat == "mean":
+        n = sum(counts[i:j])
+        if not n:
+            return None
+        return sum(v * c for v, c in zip(values[i:j], counts[i:j]) if c) / n
+    if stat == "last":
+        for value in reversed(values[i:j]):
+            if value == value:
+                return value
+        return None
+    present = [value for value in values[i:j] if value == value]
+    if not present:
+        return None
+    return min(present) if stat == "min" else max(present)
+
+
+class Rollup:
+    """
+    Buckets of one resolution for one machine, at most `size` closed ones
+    """
+
+    __slots__ = ("resolution", "size", "times", "columns", "start", "acc")
+
+    def __init__(self, resolution: int, size: int):
+        self.resolution = resolution
+        self.size = size
+        self.times = array("I")  # bucket starts
+        # metric name: [mins, maxs, means, lasts, counts]
+        self.columns: Dict[str, List[array]] = {}
+        self.start: Optional[int] = None  # start of the open bucket
+        self.acc: Dict[str, list] = {}  # metric name: accumulator
+
+    def __len__(self) -> int:
+        return min(len(self.times), self.size)
+
+    def oldest(self) -> float:
+        """
+        Start of the oldest retained bucket, inf if there is none
+        """
+        if self.times:
+            return self.times[len(self.times) - len(self)]
+        return math.inf if self.start is None else self.start
+
+    def close(self) -> None:
+        """
+        Store the open bucket
+        """
+        if not self.acc:
+            return
+        n = len(self.times)
+        self.times.append(self.start)
+        new = len(self.acc)
+        for name, column in self.columns.items():
+            stats = self.acc.get(name)
+            if stats is None:
+                for values in column[:4]:
+                    values.append(_NAN)
+                column[4].append(0)
+                continue
+            new -= 1
+            _store(column, stats)
+        if new:
+            for name, stats in self.acc.items():
+                if name not in self.columns:
+                    # no samples in the buckets before the metric appeared
+                    column = [array("f", [_NAN]) * n for _ in range(4)]
+                    column.append(array("H", [0]) * n)
+                    _store(column, stats)
+                    self.columns[name] = column
+        if n + 1 >= self.size + max(self.size // 8, 1):
+            self._compact()
+
+    def _compact(self) -> None:
+        drop = len(self.times) - self.size
+        del self.times[:drop]
+        for name in list(self.columns):
+            column = self.columns[name]
+            for values in column:
+                del values[:drop]
+            # metrics without samples for the whole window
+            if not column[4][-1] and not any(column[4]):
+                del self.columns[name]
+
+    def query(
+        self,
+        since: Optional[float],
+        until: Optional[float],
+        step: int,
+        metrics: Optional[Iterable[str]],
+        stat: str,
+        pending: Dict[str, list],
+    ) -> dict:
+        """
+        Buckets overlapping [since, until], merged into one point per `step`
+        seconds (aligned on the epoch) when `step` is coarser, `pending` being
+        the samples of the open bucket
+        """
+        resolution = self.resolution
+        lo = len(self.times) - len(self)
+        if since is not None:
+            # buckets ending after `since`
+            lo = max(lo, bisect_left(self.times, math.floor(since) - resolution + 1))
+        hi = len(self.times)
+        if until is not None:
+            hi = bisect_left(self.times, math.floor(until) + 1, lo=lo)
+        times = self.times[lo:hi]
+        if pending and (
+            (since is None or self.start + resolution > since)
+            and (until is None or self.start <= until)
+        ):
+            times.append(self.start)
+        else:
+            pending = {}
+
+        groups = []
+        i = 0
+        while i < len(times):
+            if step <= resolution:
+                groups.append((times[i], i, i + 1))
+                i += 1
+                continue
+            key = times[i] - times[i] % step
+            j = bisect_left(times, key + step, lo=i + 1)
+            groups.append((key, i, j))
+            i = j
+
+        index = STATS.index(stat)
+        result = {}
+        for name in match_metrics(self.columns.keys() | pending.keys(), metrics):
+            column = self.columns.get(name)
+            if column is None:
+                values = array("f", [_NAN]) * (hi - lo)
+                counts = array("H", [0]) * (hi - lo)
+            else:
+                values = column[index][lo:hi]
+                counts = column[4][lo:hi]
+            if pending:
+                stats = pending.get(name)
+                if stats is None:
+                    values.append(_NAN)
+                    counts.append(0)
+                else:
+                    value = stats[_SUM] / stats[_COUNT] if stat == "mean" else None
+                    values.append(stats[index] if value is None else value)
+                    counts.append(min(stats[_COUNT], 0xFFFF))
+            result[name] = [_reduce(stat, values, counts, i, j) for _, i, j in groups]
+        return {
+            "timestamps": [key for key, _, _ in groups],
+            "metrics": result,
+            "resolution": resolution,
+        }
+
+    def nbytes(self) -> int:
+        return (
+            sys.getsizeof(self.times)
+            + sys.getsizeof(self.columns)
+            + sum(
+                sys.getsizeof(values)
+                for column in self.columns.values()
+                for values in column
+            )
+        )
+
+
+class Rollups:
+    """
+    Rollups of one machine at every resolution, finest first
+    """
+
+    __slots__ = ("levels",)
+
+    def __init__(self, resolutions: List[Tuple[int, int]]):
+        self.levels = [Rollup(resolution, size) for resolution, size in resolutions]
+
+    def append(self, timestamp: float, values: Dict[str, float]) -> None:
+        ts = int(timestamp)
+        finest = self.levels[0]
+        start = ts - ts % finest.resolution
+        if start != finest.start:
+            if finest.start is not None and start < finest.start:
+                return  # older than the open bucket
+            self._advance(0, start)
+        acc = finest.acc
+        # literal indexes (_MIN, _MAX, _SUM, _LAST, _COUNT), once per sample
+        # and metric
+        for name, value in values.items():
+            stats = acc.get(name)
+            if stats is None:
+                acc[name] = [value, value, value, value, 1]
+                continue
+            if value < stats[0]:
+                stats[0] = value
+            elif value > stats[1]:
+                stats[1] = value
+            stats[2] += value
+            stats[3] = value
+            stats[4] += 1
+
+    def _advance(self, level: int, start: int) -> None:
+        """
+        Close the open bucket of `level` and open the one at `start`, closing
+        the coarser buckets that end too
+        """
+        rollup = self.levels[level]
+        rollup.close()
+        if level + 1 < len(self.levels):
+            coarser = self.levels[level + 1]
+            _merge(coarser.acc, rollup.acc)
+            coarser_start = start - start % coarser.resolution
+            if coarser_start != coarser.start:
+                self._advance(level + 1, coarser_start)
+        rollup.start = start
+        rollup.acc = {}
+
+    def level(self, step: int) -> Optional[Rollup]:
+        """
+        Coarsest rollup at most `step` seconds, None if `step` is finer than
+        all of them
+        """
+        found = None
+        for rollup in self.levels:
+            if rollup.resolution > step:
+                break
+            found = rollup
+        return found
+
+    def query(
+        self,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        step: int = 0,
+        metrics: Optional[Iterable[str]] = None,
+        stat: str = "mean",
+    ) -> Optional[dict]:
+        """
+        Samples in a time range at the coarsest resolution satisfying `step`,
+        so the cost depends on the points returned rather than the samples
+
+        Args:
+            since (float): epoch seconds, inclusive
+            until (float): epoch seconds, inclusive
+            step (int): seconds between two points
+            metrics (Iterable[str]): glob patterns of the metric names,
+                all metrics if empty
+            stat (str): min, max, mean or last of the samples of each point
+
+        Returns:
+            Optional[dict]: {"timestamps": [...], "metrics": {name: [...]},
+                "resolution": seconds}, missing values are None, None if
+                `step` is finer than the finest resolution
+
+        Raises:
+            ValueError: unknown stat
+        """
+        if stat not in STATS:
+            raise ValueError(f"Invalid stat, expected one of {', '.join(STATS)}")
+        rollup = self.level(step)
+        if rollup is None:
+            return None
+        # the open buckets of the finer levels belong to the open bucket
+        pending: Dict[str, list] = {}
+        for finer in self.levels[: self.levels.index(rollup) + 1][::-1]:
+            _merge(pending, finer.acc)
+        return rollup.query(since, until, step, metrics, stat, pending)
+
+    def nbytes(self) -> int:
+        return sum(rollup.nbytes() for rollup in self.levels)
+
+
+RESOLUTIONS = parse_resolutions(ROLLUP_RESOLUTIONS)
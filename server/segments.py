@@ -0,0 +1,375 @@
+import hashlib
+import json
+import math
+import mmap
+import os
+import re
+import struct
+import tempfile
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import Dict, FrozenSet, List, NamedTuple, Optional, Tuple
+
+from server.metric_history import match_metrics, select
+
+###############################################################################
+### On-Disk Metric History Segments
+#
+# The numeric metrics of every report (see server/metric_history.py) are
+# appended to per-machine segment files of fixed-size records:
+#
+#   HISTORY_DIR/<machine>/<start>-<end>-<layout>.seg
+#
+#   header   b"MXHSEG01", uint32 length, JSON {"machine_id", "metrics",
+#            "start", "end"} padded to a multiple of 4 bytes
+#   records  uint32 epoch seconds, float32 per metric (NaN if missing)
+#
+# A segment covers [start, end), SEGMENT_SECONDS aligned on the epoch, and
+# one layout (list of metrics): a report with a metric the layout lacks
+# starts a new segment. File names are derived from the window and the
+# layout only, so workers append to the same files (O_APPEND, one write per
+# record). Queries memory-map the segments overlapping the range, bisect
+# the timestamps in place and decode only the records returned; recent data
+# is read from the page cache. A query returns at most
+# SEGMENT_QUERY_MAX_POINTS points, the step of a longer range is raised to
+# fit. Segments past SEGMENT_RETENTION_SECONDS are deleted.
+
+# directory of the segments, empty to disable
+HISTORY_DIR = os.environ.get("HISTORY_DIR", "")
+# seconds covered by one segment (1 day)
+SEGMENT_SECONDS = int(os.environ.get("SEGMENT_SECONDS", 24 * 3600))
+# seconds a segment is kept after its end (90 days), 0 to keep forever
+SEGMENT_RETENTION_SECONDS = int(
+    os.environ.get("SEGMENT_RETENTION_SECONDS", 90 * 24 * 3600)
+)
+# seconds between two retention passes
+SEGMENT_SWEEP_INTERVAL = int(os.environ.get("SEGMENT_SWEEP_INTERVAL", 3600))
+# segments kept open for appending, least recently written closed first
+SEGMENT_OPEN_FILES = int(os.environ.get("SEGMENT_OPEN_FILES", 256))
+# max number of points returned by a query
+SEGMENT_QUERY_MAX_POINTS = int(os.environ.get("SEGMENT_QUERY_MAX_POINTS", 10000))
+
+_MAGIC = b"MXHSEG01"
+_SUFFIX = ".seg"
+_SEGMENT_NAME = re.compile(r"^(\d+)-(\d+)-([0-9a-f]+)\.seg$")
+# machine_ids usable as a directory name as is, others are hashed
+_SAFE_NAME = re.compile(r"^[A-Za-z0-9_-][A-Za-z0-9_.-]{0,127}$")
+_NAN = float("nan")
+
+
+def machine_dir(root: str, machine_id: str) -> str:
+    if _SAFE_NAME.match(machine_id):
+        return os.path.join(root, machine_id)
+    return os.path.join(root, "_" + hashlib.sha256(machine_id.encode()).hexdigest())
+
+
+def _layout_hash(metrics: Tuple[str, ...]) -> str:
+    return hashlib.sha1("\n".join(metrics).encode()).hexdigest()[:12]
+
+
+def _header(machine_id: str, metrics: Tuple[str, ...], start: int, end: int) -> bytes:
+    meta = json.dumps(
+        {"machine_id": machine_id, "metrics": metrics, "start": start, "end": end}
+    ).encode()
+    meta += b" " * (-(len(_MAGIC) + 4 + len(meta)) % 4)
+    return _MAGIC + struct.pack("<I", len(meta)) + meta
+
+
+class _Active(NamedTuple):
+    """
+    Segment a machine is appending to
+    """
+
+    path: str
+    start: int
+    end: int
+    metrics: Tuple[str, ...]
+    metric_set: FrozenSet[str]
+    record: struct.Struct
+
+
+class SegmentStore:
+    def __init__(
+        self,
+        root: str,
+        segment_seconds: int = SEGMENT_SECONDS,
+        retention_seconds: int = SEGMENT_RETENTION_SECONDS,
+        open_files: int = SEGMENT_OPEN_FILES,
+        max_points: int = SEGMENT_QUERY_MAX_POINTS,
+    ):
+        self.root = root
+        self.segment_seconds = segment_seconds
+        self.retention_seconds = retention_seconds
+        self.open_files = max(open_files, 1)
+        self.max_points = max(max_points, 1)
+        self._active: Dict[str, _Active] = {}  # machine_id: active segment
+        self._fds: "OrderedDict[str, int]" = OrderedDict()  # path: fd, LRU
+        # appends happen on the event loop, sweeps in a thread: held to change
+        # the open files and the active segments, not for the file system
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    ### Writing
+
+    def append(self, machine_id: str, timestamp: float, values: Dict[str, float]):
+        """
+        Append a record to the active segment of the machine, starting a new
+        segment when the window ends or a metric is new
+        """
+        ts = int(timestamp)
+        with self._lock:
+            self._append(machine_id, ts, values)
+
+    def _append(self, machine_id: str, ts: int, values: Dict[str, float]):
+        active = self._active.get(machine_id)
+        if (
+            active is None
+            or not active.start <= ts < active.end
+            or not values.keys() <= active.metric_set
+        ):
+            metrics = set(values)
+            if active is not None and active.start <= ts < active.end:
+                metrics.update(active.metrics)
+            active = self._start_segment(machine_id, ts, tuple(sorted(metrics)))
+        record = active.record.pack(
+            ts, *[values.get(name, _NAN) for name in active.metrics]
+        )
+        os.write(self._fd(active.path), record)
+
+    def _start_segment(
+        self, machine_id: str, ts: int, metrics: Tuple[str, ...]
+    ) -> _Active:
+        start = ts - ts % self.segment_seconds
+        end = start + self.segment_seconds
+        directory = machine_dir(self.root, machine_id)
+        path = os.path.join(
+            directory, f"{start:010d}-{end:010d}-{_layout_hash(metrics)}{_SUFFIX}"
+        )
+        if not os.path.exists(path):
+            os.makedirs(directory, exist_ok=True)
+            # the header is written to a temporary file linked into place,
+            # so that other workers never see a segment without its header
+            fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            try:
+                os.write(fd, _header(machine_id, metrics, start, end))
+                os.close(fd)
+                os.link(tmp, path)
+            except FileExistsError:
+                pass  # created by another worker meanwhile
+            finally:
+                os.unlink(tmp)
+        active = self._active[machine_id] = _Active(
+            path,
+            start,
+            end,
+            metrics,
+            frozenset(metrics),
+            struct.Struct(f"<I{len(metrics)}f"),
+        )
+        return active
+
+    def _fd(self, path: str) -> int:
+        fd = self._fds.get(path)
+        if fd is not None:
+            self._fds.move_to_end(path)
+            return fd
+        while len(self._fds) >= self.open_files:
+            os.close(self._fds.popitem(last=False)[1])
+        fd = self._fds[path] = os.open(path, os.O_WRONLY | os.O_APPEND)
+        return fd
+
+    def close(self) -> None:
+        with self._lock:
+            for fd in self._fds.values():
+                os.close(fd)
+            self._fds.clear()
+            self._active.clear()
+
+    ### Reading
+
+    def segments(
+        self,
+        machine_id: str,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+    ) -> List[str]:
+        """
+        Paths of the segments of a machine overlapping [since, until], by start
+        """
+        directory = machine_dir(self.root, machine_id)
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return []
+        found = []
+        for name in names:
+            match = _SEGMENT_NAME.match(name)
+            if match is None:
+                continue
+            start, end = int(match.group(1)), int(match.group(2))
+            if (since is None or end > since) and (until is None or start <= until):
+                found.append((start, name))
+        return [os.path.join(directory, name) for _, name in sorted(found)]
+
+    def query(
+        self,
+        machine_id: str,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        step: int = 0,
+        metrics: Optional[List[str]] = None,
+    ) -> dict:
+        """
+        Samples of a machine in a time range, same as MetricHistory.query,
+        with the step raised so that at most max_points are returned
+        """
+        paths = self.segments(machine_id, since, until)
+        if paths:
+            first = since
+            if first is None:
+                first = int(_SEGMENT_NAME.match(os.path.basename(paths[0])).group(1))
+            last = time.time() if until is None else until
+            step = max(step, math.ceil((last - first) / self.max_points))
+        parts = []
+        next_since = since
+        for path in paths:
+            part = _read_segment(path, next_since, until, step)
+            if part is None:
+                continue
+            parts.append(part)
+            if step > 0 and part[0]:
+                # the first sample of the next interval, in the next segment
+                next_since = part[0][-1] + step
+        names = match_metrics({n for _, columns in parts for n in columns}, metrics)
+        times = array("I")
+        columns = {name: array("f") for name in names}
+        for part_times, part_columns in parts:
+            times.extend(part_times)
+            for name in names:
+                values = part_columns.get(name)
+                if values is None:
+                    values = array("f", [_NAN]) * len(part_times)
+                columns[name].extend(values)
+        if any(a > b for a, b in zip(times, times[1:])):
+            # segments of different layouts overlapping in time
+            order = sorted(range(len(times)), key=times.__getitem__)
+            times = array("I", map(times.__getitem__, order))
+            for name in names:
+                columns[name] = array("f", map(columns[name].__getitem__, order))
+        return select(times, columns, step)
+
+    ### Retention
+
+    def sweep(self, now: Optional[float] = None) -> int:
+        """
+        Delete the segments that ended more than retention_seconds ago
+
+        Returns:
+            int: number of segments deleted
+        """
+        if not self.retention_seconds:
+            return 0
+        cutoff = (time.time() if now is None else now) - self.retention_seconds
+        # listed without the lock, appends go on meanwhile
+        expired: Dict[str, List[str]] = {}  # directory: paths
+        for entry in os.scandir(self.root):
+            if not entry.is_dir():
+                continue
+            expired[entry.path] = [
+                os.path.join(entry.path, name)
+                for name in os.listdir(entry.path)
+                for match in [_SEGMENT_NAME.match(name)]
+                if match is not None and int(match.group(2)) <= cutoff
+            ]
+        with self._lock:
+            for paths in expired.values():
+                for path in paths:
+                    fd = self._fds.pop(path, None)
+                    if fd is not None:
+                        os.close(fd)
+            self._active = {
+                machine_id: active
+                for machine_id, active in self._active.items()
+                if active.end > cutoff
+            }
+        deleted = 0
+        for directory, paths in expired.items():
+            for path in paths:
+                try:
+                    os.unlink(path)
+                    deleted += 1
+                except FileNotFoundError:
+                    pass  # deleted by another worker
+            try:
+                os.rmdir(directory)  # only if empty
+            except OSError:
+                pass
+        return deleted
+
+
+def _read_segment(
+    path: str, since: Optional[float], until: Optional[float], step: int = 0
+) -> Optional[Tuple[array, Dict[str, array]]]:
+    """
+    Records of a segment in [since, until], the first one of every `step`
+    seconds: the file is memory-mapped, the timestamps are bisected in place
+    and only the records returned are copied out, as one array per column
+
+    Returns:
+        Optional[Tuple[array, Dict[str, array]]]: timestamps and values by
+            metric name, None if the segment was deleted meanwhile
+    """
+    try:
+        with open(path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        return None
+    try:
+        with memoryview(mapped) as view:
+            (meta_length,) = struct.unpack_from("<I", view, len(_MAGIC))
+            offset = len(_MAGIC) + 4 + meta_length
+            metrics = json.loads(bytes(view[len(_MAGIC) + 4 : offset]))["metrics"]
+            stride = 1 + len(metrics)  # 4-byte fields per record
+            # a record being appended is left out
+            count = (len(view) - offset) // (4 * stride)
+            with view[offset : offset + count * 4 * stride] as region:
+                with region.cast("I") as fields:
+                    timestamp = lambda i: fields[i * stride]
+                    start = 0
+                    if since is not None:
+                        start = bisect_left(
+                            range(count), math.ceil(since), key=timestamp
+                        )
+                    end = count
+                    if until is not None:
+                        end = bisect_left(
+                            range(count), math.floor(until) + 1, lo=start, key=timestamp
+                        )
+                    ranges = [(start, end)]
+                    if step > 0:
+                        ranges = []
+                        while start < end:
+                            ranges.append((start, start + 1))
+                            start = bisect_left(
+                                range(count),
+                                timestamp(start) + step,
+                                lo=start + 1,
+                                hi=end,
+                                key=timestamp,
+                            )
+                times, values = array("I"), array("f")
+                for first, last in ranges:
+                    with region[first * 4 * stride : last * 4 * stride] as records:
+                        times.frombytes(records)
+                        values.frombytes(records)
+    finally:
+        mapped.close()
+    return times[::stride], {
+        name: values[1 + i :: stride] for i, name in enumerate(metrics)
+    }
+
+
+SEGMENTS: Optional[SegmentStore] = SegmentStore(HISTORY_DIR) if HISTORY_DIR else None
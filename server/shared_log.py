@@ -0,0 +1,293 @@
+import fcntl
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, List, Optional, Set, Tuple
+
+###############################################################################
+### Shared Mutation Log
+#
+# Every gunicorn worker keeps its own in-memory Database. To let more than one
+# worker serve requests, each worker appends the mutations it accepts to a
+# SQLite table (WAL mode, so readers never block the writer) and replays the
+# mutations appended by the other workers. The log is polled every
+# STATE_SYNC_INTERVAL seconds in the background, read in a thread with its
+# own connection, so requests never wait on SQLite to read: a worker may
+# serve a state up to STATE_SYNC_INTERVAL behind the other workers.
+#
+# A replayed report only updates the statuses and the indexes of the views
+# (caches, liveness, summaries, GPU index, streams). Its history, metric
+# history, rollups, alerts and segments are kept by the worker that received
+# it, so adding workers splits that work rather than repeating it. The
+# histories served by a worker hold the reports it received: clients keep
+# their connection, so the reports of a machine mostly land on one worker.
+#
+# The same log makes the state durable: a compacted snapshot of the state is
+# written next to the SQLite file periodically, and on startup a worker loads
+# the snapshot and replays only the tail of the log after it.
+
+# path of the SQLite file shared by all workers, empty to disable
+STATE_DB_PATH = os.environ.get("STATE_DB_PATH", "")
+# seconds between two snapshots of the state
+STATE_SNAPSHOT_INTERVAL = int(os.environ.get("STATE_SNAPSHOT_INTERVAL", 60))
+# seconds between two reads of the mutations of the other workers
+STATE_SYNC_INTERVAL = float(os.environ.get("STATE_SYNC_INTERVAL", 0.2))
+
+
+class SharedLog:
+    """
+    Append-only mutation log stored in SQLite and tailed by every worker
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.snapshot_path = path + ".snapshot"
+        self.applied_seq = 0
+        self._own: Set[int] = set()  # appended by this worker, not yet tailed
+        self._lock = threading.RLock()
+        self._pid: Optional[int] = None
+        self._conn: Optional[sqlite3.Connection] = None
+        # connection of the background reads, see fetch
+        self._read_lock = threading.Lock()
+        self._read_pid: Optional[int] = None
+        self._read_conn: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            timeout=30,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS mutations ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "op TEXT NOT NULL, "
+            "key TEXT NOT NULL, "
+            "payload BLOB NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta ("
+            "name TEXT PRIMARY KEY, "
+            "value INTEGER NOT NULL)"
+        )
+        return conn
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        # connections must not be shared with forked workers
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = self._connect()
+            self._pid = os.getpid()
+        return self._conn
+
+    def append(self, op: str, *args: Any, key: str = "") -> int:
+        """
+        Append a mutation that has already been applied by this worker
+
+        Args:
+            op (str): name of the mutation
+            args: arguments to replay the mutation with
+            key (str): mutations of the same op and key supersede each other
+        """
+        payload = pickle.dumps(args, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            cursor = self.conn.execute(
+                "INSERT INTO mutations (op, key, payload) VALUES (?, ?, ?)",
+                (op, key, payload),
+            )
+            seq = cursor.lastrowid
+            self._own.add(seq)
+        return seq
+
+    @contextmanager
+    def transaction(self):
+        """
+        Commit the mutations appended within the block at once
+        """
+        with self._lock:
+            own = set(self._own)
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                # rolled back seqs may be reused by other workers
+                self._own = own
+                raise
+            self.conn.execute("COMMIT")
+
+    def read_since(self, seq: int) -> List[Tuple[int, str, bytes]]:
+        return self.conn.execute(
+            "SELECT seq, op, payload FROM mutations WHERE seq > ? ORDER BY seq",
+            (seq,),
+        ).fetchall()
+
+    def read_latest_since(self, seq: int) -> List[Tuple[int, str, bytes]]:
+        """
+        Same as read_since, but only the last report of each machine
+        """
+        return self.conn.execute(
+            "SELECT seq, op, payload FROM mutations WHERE seq > ? AND ("
+            "op != 'report' OR seq IN ("
+            "SELECT MAX(seq) FROM mutations WHERE seq > ? AND op = 'report' "
+            "GROUP BY key)) ORDER BY seq",
+            (seq, seq),
+        ).fetchall()
+
+    def fetch(self) -> List[Tuple[int, str, bytes]]:
+        """
+        Mutations appended since the last replay, read with a connection of
+        its own so that it can run in a thread while the appends go on, see
+        apply
+        """
+        with self._read_lock:
+            if self._read_conn is None or self._read_pid != os.getpid():
+                self._read_conn = self._connect()
+                self._read_pid = os.getpid()
+            return self._read_conn.execute(
+                "SELECT seq, op, payload FROM mutations WHERE seq > ? ORDER BY seq",
+                (self.applied_seq,),
+            ).fetchall()
+
+    def apply(
+        self, rows: List[Tuple[int, str, bytes]], apply: Callable[..., None]
+    ) -> int:
+        """
+        Replay the mutations of `rows` appended by other workers, skipping
+        those replayed meanwhile
+
+        Args:
+            apply: called with the op and the arguments of each mutation
+
+        Returns:
+            int: number of mutations replayed
+        """
+        count = 0
+        with self._lock:
+            for seq, op, payload in rows:
+                if seq <= self.applied_seq:
+                    continue
+                if seq in self._own:
+                    self._own.discard(seq)
+                else:
+                    apply(op, *pickle.loads(payload))
+                    count += 1
+                self.applied_seq = seq
+        return count
+
+    def catch_up(self, apply: Callable[..., None], latest_only: bool = False) -> int:
+        """
+        Replay the mutations appended by other workers since the last call
+
+        Args:
+            apply: called with the op and the arguments of each mutation
+            latest_only (bool): skip reports superseded by a later report
+                of the same machine, used when restoring on startup
+
+        Returns:
+            int: number of mutations replayed
+        """
+        with self._lock:
+            if latest_only:
+                rows = self.read_latest_since(self.applied_seq)
+            else:
+                rows = self.read_since(self.applied_seq)
+            return self.apply(rows, apply)
+
+    ###########################################################################
+    ### Snapshots
+
+    def load_snapshot(self) -> Optional[Any]:
+        """
+        Load the latest snapshot, the log is then tailed from its position
+
+        Returns:
+            the state passed to write_snapshot, None if there is no snapshot
+        """
+        if not os.path.exists(self.snapshot_path):
+            return None
+        with open(self.snapshot_path, "rb") as f:
+            seq, state = pickle.load(f)
+        with self._lock:
+            self.applied_seq = max(self.applied_seq, seq)
+        return state
+
+    def capture(
+        self, apply: Callable[..., None], dump: Callable[[], Any]
+    ) -> Tuple[int, Any]:
+        """
+        Catch up with the log and dump the state at that exact position
+
+        Returns:
+            Tuple[int, Any]: position in the log and the dumped state
+        """
+        with self._lock:
+            self.catch_up(apply)
+            # mutations appended meanwhile are blocked by the lock,
+            # so the state reflects exactly the log up to applied_seq
+            return self.applied_seq, dump()
+
+    def snapshot_age(self) -> float:
+        """
+        Seconds since the latest snapshot was written by any worker
+        """
+        try:
+            return time.time() - os.path.getmtime(self.snapshot_path)
+        except OSError:
+            return float("inf")
+
+    def write_snapshot(self, seq: int, state: Any, interval: float = 0) -> bool:
+        """
+        Write a snapshot of the state at position `seq` and compact the log.
+
+        Mutations are only dropped up to the previous snapshot, so that
+        workers restoring from it or lagging behind can still replay them.
+
+        Args:
+            seq (int): position in the log the state reflects
+            state: picklable state
+            interval (float): skip if another worker wrote a snapshot within
+                the last `interval` seconds
+
+        Returns:
+            bool: False if skipped because of another worker
+        """
+        with open(self.snapshot_path + ".lock", "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            if self.snapshot_age() < interval:
+                return False
+            # the connection is shared with the thread serving requests
+            with self._lock:
+                row = self.conn.execute(
+                    "SELECT value FROM meta WHERE name = 'snapshot_seq'"
+                ).fetchone()
+            previous_seq = row[0] if row else 0
+            if seq <= previous_seq:
+                return False
+
+            tmp_path = self.snapshot_path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump((seq, state), f, protocol=pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+
+            with self._lock:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO meta (name, value) "
+                    "VALUES ('snapshot_seq', ?)",
+                    (seq,),
+                )
+                self.conn.execute(
+                    "DELETE FROM mutations WHERE seq <= ?", (previous_seq,)
+                )
+        return True
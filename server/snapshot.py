@@ -0,0 +1,214 @@
+from types import MappingProxyType
+from typing import Any, Dict, Iterable, Iterator, Mapping, NamedTuple, Tuple, Union
+
+###############################################################################
+### Copy-on-Write Snapshots
+#
+# The statuses and the view groups are published together as an immutable,
+# versioned Snapshot. Writers never mutate a published snapshot: they build
+# the next one, sharing everything that did not change, and publish it with a
+# single assignment. Readers take DB.SNAPSHOT once and get a consistent view
+# of both without any lock, however long they hold it.
+
+# shards of a FrozenMap, an update copies one shard (~len / _SHARDS entries)
+_SHARDS = 256
+# items per chunk of a FrozenOrderedSet, an update copies the chunks it
+# changes and the tuple of chunks (~len / _CHUNK_SIZE entries)
+_CHUNK_SIZE = 256
+
+
+class FrozenMap(Mapping):
+    """
+    Immutable mapping. `set` and `delete` return a new map that shares all
+    but one of its shards with this one.
+    """
+
+    __slots__ = ("_shards", "_len")
+
+    def __init__(self, items: Union[Mapping, Iterable[Tuple[Any, Any]]] = ()):
+        shards = [{} for _ in range(_SHARDS)]
+        for key, value in dict(items).items():
+            shards[hash(key) % _SHARDS][key] = value
+        self._shards: Tuple[Dict, ...] = tuple(shards)
+        self._len = sum(map(len, shards))
+
+    @classmethod
+    def _from_shards(cls, shards: Tuple[Dict, ...], length: int) -> "FrozenMap":
+        frozen = object.__new__(cls)
+        frozen._shards = shards
+        frozen._len = length
+        return frozen
+
+    def __getitem__(self, key):
+        return self._shards[hash(key) % _SHARDS][key]
+
+    def get(self, key, default=None):
+        return self._shards[hash(key) % _SHARDS].get(key, default)
+
+    def __contains__(self, key) -> bool:
+        return key in self._shards[hash(key) % _SHARDS]
+
+    def __iter__(self) -> Iterator:
+        for shard in self._shards:
+            yield from shard
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __repr__(self) -> str:
+        return f"FrozenMap({dict(self)!r})"
+
+    def set(self, key, value) -> "FrozenMap":
+        index = hash(key) % _SHARDS
+        shard = self._shards[index]
+        length = self._len if key in shard else self._len + 1
+        shards = list(self._shards)
+        shards[index] = {**shard, key: value}
+        return self._from_shards(tuple(shards), length)
+
+    def delete(self, key) -> "FrozenMap":
+        index = hash(key) % _SHARDS
+        shard = self._shards[index]
+        if key not in shard:
+            return self
+        shards = list(self._shards)
+        shards[index] = {k: v for k, v in shard.items() if k != key}
+        return self._from_shards(tuple(shards), self._len - 1)
+
+    def update(self, items: Mapping, deleted: Iterable = ()) -> "FrozenMap":
+        """
+        New map with `items` set and the `deleted` keys removed, each shard
+        changed is copied once
+        """
+        shards = list(self._shards)
+        copied = set()
+        length = self._len
+        for key in deleted:
+            index = hash(key) % _SHARDS
+            if key in shards[index]:
+                if index not in copied:
+                    shards[index] = dict(shards[index])
+                    copied.add(index)
+                del shards[index][key]
+                length -= 1
+        for key, value in items.items():
+            index = hash(key) % _SHARDS
+            if index not in copied:
+                shards[index] = dict(shards[index])
+                copied.add(index)
+            if key not in shards[index]:
+                length += 1
+            shards[index][key] = value
+        return self._from_shards(tuple(shards), length)
+
+
+class FrozenOrderedSet(Mapping):
+    """
+    Immutable ordered set, read as a mapping of its items to None like the
+    dict keys it replaces. Items are kept in insertion order in chunks, with
+    a FrozenMap of the chunk of each item: `update` returns a new set that
+    shares all but the chunks and the shards it changed.
+    """
+
+    __slots__ = ("_chunks", "_index")
+
+    def __init__(self, items: Iterable = ()):
+        items = list(dict.fromkeys(items))
+        self._chunks: Tuple[Dict, ...] = tuple(
+            dict.fromkeys(items[start : start + _CHUNK_SIZE])
+            for start in range(0, len(items), _CHUNK_SIZE)
+        )
+        # item: position of its chunk
+        self._index = FrozenMap(
+            (item, position // _CHUNK_SIZE) for position, item in enumerate(items)
+        )
+
+    def __getitem__(self, item) -> None:
+        if item not in self._index:
+            raise KeyError(item)
+        return None
+
+    def __contains__(self, item) -> bool:
+        return item in self._index
+
+    def __iter__(self) -> Iterator:
+        for chunk in self._chunks:
+            yield from chunk
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __repr__(self) -> str:
+        return f"FrozenOrderedSet({list(self)!r})"
+
+    def update(
+        self, added: Iterable = (), removed: Iterable = ()
+    ) -> "FrozenOrderedSet":
+        """
+        New set with the `removed` items removed and the `added` items
+        appended, `added` must not be in this set nor in `removed`
+        """
+        chunks = list(self._chunks)
+        copied = set()
+
+        def chunk(position: int) -> Dict:
+            if position not in copied:
+                chunks[position] = dict(chunks[position])
+                copied.add(position)
+            return chunks[position]
+
+        removed = [item for item in removed if item in self._index]
+        for item in removed:
+            del chunk(self._index[item])[item]
+        positions = {}
+        for item in added:
+            if not chunks or len(chunks[-1]) >= _CHUNK_SIZE:
+                chunks.append({})
+                copied.add(len(chunks) - 1)
+            chunk(len(chunks) - 1)[item] = None
+            positions[item] = len(chunks) - 1
+        frozen = object.__new__(FrozenOrderedSet)
+        frozen._chunks = tuple(chunks)
+        frozen._index = self._index.update(positions, removed)
+        if len(chunks) > 2 * len(frozen) // _CHUNK_SIZE + 1:
+            # chunks less than half full on average, packed again
+            return FrozenOrderedSet(frozen)
+        return frozen
+
+
+def freeze_view_group(view_group: Mapping) -> Mapping:
+    """
+    Read-only view_group, view_machines as a FrozenOrderedSet (read as dict
+    keys, values are None)
+    """
+    view_machines = view_group.get("view_machines") or ()
+    if not isinstance(view_machines, FrozenOrderedSet):
+        view_machines = FrozenOrderedSet(view_machines)
+    return MappingProxyType({**view_group, "view_machines": view_machines})
+
+
+class Snapshot(NamedTuple):
+    """
+    Statuses and view groups at a given version, never mutated
+    """
+
+    version: int
+    # machine_id: latest report, reports are never mutated either
+    statuses: FrozenMap
+    # view_key: read-only view_group, see freeze_view_group
+    views: FrozenMap
+
+    def set_status(self, machine_id: str, report: dict) -> "Snapshot":
+        return Snapshot(
+            self.version + 1, self.statuses.set(machine_id, report), self.views
+        )
+
+    def remove_status(self, machine_id: str) -> "Snapshot":
+        return Snapshot(self.version + 1, self.statuses.delete(machine_id), self.views)
+
+    def set_view_group(self, view_key: str, view_group: Mapping) -> "Snapshot":
+        return Snapshot(
+            self.version + 1,
+            self.statuses,
+            self.views.set(view_key, freeze_view_group(view_group)),
+        )
@@ -0,0 +1,112 @@
+import asyncio
+import os
+from typing import AsyncIterator, Callable, Dict, Iterable, List, Set
+
+###############################################################################
+### Server-Sent Events for view updates
+
+# max number of machines with a pending update per subscriber, a subscriber
+# falling further behind is sent the whole view again instead
+STREAM_QUEUE_SIZE = int(os.environ.get("STREAM_QUEUE_SIZE", 1024))
+# seconds to wait after an update so that a burst of reports is sent at once
+STREAM_COALESCE_SECONDS = float(os.environ.get("STREAM_COALESCE_SECONDS", 0.5))
+# seconds between two keep-alive comments on an idle stream
+STREAM_KEEPALIVE_SECONDS = 15
+
+
+class Subscriber:
+    """
+    Pending updates of one stream, coalesced by machine_id:
+    only the latest status of each machine is kept until it is sent
+    """
+
+    __slots__ = ("pending", "event", "overflowed")
+
+    def __init__(self):
+        self.pending: Dict[str, bytes] = {}  # machine_id: status JSON
+        self.event = asyncio.Event()
+        self.overflowed = False
+
+    def push(self, machine_id: str, data: bytes) -> None:
+        if machine_id not in self.pending and len(self.pending) >= STREAM_QUEUE_SIZE:
+            self.overflowed = True
+            self.pending.clear()
+        elif not self.overflowed:
+            self.pending[machine_id] = data
+        self.event.set()
+
+    def drain(self) -> List[bytes]:
+        self.event.clear()
+        data = list(self.pending.values())
+        self.pending.clear()
+        return data
+
+
+class Broadcaster:
+    """
+    Subscribers by view_key
+    """
+
+    def __init__(self):
+        self._subscribers: Dict[str, Set[Subscriber]] = {}
+
+    def subscribe(self, view_key: str) -> Subscriber:
+        subscriber = Subscriber()
+        self._subscribers.setdefault(view_key, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, view_key: str, subscriber: Subscriber) -> None:
+        subscribers = self._subscribers.get(view_key)
+        if subscribers is not None:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self._subscribers[view_key]
+
+    def has_subscribers(self, view_keys: Iterable[str]) -> bool:
+        return any(view_key in self._subscribers for view_key in view_keys)
+
+    def publish(self, view_keys: Iterable[str], machine_id: str, data: bytes) -> None:
+        for view_key in view_keys:
+            for subscriber in self._subscribers.get(view_key, ()):
+                subscriber.push(machine_id, data)
+
+
+async def stream_view(
+    broadcaster: Broadcaster,
+    view_key: str,
+    get_view_json: Callable[[], bytes],
+) -> AsyncIterator[bytes]:
+    """
+    Server-Sent Events of a view:
+        event: view     data: JSON array of all statuses, sent first and
+                        whenever the subscriber fell too far behind
+        event: status   data: JSON status of a machine that reported
+    """
+    subscriber = broadcaster.subscribe(view_key)
+    try:
+        yield b"event: view\ndata: " + get_view_json() + b"\n\n"
+        while True:
+            try:
+                await asyncio.wait_for(
+                    subscriber.event.wait(), timeout=STREAM_KEEPALIVE_SECONDS
+                )
+            except asyncio.TimeoutError:
+                yield b": keep-alive\n\n"
+                continue
+            await asyncio.sleep(STREAM_COALESCE_SECONDS)
+            if subscriber.overflowed:
+                subscriber.overflowed = False
+                subscriber.drain()
+                try:
+                    data = get_view_json()
+                except ValueError:
+                    # view deleted or disabled meanwhile
+                    return
+                yield b"event: view\ndata: " + data + b"\n\n"
+            else:
+                yield b"".join(
+                    b"event: status\ndata: " + data + b"\n\n"
+                    for data in subscriber.drain()
+                )
+    finally:
+        broadcaster.unsubscribe(view_key, subscriber)
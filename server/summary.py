@@ -0,0 +1,143 @@
+from typing import Dict, Iterable, Mapping, Optional, Tuple
+
+###############################################################################
+### View Summaries
+#
+# Aggregates of each view group, updated on every report by subtracting the
+# previous contribution of the machine and adding the new one, so reading a
+# summary does not depend on the number of machines.
+
+# usage above which a disk is counted as almost full, range [0, 1]
+DISK_USAGE_ALERT = 0.9
+
+
+class Contribution:
+    """
+    What a machine adds to the summaries of the views containing it.
+    GPUs and disks of an offline machine are not counted.
+    """
+
+    __slots__ = (
+        "online",
+        "gpus",
+        "gpu_memory_total",
+        "gpu_memory_free",
+        "gpu_usage",
+        "disks_over_90",
+    )
+
+    def __init__(self, report: Optional[dict] = None, online: bool = True):
+        self.online = int(online)
+        self.gpus = 0
+        self.gpu_memory_total = 0.0
+        self.gpu_memory_free = 0.0
+        self.gpu_usage = 0.0  # sum over gpus
+        self.disks_over_90 = 0
+        if report is None or not online:
+            return
+        for gpu in report.get("gpu_status") or ():
+            self.gpus += 1
+            self.gpu_memory_total += gpu.get("memory_total") or 0.0
+            self.gpu_memory_free += gpu.get("memory_free") or 0.0
+            self.gpu_usage += gpu.get("gpu_usage") or 0.0
+        for disk in report.get("disk_info") or ():
+            if (disk.get("usage") or 0.0) > DISK_USAGE_ALERT:
+                self.disks_over_90 += 1
+
+
+class ViewSummary:
+    __slots__ = ("machines", *Contribution.__slots__)
+
+    def __init__(self):
+        self.machines = 0  # machines of the view that reported
+        self.online = 0
+        self.gpus = 0
+        self.gpu_memory_total = 0.0
+        self.gpu_memory_free = 0.0
+        self.gpu_usage = 0.0
+        self.disks_over_90 = 0
+
+    def add(self, contribution: Contribution, sign: int = 1) -> None:
+        self.machines += sign
+        for name in Contribution.__slots__:
+            value = getattr(self, name) + sign * getattr(contribution, name)
+            setattr(self, name, value)
+
+    def to_dict(self) -> dict:
+        return {
+            "machines": self.machines,
+            "online": self.online,
+            "offline": self.machines - self.online,
+            "gpus": self.gpus,
+            # sums of floats drift a little as contributions come and go
+            "gpu_memory_total": round(self.gpu_memory_total, 1),
+            "gpu_memory_free": round(self.gpu_memory_free, 1),
+            "gpu_usage_avg": (
+                round(self.gpu_usage / self.gpus, 4) if self.gpus > 0 else None
+            ),
+            "disks_over_90": self.disks_over_90,
+        }
+
+
+class Summaries:
+    """
+    Contribution of each machine and summary of each view, not part of the state
+    """
+
+    def __init__(self):
+        self._contributions: Dict[str, Contribution] = {}  # machine_id
+        self._views: Dict[str, ViewSummary] = {}  # view_key
+
+    def clear(self) -> None:
+        self._contributions.clear()
+        self._views.clear()
+
+    def get(self, view_key: str) -> ViewSummary:
+        summary = self._views.get(view_key)
+        if summary is None:
+            summary = self._views[view_key] = ViewSummary()
+        return summary
+
+    def rebuild(
+        self,
+        contributions: Iterable[Tuple[str, Contribution]],
+        machine_views: Mapping[str, Iterable[str]],
+    ) -> None:
+        """
+        Summaries of all views from the contribution of every machine
+        """
+        self.clear()
+        for machine_id, contribution in contributions:
+            self._contributions[machine_id] = contribution
+            for view_key in machine_views.get(machine_id, ()):
+                self.get(view_key).add(contribution)
+
+    def update_machine(
+        self, machine_id: str, contribution: Contribution, view_keys: Iterable[str]
+    ) -> None:
+        """
+        Replace the contribution of a machine in the summaries of its views
+        """
+        previous = self._contributions.get(machine_id)
+        self._contributions[machine_id] = contribution
+        for view_key in view_keys:
+            summary = self.get(view_key)
+            if previous is not None:
+                summary.add(previous, -1)
+            summary.add(contribution)
+
+    def remove_machine(self, machine_id: str, view_keys: Iterable[str]) -> None:
+        previous = self._contributions.pop(machine_id, None)
+        if previous is not None:
+            for view_key in view_keys:
+                self.get(view_key).add(previous, -1)
+
+    def add_to_view(self, view_key: str, machine_id: str) -> None:
+        contribution = self._contributions.get(machine_id)
+        if contribution is not None:
+            self.get(view_key).add(contribution)
+
+    def remove_from_view(self, view_key: str, machine_id: str) -> None:
+        contribution = self._contributions.get(machine_id)
+        if contribution is not None:
+            self.get(view_key).add(contribution, -1)
@@ -0,0 +1,128 @@
+import itertools
+from typing import Dict, Iterable, Optional, Tuple
+
+from server import codec, ingest
+from server.profiles import Status
+
+###############################################################################
+### Serialized View Cache
+
+
+def serialize_status(report: dict, fmt: str = codec.JSON) -> bytes:
+    """
+    Serialize a stored report the same way as response_model=MachineStatus,
+    without validating it again
+    """
+    if isinstance(report, Status):
+        report = report.to_dict()
+    if fmt == codec.MSGPACK:
+        return codec.pack(ingest.dump_report(report))
+    return ingest.dump_report_json(report)
+
+
+class ViewCache:
+    """
+    Serialized bytes of each machine's latest status and of each view, per
+    wire format, so that polling an unchanged view neither validates nor
+    serializes anything.
+
+    A report only invalidates the status of its machine and the views that
+    contain it; a view is then rebuilt by joining the cached statuses.
+
+    Entries built by a reader from a snapshot that a writer has invalidated
+    meanwhile are never served: statuses are checked against the report
+    they were serialized from and views against the epoch of the view.
+    """
+
+    def __init__(self):
+        # format: machine_id: (report, serialized status)
+        self._statuses: Dict[str, Dict[str, Tuple[dict, bytes]]] = {
+            codec.JSON: {},
+            codec.MSGPACK: {},
+        }
+        # format: (view_key, online_only): (epoch, serialized array of statuses)
+        self._views: Dict[str, Dict[Tuple[str, bool], Tuple[int, bytes]]] = {
+            codec.JSON: {},
+            codec.MSGPACK: {},
+        }
+        # view_key: epoch, bumped on every invalidation
+        self._epochs: Dict[str, int] = {}
+        self._clock = itertools.count(1)
+
+    def invalidate_machine(self, machine_id: str, view_keys: Iterable[str]) -> None:
+        for statuses in self._statuses.values():
+            statuses.pop(machine_id, None)
+        for view_key in view_keys:
+            self.invalidate_view(view_key)
+
+    def invalidate_view(self, view_key: str) -> None:
+        self._epochs[view_key] = next(self._clock)
+        for views in self._views.values():
+            views.pop((view_key, False), None)
+            views.pop((view_key, True), None)
+
+    def clear(self) -> None:
+        for cache in (*self._statuses.values(), *self._views.values()):
+            cache.clear()
+
+    def epoch(self, view_key: str) -> int:
+        """
+        Epoch of a view, to be read before the snapshot a view is built from
+        """
+        return self._epochs.get(view_key, 0)
+
+    def status_bytes(
+        self, machine_id: str, report: dict, fmt: str = codec.JSON
+    ) -> bytes:
+        statuses = self._statuses[fmt]
+        entry = statuses.get(machine_id)
+        if entry is not None and entry[0] is report:
+            return entry[1]
+        data = serialize_status(report, fmt)
+        statuses[machine_id] = (report, data)
+        return data
+
+    def view_bytes(
+        self, view_key: str, fmt: str = codec.JSON, online_only: bool = False
+    ) -> Optional[bytes]:
+        """
+        Returns:
+            Optional[bytes]: cached array of the view, None if dirty
+        """
+        entry = self._views[fmt].get((view_key, online_only))
+        if entry is not None and entry[0] == self.epoch(view_key):
+            return entry[1]
+        return None
+
+    def build_view_bytes(
+        self,
+        view_key: str,
+        statuses: Iterable[Tuple[str, dict]],
+        fmt: str = codec.JSON,
+        online_only: bool = False,
+        epoch: Optional[int] = None,
+    ) -> bytes:
+        """
+        Join the cached statuses of the machines of a view and cache the result
+
+        Args:
+            view_key (str): view_key
+            statuses (Iterable[Tuple[str, dict]]): machine_id and report of the
+                machines in the view, in view order
+            fmt (str): codec.JSON or codec.MSGPACK
+            online_only (bool): the statuses exclude the offline machines
+            epoch (int): epoch of the view when the statuses were taken,
+                the current epoch if not given
+        """
+        items = [
+            self.status_bytes(machine_id, report, fmt)
+            for machine_id, report in statuses
+        ]
+        if fmt == codec.MSGPACK:
+            data = codec.msgpack_array_header(len(items)) + b"".join(items)
+        else:
+            data = b"[" + b",".join(items) + b"]"
+        if epoch is None:
+            epoch = self.epoch(view_key)
+        self._views[fmt][(view_key, online_only)] = (epoch, data)
+        return data
@@ -0,0 +1,118 @@
+import time
+import uuid
+from datetime import datetime
+
+import pytest
+
+import server.database as db
+from server.alerts import STALENESS, AlertEngine, compile_rules
+from tests.test_database import make_report, new_report_key
+
+
+def engine_with(*specs):
+    notifications = []
+    engine = AlertEngine(compile_rules(specs), notifications.append)
+    return engine, notifications
+
+
+def statuses(notifications):
+    return [(n["status"], n["value"]) for n in notifications]
+
+
+TEMPERATURE = {
+    "name": "hot",
+    "metric": "gpu.*.temperature",
+    "above": 90,
+    "clear": 85,
+    "for": 20,
+}
+
+
+def test_fires_after_the_duration_and_resolves_past_clear():
+    engine, notifications = engine_with(TEMPERATURE)
+    for ts, value in [(0, 91), (10, 95), (20, 92)]:
+        engine.evaluate("m", ts, {"gpu.0.temperature": value})
+    assert statuses(notifications) == [("firing", 92)]
+    assert engine.firing(["m"])[0]["since"] == 0
+
+    # between clear and the threshold: still firing, not notified again
+    for ts, value in [(30, 88), (40, 93), (50, 86)]:
+        engine.evaluate("m", ts, {"gpu.0.temperature": value})
+    assert len(notifications) == 1
+    assert engine.firing(["m"])[0]["value"] == 86
+
+    engine.evaluate("m", 60, {"gpu.0.temperature": 84})
+    assert statuses(notifications) == [("firing", 92), ("resolved", 84)]
+    assert notifications[-1]["threshold"] == 85
+    assert engine.firing() == []
+
+
+def test_pending_alert_is_dropped_without_notification():
+    engine, notifications = engine_with(TEMPERATURE)
+    engine.evaluate("m", 0, {"gpu.0.temperature": 91})
+    engine.evaluate("m", 10, {"gpu.0.temperature": 89})
+    engine.evaluate("m", 20, {"gpu.0.temperature": 91})
+    engine.evaluate("m", 30, {"gpu.0.temperature": 91})
+    assert notifications == []
+    # the duration starts over at the second breach
+    engine.evaluate("m", 40, {"gpu.0.temperature": 91})
+    assert statuses(notifications) == [("firing", 91)]
+
+
+def test_below_rule_and_replays():
+    engine, notifications = engine_with(
+        {"name": "low", "metric": "ram_free", "below": 1, "clear": 2}
+    )
+    engine.evaluate("m", 0, {"ram_free": 0.5}, notify=False)
+    assert notifications == [] and len(engine.firing()) == 1
+    engine.evaluate("m", 10, {"ram_free": 1.5})
+    assert notifications == []
+    engine.evaluate("m", 20, {"ram_free": 3})
+    assert statuses(notifications) == [("resolved", 3)]
+
+
+def test_staleness_fires_on_sweep_and_resolves_on_report():
+    engine, notifications = engine_with(
+        {"name": "stale", "metric": STALENESS, "above": 60}
+    )
+    engine.evaluate("m", 0, {})
+    engine.sweep(30, {"m": 0})
+    assert notifications == []
+    engine.sweep(60, {"m": 0})
+    assert statuses(notifications) == [("firing", 60)]
+    engine.sweep(120, {"m": 0})
+    assert len(notifications) == 1
+    engine.evaluate("m", 130, {})
+    assert statuses(notifications)[-1] == ("resolved", 0.0)
+    assert engine.firing() == []
+
+
+def test_staleness_after_restore(monkeypatch):
+    report_key, machine_id = new_report_key(), uuid.uuid4().hex
+    created_at = datetime.fromtimestamp(time.time() - 100)
+    db.store_report(make_report(machine_id, report_key, created_at=created_at))
+    state = db._dump_state()
+    # restarted: the alert engine starts empty
+    engine, notifications = engine_with(
+        {"name": "stale", "metric": STALENESS, "above": 60}
+    )
+    monkeypatch.setattr(db.DB, "ALERTS", engine)
+    db._load_state(state)
+    db.sweep()
+    fired = [n for n in notifications if n["machine_id"] == machine_id]
+    assert [n["status"] for n in fired] == ["firing"]
+
+
+@pytest.mark.parametrize(
+    "spec",
+    [
+        {"name": "x", "metric": "cpu_usage"},
+        {"name": "x", "metric": "cpu_usage", "above": 1, "below": 0},
+        {"name": "x", "metric": "cpu_usage", "above": 1, "clear": 2},
+        {"name": "x", "metric": "cpu_usage", "above": 1, "for": -1},
+        {"name": "x", "metric": STALENESS, "below": 1},
+    ],
+)
+def test_invalid_rules(spec):
+    with pytest.raises(ValueError):
+        compile_rules([spec])
@@ -0,0 +1,64 @@
+import json
+import time
+
+import pytest
+
+from server.codec import JSON, MSGPACK, peek_fields
+
+
+def test_peek_json_top_level_fields():
+    body = json.dumps({"report_key": "k", "name": "n", "machine_id": "m"}).encode()
+    assert peek_fields(body, JSON) == ("k", "m")
+
+
+def test_peek_json_skips_nested_fields():
+    body = json.dumps(
+        {
+            "gpu_status": [{"machine_id": "nested", "report_key": "nested"}],
+            "extra": {"machine_id": "nested"},
+            'quoted "machine_id": "in a key': 1,
+            "name": '"report_key": "in a string"',
+            "machine_id": "m",
+            "report_key": "k",
+        }
+    ).encode()
+    assert peek_fields(body, JSON) == ("k", "m")
+    # a key ending with an escaped quote followed by machine_id
+    body = rb'{"x\"machine_id": "key", "machine_id": "m", "report_key": "k"}'
+    assert json.loads(body)['x"machine_id'] == "key"
+    assert peek_fields(body, JSON) == ("k", "m")
+
+
+def test_peek_json_missing_or_invalid():
+    assert peek_fields(b'{"machine_id": 1, "disk": {"report_key": "k"}}', JSON) == (
+        None,
+        None,
+    )
+    assert peek_fields(b"not json", JSON) == (None, None)
+
+
+def test_peek_json_escaped_value():
+    body = json.dumps({"machine_id": 'a"b\\c', "report_key": "k"}).encode()
+    assert peek_fields(body, JSON) == ("k", 'a"b\\c')
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        b'{"data": [' + b",".join([b'{"machine_id":"x"}'] * 100000) + b"]}",
+        b'{"x": "' + b'\\"' * 500000,
+        b'"\\"' * 500000,
+    ],
+)
+def test_peek_json_large_body_is_bounded(body):
+    start = time.perf_counter()
+    assert peek_fields(body, JSON) == (None, None)
+    assert time.perf_counter() - start < 0.5
+
+
+def test_peek_msgpack_top_level_fields():
+    msgpack = pytest.importorskip("msgpack")
+    body = msgpack.packb(
+        {"gpu_status": [{"machine_id": "nested"}], "machine_id": "m", "report_key": "k"}
+    )
+    assert peek_fields(body, MSGPACK) == ("k", "m")
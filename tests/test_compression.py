@@ -0,0 +1,57 @@
+import gzip
+
+import pytest
+from starlette.testclient import TestClient
+
+from server.compression import DecompressMiddleware
+
+BODY = b'{"machine_id": "m"}' * 100
+
+
+async def echo(scope, receive, send):
+    message = await receive()
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": message["body"]})
+
+
+def post(body: bytes, encoding: str, max_size: int = 1024 * 1024):
+    client = TestClient(DecompressMiddleware(echo, max_size=max_size))
+    return client.post("/", content=body, headers={"Content-Encoding": encoding})
+
+
+def compress(encoding: str, data: bytes) -> bytes:
+    if encoding == "gzip":
+        return gzip.compress(data)
+    zstandard = pytest.importorskip("zstandard")
+    return zstandard.ZstdCompressor().compress(data)
+
+
+@pytest.mark.parametrize("encoding", ["gzip", "zstd"])
+def test_decodes_body(encoding):
+    response = post(compress(encoding, BODY), encoding)
+    assert response.status_code == 200
+    assert response.content == BODY
+
+
+@pytest.mark.parametrize("encoding", ["gzip", "zstd"])
+def test_truncated_body_is_rejected(encoding):
+    response = post(compress(encoding, BODY)[:-4], encoding)
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize("encoding", ["gzip", "zstd"])
+def test_data_after_the_stream_is_rejected(encoding):
+    response = post(compress(encoding, BODY) + b"trailing", encoding)
+    assert response.status_code == 400
+    response = post(compress(encoding, BODY) * 2, encoding)
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize("encoding", ["gzip", "zstd"])
+def test_decompressed_size_is_bounded(encoding):
+    response = post(compress(encoding, b"0" * 1024 * 1024), encoding, 64 * 1024)
+    assert response.status_code == 413
+
+
+def test_unsupported_encoding():
+    assert post(BODY, "br").status_code == 415
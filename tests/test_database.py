@@ -0,0 +1,367 @@
+import asyncio
+import json
+import pickle
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+import server.database as db
+from server import ingest, stream
+from server.data_model import MachineStatusDelta, ViewGroup
+from server.liveness import Liveness
+from server.metric_history import MetricHistory
+from server.profiles import DYNAMIC_FIELDS
+from server.ratelimit import RateLimited
+from server.segments import SegmentStore
+
+
+def new_report_key() -> str:
+    return db.create_new_report_key("1000")["report_key"]
+
+
+def make_report(machine_id: str, report_key: str, **fields) -> dict:
+    return ingest.parse_report(
+        {
+            "machine_id": machine_id,
+            "report_key": report_key,
+            "name": "node",
+            "cpu_usage": 0.5,
+            "gpu_status": [
+                {"index": 0, "gpu_name": "A100", "memory_free": 1000.0},
+            ],
+            **fields,
+        }
+    )
+
+
+def delta(machine_id: str, report_key: str, base_version: int, patch: dict):
+    return MachineStatusDelta(
+        machine_id=machine_id,
+        report_key=report_key,
+        base_version=base_version,
+        patch=patch,
+    )
+
+
+###############################################################################
+### Delta versioning
+
+
+def test_delta_merges_into_acknowledged_version():
+    report_key, machine_id = new_report_key(), uuid.uuid4().hex
+    version = db.store_report(make_report(machine_id, report_key))
+    assert version == db.report_version(db.DB.STATUS_DATA[machine_id])
+
+    new_version = db.store_report_delta(
+        delta(machine_id, report_key, version, {"cpu_usage": 0.9})
+    )
+    stored = db.DB.STATUS_DATA[machine_id]
+    assert new_version == db.report_version(stored) > version
+    assert stored["cpu_usage"] == 0.9
+    assert stored["name"] == "node"
+
+
+def test_delta_on_another_base_requires_resync():
+    report_key, machine_id = new_report_key(), uuid.uuid4().hex
+    version = db.store_report(make_report(machine_id, report_key))
+    db.store_report_delta(delta(machine_id, report_key, version, {"cpu_usage": 0.9}))
+    with pytest.raises(db.ResyncRequired):
+        db.store_report_delta(
+            delta(machine_id, report_key, version, {"cpu_usage": 0.1})
+        )
+    with pytest.raises(db.ResyncRequired):
+        db.store_report_delta(delta(uuid.uuid4().hex, report_key, version, {}))
+
+
+def test_delta_ignores_identity_fields():
+    report_key, machine_id = new_report_key(), uuid.uuid4().hex
+    version = db.store_report(make_report(machine_id, report_key))
+    db.store_report_delta(
+        delta(machine_id, report_key, version, {"machine_id": "x", "name": "renamed"})
+    )
+    stored = db.DB.STATUS_DATA[machine_id]
+    assert stored["machine_id"] == machine_id
+    assert stored["name"] == "renamed"
+
+
+def test_report_older_than_stored_is_rejected():
+    report_key, machine_id = new_report_key(), uuid.uuid4().hex
+    now = datetime.now()
+    version = db.store_report(make_report(machine_id, report_key, created_at=now))
+    with pytest.raises(ValueError):
+        db.store_report(
+            make_report(machine_id, report_key, created_at=now - timedelta(seconds=1))
+        )
+    # the acknowledged version is still the base of the next delta
+    assert db.report_version(db.DB.STATUS_DATA[machine_id]) == version
+    db.store_report_delta(delta(machine_id, report_key, version, {"cpu_usage": 0.1}))
+
+
+def test_report_of_deleted_report_key_is_rejected():
+    report_key, machine_id = new_report_key(), uuid.uuid4().hex
+    db.delete_report_key("1000", report_key)
+    # deleted by another worker after store_report checked the report_key
+    with pytest.raises(ValueError):
+        db._accept_report(make_report(machine_id, report_key))
+    assert machine_id not in db.DB.STATUS_DATA
+
+
+def test_report_rejected_by_the_history_is_not_published():
+    report_key, machine_id = new_report_key(), uuid.uuid4().hex
+    now = datetime.now()
+    version = db.store_report(make_report(machine_id, report_key, created_at=now))
+    # not storable as a 32-bit unix time, past the validation
+    report = make_report(machine_id, report_key)
+    report["created_at"] = datetime(2200, 1, 1)
+    with pytest.raises(OverflowError):
+        db.store_report(report)
+    assert db.report_version(db.DB.STATUS_DATA[machine_id]) == version
+    assert len(db.DB.HISTORY[machine_id].query()) == 1
+    # not locked out by the rejected report
+    later = now + timedelta(seconds=1)
+    db.store_report(make_report(machine_id, report_key, created_at=later))
+
+
+def test_replayed_report_only_updates_the_status():
+    report_key, machine_id = new_report_key(), uuid.uuid4().hex
+    view_key = new_view([machine_id])
+    # received by another worker
+    db._replay("report", db.compact(make_report(machine_id, report_key)))
+    assert machine_id in db.DB.STATUS_DATA
+    assert db.get_view_summary(view_key)["machines"] == 1
+    # its history stays with the worker that received it
+    assert machine_id not in db.DB.HISTORY
+    assert machine_id not in db.DB.METRIC_HISTORY
+    assert machine_id not in db.DB.ROLLUPS
+
+
+def test_batch_reports_succeed_or_fail_one_by_one():
+    report_key = new_report_key()
+    stored, limited = uuid.uuid4().hex, uuid.uuid4().hex
+
+    def admit(report_key, machine_id):
+        if machine_id == limited:
+            raise RateLimited("Too many reports from this machine", 2.0)
+
+    reports = [
+        {"machine_id": stored, "report_key": report_key, "cpu_usage": 0.5},
+        {"machine_id": uuid.uuid4().hex, "report_key": report_key, "cpu_usage": "x"},
+        {"machine_id": uuid.uuid4().hex, "report_key": "unknown"},
+        {"machine_id": limited, "report_key": report_key},
+    ]
+    results = db.store_report_batch(reports, admit)
+    assert [result["status_code"] for result in results] == [201, 400, 400, 429]
+    assert results[0]["version"] == db.report_version(db.DB.STATUS_DATA[stored])
+    assert results[3]["retry_after"] == 2.0
+    assert limited not in db.DB.STATUS_DATA
+
+
+###############################################################################
+### View membership
+
+
+def new_view(machine_ids) -> str:
+    view_group = db.create_new_view_group(
+        "1000", ViewGroup(view_machines=list(machine_ids))
+    )
+    return view_group.view_key
+
+
+def test_view_membership_updates_keep_the_order_and_the_reverse_index():
+    view_key = new_view(["a", "b", "c"])
+    previous = db.DB.SNAPSHOT
+    db.update_machines_in_view("1000", view_key, add=["d", "a"], remove=["b"])
+    assert list(db.DB.ALL_VIEW_KEYS[view_key]["view_machines"]) == ["a", "c", "d"]
+    # readers of the previous snapshot still see the previous machines
+    assert list(previous.views[view_key]["view_machines"]) == ["a", "b", "c"]
+    assert view_key in db.DB.MACHINE_VIEWS["d"]
+    assert view_key not in db.DB.MACHINE_VIEWS.get("b", ())
+
+    # added and removed at once: not in the view
+    db.update_machines_in_view("1000", view_key, add=["e"], remove=["e"])
+    assert "e" not in db.DB.ALL_VIEW_KEYS[view_key]["view_machines"]
+
+    db.update_machines_in_view("1000", view_key, update=["d", "b"], overwrite=True)
+    assert list(db.DB.ALL_VIEW_KEYS[view_key]["view_machines"]) == ["d", "b"]
+    assert view_key in db.DB.MACHINE_VIEWS["b"]
+    assert view_key not in db.DB.MACHINE_VIEWS.get("a", ())
+
+
+def test_view_membership_updates_the_view_summary():
+    report_key, machine_id = new_report_key(), uuid.uuid4().hex
+    db.store_report(make_report(machine_id, report_key))
+    view_key = new_view([])
+    assert db.get_view_summary(view_key)["machines"] == 0
+    db.update_machines_in_view("1000", view_key, add=[machine_id])
+    assert db.get_view_summary(view_key)["machines"] == 1
+    assert db.find_available_gpus(view_key)[0]["machine_id"] == machine_id
+    db.update_machines_in_view("1000", view_key, remove=[machine_id])
+    assert db.get_view_summary(view_key)["machines"] == 0
+    assert db.find_available_gpus(view_key) == []
+
+
+###############################################################################
+### Metric history
+
+
+def test_segments_are_read_only_for_a_range_before_the_memory(monkeypatch, tmp_path):
+    store = SegmentStore(str(tmp_path))
+    monkeypatch.setattr(db, "SEGMENTS", store)
+    report_key, machine_id = new_report_key(), uuid.uuid4().hex
+    view_key = new_view([machine_id])
+    now = datetime.now()
+    for seconds in (-20, -10, 0):
+        created_at = now + timedelta(seconds=seconds)
+        db.store_report(make_report(machine_id, report_key, created_at=created_at))
+    # samples evicted from memory, still on disk
+    db.DB.METRIC_HISTORY[machine_id] = MetricHistory(1)
+    db.DB.METRIC_HISTORY[machine_id].append(now.timestamp(), {"cpu_usage": 0.5})
+
+    def query(since=None):
+        return asyncio.run(db.get_view_machine_metrics(view_key, machine_id, since))
+
+    assert len(query()["timestamps"]) == 1
+    assert len(query(now - timedelta(seconds=30))["timestamps"]) == 3
+    store.close()
+
+
+def test_rollup_is_chosen_by_step_whatever_since(monkeypatch, tmp_path):
+    store = SegmentStore(str(tmp_path))
+    monkeypatch.setattr(db, "SEGMENTS", store)
+    report_key, machine_id = new_report_key(), uuid.uuid4().hex
+    view_key = new_view([machine_id])
+    now = datetime.now()
+    db.store_report(make_report(machine_id, report_key, created_at=now))
+
+    def resolution(since=None):
+        result = asyncio.run(
+            db.get_view_machine_metrics(view_key, machine_id, since, step=3600)
+        )
+        return result["resolution"]
+
+    assert resolution() == 3600
+    assert resolution(now) == 3600
+    # older than the rollups, read from the segments
+    assert resolution(now - timedelta(days=30)) == 0
+    store.close()
+
+
+###############################################################################
+### Derived views
+
+
+def test_view_bytes_are_cached_until_a_machine_reports():
+    report_key, machine_id = new_report_key(), uuid.uuid4().hex
+    view_key = new_view([machine_id])
+    now = datetime.now()
+    db.store_report(make_report(machine_id, report_key, created_at=now))
+    data = db.get_view_bytes(view_key)
+    assert db.get_view_bytes(view_key) is data
+    later = now + timedelta(seconds=1)
+    db.store_report(
+        make_report(machine_id, report_key, created_at=later, cpu_usage=0.9)
+    )
+    data = db.get_view_bytes(view_key)
+    assert json.loads(data)[0]["cpu_usage"] == 0.9
+
+
+def test_reports_are_pushed_to_every_subscriber_of_their_views(monkeypatch):
+    report_key, machine_id = new_report_key(), uuid.uuid4().hex
+    views = [new_view([machine_id]), new_view([machine_id])]
+    subscribers = [db.DB.SUBSCRIBERS.subscribe(view_key) for view_key in views]
+    slow = db.DB.SUBSCRIBERS.subscribe(views[0])
+    try:
+        db.store_report(make_report(machine_id, report_key))
+        for subscriber in subscribers:
+            (data,) = subscriber.drain()
+            assert json.loads(data)["machine_id"] == machine_id
+
+        # a subscriber too far behind drops its updates, to be sent the view
+        monkeypatch.setattr(stream, "STREAM_QUEUE_SIZE", 1)
+        other = uuid.uuid4().hex
+        db.update_machines_in_view("1000", views[0], add=[other])
+        db.store_report(make_report(other, report_key))
+        assert slow.overflowed and slow.drain() == []
+    finally:
+        db.DB.SUBSCRIBERS.unsubscribe(views[0], slow)
+        for view_key, subscriber in zip(views, subscribers):
+            db.DB.SUBSCRIBERS.unsubscribe(view_key, subscriber)
+
+
+def test_metrics_are_rendered_again_once_a_machine_reports():
+    report_key, machine_id = new_report_key(), uuid.uuid4().hex
+    view_key = new_view([machine_id])
+    now = datetime.now()
+    sample = f'mxstatus_cpu_usage_ratio{{machine_id="{machine_id}",name="node"}}'
+    db.store_report(make_report(machine_id, report_key, created_at=now))
+    assert f"{sample} 0.5\n".encode() in db.get_view_metrics(view_key)
+    later = now + timedelta(seconds=1)
+    db.store_report(
+        make_report(machine_id, report_key, created_at=later, cpu_usage=0.9)
+    )
+    assert f"{sample} 0.9\n".encode() in db.get_view_metrics(view_key)
+    db.update_machines_in_view("1000", view_key, remove=[machine_id])
+    assert machine_id.encode() not in db.get_view_metrics(view_key)
+
+
+def test_view_summary_counts_offline_and_evicted_machines(monkeypatch):
+    # only the machines of this test are swept
+    monkeypatch.setattr(db.DB, "LIVENESS", Liveness(60, 3600))
+    report_key = new_report_key()
+    machine_ids = [uuid.uuid4().hex, uuid.uuid4().hex]
+    view_key = new_view(machine_ids)
+    now = datetime.now()
+    db.store_report(make_report(machine_ids[0], report_key, created_at=now))
+    later = now + timedelta(seconds=30)
+    db.store_report(make_report(machine_ids[1], report_key, created_at=later))
+
+    def counts():
+        summary = db.get_view_summary(view_key)
+        return summary["machines"], summary["online"], summary["gpus"]
+
+    assert counts() == (2, 2, 2)
+    db.sweep(now.timestamp() + 61)
+    assert counts() == (2, 1, 1)  # the GPUs of online machines
+    db.sweep(now.timestamp() + 3601)
+    assert counts() == (1, 0, 0)
+    assert machine_ids[0] not in db.DB.STATUS_DATA
+
+
+###############################################################################
+### Compact statuses
+
+
+def test_stored_statuses_share_their_static_profile():
+    report_key = new_report_key()
+    machine_ids = [uuid.uuid4().hex, uuid.uuid4().hex]
+    static = {
+        "cpu_model": "EPYC",
+        "disk_info": [{"filesystem": "/dev/sda1", "mounted_on": "/", "usage": 0.5}],
+    }
+    now = datetime.now()
+    reports = [
+        make_report(machine_id, report_key, created_at=now, **static)
+        for machine_id in machine_ids
+    ]
+    for report in reports:
+        db.store_report(dict(report))
+    first, second = (db.DB.STATUS_DATA[machine_id] for machine_id in machine_ids)
+    assert first.profile is second.profile
+    # read like the validated report
+    assert first.to_dict() == dict(first) == reports[0]
+    assert first["disk_info"][0]["usage"] == 0.5
+    # shared again once replayed from another worker
+    assert pickle.loads(pickle.dumps(first)).profile is first.profile
+
+    # the history shares what did not change with the previous report
+    later = now + timedelta(seconds=1)
+    db.store_report(
+        make_report(
+            machine_ids[0], report_key, created_at=later, cpu_usage=0.9, **static
+        )
+    )
+    previous, latest = db.DB.HISTORY[machine_ids[0]].query()
+    assert latest["cpu_usage"] == 0.9
+    disk_info = DYNAMIC_FIELDS.index("disk_info")
+    assert latest.record[disk_info] is previous.record[disk_info]
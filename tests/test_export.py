@@ -0,0 +1,47 @@
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+import server.database as db
+from server import export
+from server.history import ReportHistory
+from tests.test_database import make_report, new_report_key, new_view
+
+
+def test_history_export_lists_the_reports_retained_on_call():
+    report_key, machine_id = new_report_key(), uuid.uuid4().hex
+    now = datetime.now()
+    db.store_report(make_report(machine_id, report_key, created_at=now))
+    rows = db.export_view(new_view([machine_id]), "machine", history=True)
+    # stored while the rows are produced in a threadpool
+    db.store_report(
+        make_report(machine_id, report_key, created_at=now + timedelta(seconds=1))
+    )
+    assert [row["created_at"] for row in rows] == [now]
+
+
+def test_history_export_reads_the_reports_lazily():
+    report_key, machine_id = new_report_key(), uuid.uuid4().hex
+    now = datetime.now()
+    db.store_report(make_report(machine_id, report_key, created_at=now))
+    db.DB.HISTORY[machine_id] = ReportHistory(2)
+    times = [now + timedelta(seconds=seconds) for seconds in range(1, 5)]
+    for created_at in times[:2]:
+        db.store_report(make_report(machine_id, report_key, created_at=created_at))
+    rows = db.export_view(
+        new_view([machine_id]), "machine", history=True, since=times[1]
+    )
+    assert [row["created_at"] for row in rows] == [times[1]]
+    rows = db.export_view(new_view([machine_id]), "machine", history=True)
+    # overwrites the oldest report before its row is produced
+    db.store_report(make_report(machine_id, report_key, created_at=times[2]))
+    assert [row["created_at"] for row in rows] == [times[1]]
+
+
+def test_arrow_without_pyarrow_is_unsupported(monkeypatch):
+    monkeypatch.setattr(export, "pyarrow", None)
+    with pytest.raises(export.UnsupportedFormat):
+        export.check_format(export.ARROW)
+    with pytest.raises(ValueError):
+        export.check_format("xml")
@@ -0,0 +1,46 @@
+from server.gpu_index import GPUIndex
+
+
+def report(machine_id: str, *memory_free: float) -> dict:
+    return {
+        "machine_id": machine_id,
+        "gpu_status": [
+            {"gpu_name": "A100", "memory_free": free, "gpu_usage": 0.1}
+            for free in memory_free
+        ],
+    }
+
+
+def machines(entries) -> list:
+    return [(machine_id, position) for _, _, machine_id, position in entries]
+
+
+def test_query_only_walks_the_gpus_of_the_view():
+    index = GPUIndex()
+    index.rebuild(
+        [
+            ("a", report("a", 100, 300)),
+            ("b", report("b", 200)),
+            ("c", report("c", 900)),
+        ],
+        {"a": {"v"}, "b": {"v", "w"}},
+    )
+    assert machines(index.query("v", count=5)) == [("a", 1), ("b", 0), ("a", 0)]
+    assert machines(index.query("v", min_free_mb=150, count=5)) == [("a", 1), ("b", 0)]
+    assert machines(index.query("w", count=5)) == [("b", 0)]
+    assert index.query("unknown") == []
+
+
+def test_reports_and_view_membership_update_the_view_lists():
+    index = GPUIndex()
+    index.update_machine("a", report("a", 100), ["v"])
+    index.update_machine("b", report("b", 200), [])
+    assert machines(index.query("v", count=5)) == [("a", 0)]
+    index.add_to_view("v", "b")
+    index.update_machine("a", report("a", 300), ["v"])
+    assert machines(index.query("v", count=5)) == [("a", 0), ("b", 0)]
+    index.remove_from_view("v", "a")
+    assert machines(index.query("v", count=5)) == [("b", 0)]
+    index.remove_machine("b", ["v"])
+    assert index.query("v", count=5) == []
+    assert len(index) == 1
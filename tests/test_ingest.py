@@ -0,0 +1,69 @@
+import json
+from datetime import datetime
+
+import pytest
+from pydantic import ValidationError
+
+from server import ingest
+from server.data_model import MachineStatus
+
+FULL = {
+    "created_at": "2026-01-02T03:04:05",
+    "name": "node",
+    "machine_id": "m",
+    "report_key": "k",
+    "hostname": "host",
+    "ipv4s": ["10.0.0.1"],
+    "uptime": 12.5,
+    "cpu_cores": 8,
+    "cpu_usage": 0.5,
+    "ram_free": 1024.0,
+    "disk_info": [{"filesystem": "/dev/sda1", "size": 100.0, "usage": 0.2}],
+    "gpu_status": [
+        {"index": 0, "gpu_name": "A100", "memory_free": 1000.0},
+        {"index": 1},
+    ],
+    "gpu_compute_processes": [{"pid": 1, "user": "alice", "gpu_mem_used": 10.0}],
+    "users_info": {"alice": ["alice@example.com", None], "bob": []},
+}
+
+
+def model_dump(report: dict) -> dict:
+    # the validators of MachineStatus mutate users_info in place
+    return MachineStatus(**json.loads(json.dumps(report))).model_dump()
+
+
+@pytest.mark.parametrize(
+    "report", [FULL, {"machine_id": "m"}, {"users_info": "not an object"}]
+)
+def test_schema_matches_the_model(report):
+    expected = model_dump(report)
+    for parsed in (
+        ingest.parse_report(json.loads(json.dumps(report))),
+        ingest.parse_report_json(json.dumps(report).encode()),
+    ):
+        if "created_at" not in report:
+            # defaults to now, on both paths
+            assert isinstance(parsed.pop("created_at"), datetime)
+            parsed["created_at"] = expected["created_at"]
+        assert parsed == expected
+
+
+def test_dump_matches_the_model():
+    model = MachineStatus(**json.loads(json.dumps(FULL)))
+    report = ingest.parse_report(json.loads(json.dumps(FULL)))
+    assert report["users_info"]["alice"][0] != "alice@example.com"  # masked
+    assert ingest.dump_report_json(report) == model.model_dump_json().encode()
+
+
+@pytest.mark.parametrize(
+    "created_at", ["1969-12-31T23:00:00+00:00", "2106-03-01T00:00:00+00:00"]
+)
+def test_created_at_out_of_range_is_rejected(created_at):
+    report = {"machine_id": "m", "created_at": created_at}
+    with pytest.raises(ValidationError):
+        ingest.parse_report(report)
+    with pytest.raises(ValidationError):
+        ingest.parse_report_json(json.dumps(report).encode())
+    with pytest.raises(ValidationError):
+        MachineStatus(**report)
@@ -0,0 +1,27 @@
+from server.liveness import Liveness
+
+
+def test_machine_goes_offline_and_back_online():
+    liveness = Liveness(offline_seconds=10, retention_seconds=100)
+    assert liveness.seen("a", 0)
+    assert not liveness.seen("a", 5)
+    assert liveness.sweep(12) == ([], [])  # pushed back to 15
+    assert liveness.sweep(15) == (["a"], [])
+    assert liveness.is_offline("a")
+    assert liveness.seen("a", 20)
+    assert not liveness.is_offline("a")
+    assert liveness.sweep(105) == (["a"], [])  # expiry pushed back to 120
+    assert liveness.sweep(120) == ([], ["a"])
+
+
+def test_evicted_machine_reporting_again_has_one_entry_per_heap():
+    liveness = Liveness(offline_seconds=10, retention_seconds=100)
+    liveness.seen("a", 0)
+    liveness.forget("a")
+    assert liveness.seen("a", 1)
+    liveness.forget("a")
+    assert liveness.seen("a", 2)
+    assert len(liveness._offline_heap) == len(liveness._expiry_heap) == 1
+    assert liveness.sweep(12) == (["a"], [])
+    assert liveness.sweep(102) == ([], ["a"])
+    assert not liveness._offline_heap and not liveness._expiry_heap
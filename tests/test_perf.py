@@ -0,0 +1,87 @@
+import asyncio
+import uuid
+
+from fastapi import FastAPI, HTTPException
+from starlette.testclient import TestClient
+
+from server import main, perf
+from server.ratelimit import LoadShedder, ReportLimiter, TokenBucketLimiter
+from tests.test_database import new_report_key
+
+
+def test_perf_middleware_records_the_404_of_routes_only(monkeypatch):
+    monkeypatch.setattr(perf, "PERF", perf.PerfStats())
+    app = FastAPI()
+    app.add_middleware(perf.PerfMiddleware)
+
+    @app.get("/machine")
+    async def machine():
+        raise HTTPException(status_code=404, detail="Unknown machine")
+
+    client = TestClient(app)
+    assert client.get("/machine").status_code == 404
+    assert client.get("/machine").status_code == 404
+    assert client.get("/unknown").status_code == 404
+    assert client.post("/machine").status_code == 405
+    endpoints = perf.PERF.to_dict()["endpoints"]
+    assert list(endpoints) == ["GET /machine"]
+    assert endpoints["GET /machine"]["status"] == {404: 2}
+
+
+###############################################################################
+### Overload
+
+
+def test_token_bucket_refills_at_the_rate_up_to_the_burst():
+    limiter = TokenBucketLimiter(rate=2, burst=2)
+    assert limiter.acquire("m", now=0) == 0
+    assert limiter.acquire("m", now=0) == 0
+    assert limiter.acquire("m", now=0) == 0.5
+    assert limiter.acquire("m", now=0.5) == 0
+    # full again, not beyond the burst
+    assert limiter.acquire("m", now=100) == 0
+    assert limiter.acquire("m", now=100) == 0
+    assert limiter.acquire("m", now=100) > 0
+
+
+def test_report_beyond_the_rate_is_answered_429(monkeypatch):
+    monkeypatch.setattr(main, "report_limiter", ReportLimiter(1, 1))
+    client = TestClient(main.app)
+    body = {"machine_id": uuid.uuid4().hex, "report_key": new_report_key()}
+    assert client.post("/report", json=body).status_code == 201
+    response = client.post("/report", json=body)
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "1"
+
+
+def test_reports_beyond_the_concurrency_limit_are_shed():
+    release = asyncio.Event()
+
+    async def app(scope, receive, send):
+        await release.wait()
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    shedder = LoadShedder(app, max_concurrent=1)
+
+    async def status(path: str) -> int:
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {"type": "http", "path": path}
+        await shedder(scope, None, send)
+        return sent[0]["status"]
+
+    async def run():
+        first = asyncio.create_task(status("/report"))
+        await asyncio.sleep(0)
+        assert await status("/report_delta") == 503
+        release.set()
+        # not a report endpoint, never shed
+        assert await status("/view") == 200
+        assert await first == 200
+
+    asyncio.run(run())
+    assert shedder.shed == 1 and shedder.in_flight == 0
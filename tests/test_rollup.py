@@ -0,0 +1,52 @@
+import pytest
+
+from server.rollup import Rollups, parse_resolutions
+
+
+def rollups_with_samples(seconds: int, interval: int = 10) -> Rollups:
+    rollups = Rollups(parse_resolutions("60:10,300:4"))
+    for ts in range(0, seconds, interval):
+        rollups.append(ts, {"cpu_usage": ts})
+    return rollups
+
+
+def test_parse_resolutions():
+    assert parse_resolutions("60:360, 300:288") == [(60, 360), (300, 288)]
+    with pytest.raises(ValueError):
+        parse_resolutions("60:10,90:10")
+    with pytest.raises(ValueError):
+        parse_resolutions("60:0")
+
+
+def test_level_is_the_coarsest_resolution_within_step():
+    rollups = rollups_with_samples(0)
+    assert rollups.level(30) is None
+    assert rollups.level(60).resolution == 60
+    assert rollups.level(299).resolution == 60
+    assert rollups.level(3600).resolution == 300
+
+
+def test_buckets_aggregate_the_samples():
+    rollups = rollups_with_samples(180)
+    result = rollups.query(step=60, stat="mean")
+    assert result["resolution"] == 60
+    assert result["timestamps"] == [0, 60, 120]
+    assert result["metrics"]["cpu_usage"] == [25, 85, 145]
+    assert rollups.query(step=60, stat="max")["metrics"]["cpu_usage"] == [50, 110, 170]
+    assert rollups.query(step=60, stat="min")["metrics"]["cpu_usage"] == [0, 60, 120]
+    # merged into one point per step, the open bucket included
+    result = rollups.query(step=120, stat="last")
+    assert result["timestamps"] == [0, 120]
+    assert result["metrics"]["cpu_usage"] == [110, 170]
+
+
+def test_coarser_buckets_and_retention():
+    rollups = rollups_with_samples(3000)
+    fine, coarse = rollups.levels
+    assert len(fine) == 10 and fine.oldest() == 2340
+    assert len(coarse) == 4 and coarse.oldest() == 1500
+    result = rollups.query(since=0, until=2399, step=300)
+    assert result["timestamps"] == [1500, 1800, 2100]
+    assert result["metrics"]["cpu_usage"] == [1645, 1945, 2245]
+    with pytest.raises(ValueError):
+        rollups.query(step=300, stat="median")
@@ -0,0 +1,50 @@
+import os
+
+from server.segments import SegmentStore
+
+DAY = 24 * 3600
+
+
+def store_with_samples(tmp_path, count: int, interval: int = 10, **options):
+    store = SegmentStore(str(tmp_path), segment_seconds=DAY, **options)
+    for i in range(count):
+        store.append("m", DAY + i * interval, {"cpu_usage": i})
+    return store
+
+
+def test_query_bounds(tmp_path):
+    store = store_with_samples(tmp_path, 100)
+    result = store.query("m", since=DAY + 100, until=DAY + 190)
+    assert result["timestamps"] == list(range(DAY + 100, DAY + 200, 10))
+    assert result["metrics"]["cpu_usage"] == list(range(10, 20))
+    assert store.query("m", since=DAY + 1000)["timestamps"] == []
+    assert store.query("unknown", since=0)["timestamps"] == []
+
+
+def test_query_step_reads_the_first_sample_of_each_interval(tmp_path):
+    # two days, one segment each
+    store = store_with_samples(tmp_path, 2 * 8640)
+    result = store.query("m", since=DAY + 5, until=3 * DAY, step=3600)
+    assert len(result["timestamps"]) == 48
+    assert result["timestamps"][:2] == [DAY + 10, DAY + 3610]
+    assert all(
+        b - a >= 3600 for a, b in zip(result["timestamps"], result["timestamps"][1:])
+    )
+
+
+def test_query_points_are_capped(tmp_path):
+    store = store_with_samples(tmp_path, 1000, max_points=100)
+    result = store.query("m", since=DAY, until=DAY + 10000)
+    assert len(result["timestamps"]) == 100
+    # without since, the range starts with the oldest segment
+    assert len(store.query("m", until=DAY + 10000)["timestamps"]) == 100
+
+
+def test_sweep_deletes_the_expired_segments(tmp_path):
+    store = store_with_samples(tmp_path, 2 * 8640, retention_seconds=DAY)
+    assert store.sweep(now=3 * DAY) == 1
+    assert len(store.segments("m")) == 1
+    store.append("m", 3 * DAY, {"cpu_usage": 1})
+    assert store.sweep(now=10 * DAY) == 2
+    assert not os.listdir(tmp_path)
+    store.close()
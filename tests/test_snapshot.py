@@ -0,0 +1,39 @@
+from server import snapshot
+from server.snapshot import FrozenMap, FrozenOrderedSet
+
+
+def test_frozen_map_update_leaves_the_original_unchanged():
+    original = FrozenMap({"a": 1, "b": 2})
+    updated = original.update({"b": 3, "c": 4}, ["a", "missing"])
+    assert dict(updated) == {"b": 3, "c": 4}
+    assert len(updated) == 2
+    assert dict(original) == {"a": 1, "b": 2}
+
+
+def test_frozen_ordered_set_keeps_the_insertion_order(monkeypatch):
+    monkeypatch.setattr(snapshot, "_CHUNK_SIZE", 2)
+    original = FrozenOrderedSet(["a", "b", "c", "a"])
+    assert list(original) == ["a", "b", "c"]
+    updated = original.update(["d", "e"], ["b"])
+    assert list(updated) == ["a", "c", "d", "e"]
+    assert "b" not in updated and "e" in updated and len(updated) == 4
+    assert updated["a"] is None
+    assert dict(updated) == dict.fromkeys(["a", "c", "d", "e"])
+    assert list(original) == ["a", "b", "c"]
+
+
+def test_frozen_ordered_set_shares_the_unchanged_chunks(monkeypatch):
+    monkeypatch.setattr(snapshot, "_CHUNK_SIZE", 2)
+    original = FrozenOrderedSet("abcdef")
+    updated = original.update(["g"], ["c"])
+    assert updated._chunks[0] is original._chunks[0]
+    assert updated._chunks[2] is original._chunks[2]
+    assert list(updated) == list("abdefg")
+
+
+def test_frozen_ordered_set_packs_emptied_chunks(monkeypatch):
+    monkeypatch.setattr(snapshot, "_CHUNK_SIZE", 2)
+    items = FrozenOrderedSet("abcdefgh").update((), "abcdef")
+    assert list(items) == ["g", "h"]
+    assert len(items._chunks) == 1
+    assert list(items.update(["i"], ["g"])) == ["h", "i"]